@@ -0,0 +1,655 @@
+#!/usr/bin/python3
+"""
+Benchmarks for zoa.
+
+Run all benchmarks with `python3 BenchZoa.py` or only some of them by name,
+i.e. `python3 BenchZoa.py deep`.
+"""
+import dataclasses
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from zoa import *
+
+def timeit(fn, repeat=3) -> float:
+  """Return the best time (in seconds) of calling fn."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    t = time.perf_counter() - start
+    if best is None or t < best: best = t
+  return best
+
+def report(name, t, base=None):
+  ratio = f'  ({base / t:.2f}x)' if base else ''
+  print(f'  {name:<40} {t * 1000:10.3f} ms{ratio}')
+
+def tryit(fn):
+  """Time fn, returning None if it hits the recursion limit."""
+  try: return timeit(fn)
+  except RecursionError: return None
+
+################################################################################
+# deep: recursive vs explicit-stack raw encode/decode
+
+def deepPy(depth):
+  v = b'leaf'
+  for _ in range(depth): v = [v, b'x']
+  return v
+
+def widePy(width):
+  return [[b'item', [b'a', b'b']] for _ in range(width)]
+
+def benchDeep():
+  for name, v in [
+      ('deep(500)',   deepPy(500)),
+      ('deep(50000)', deepPy(50000)),
+      ('wide(20000)', widePy(20000))]:
+    print(name)
+    z = ZoaRaw.frPyDeep(v)
+    bw = io.BytesIO(); write_arr_deep(bw, z.arr); b = bw.getvalue()
+    cases = [
+      ('frPy',    lambda: ZoaRaw.frPy(v),     lambda: ZoaRaw.frPyDeep(v)),
+      ('to_py',   lambda: z.to_py(),          lambda: z.to_py_deep()),
+      ('write_arr',
+        lambda: write_arr(io.BytesIO(), z.arr),
+        lambda: write_arr_deep(io.BytesIO(), z.arr)),
+      ('from_zoab',
+        lambda: from_zoab(io.BytesIO(b)),
+        lambda: from_zoab_deep(io.BytesIO(b))),
+    ]
+    for case, rec, deep in cases:
+      tr = tryit(rec)
+      if tr is None: print(f'  {case + " (recursive)":<40}  RecursionError')
+      else:          report(case + ' (recursive)', tr)
+      report(case + ' (stack)', timeit(deep), tr)
+    report('from_zoab_buf', timeit(lambda: from_zoab_buf(b)))
+
+################################################################################
+# lazy: full decode vs LazyZoa with a few accesses
+
+def benchLazy():
+  v = [[b'record', str(i).encode(), [b'a', b'b', b'c']] for i in range(50000)]
+  b = ZoaRaw.frPyDeep(v).serialize().getvalue()
+  full = timeit(lambda: from_zoab_buf(b)[0].arr[25000])
+  report('from_zoab_buf then index', full)
+  def lazy():
+    lz = LazyZoa(b)
+    for i in range(0, len(lz), 5000): lz[i]
+  report('LazyZoa + 10 accesses', timeit(lazy), full)
+
+################################################################################
+# records: stream from_zoab to record N vs open_records (mmap + index)
+
+def benchRecords():
+  n = 200000
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'recs.zoab')
+    with open(path, 'wb') as f:
+      for i in range(n):
+        f.write(encode_zoab(ZoaRaw.frPy([b'record', str(i).encode(), b'x' * 40])))
+    print(f'{n} records, {os.path.getsize(path) / 1e6:.1f}MB')
+    def stream():
+      with open(path, 'rb') as f:
+        for _ in range(n - 1): from_zoab(f)
+        return from_zoab(f)
+    base = timeit(stream)
+    report('from_zoab to the last record', base)
+    def scan():
+      with open_records(path) as recs: return recs[-1]
+    report('open_records + last record', timeit(scan), base)
+    with open_records(path, index=True): pass
+    def indexed():
+      with open_records(path, index=True) as recs:
+        for i in range(0, n, n // 10): recs[i]
+    report('open_records (.zidx) + 10 records', timeit(indexed), base)
+
+################################################################################
+# recordlog: per-record serialize + write vs RecordWriter
+
+def benchRecordLog():
+  p = Parser(b'struct Event [ name: Str; n: Int; data: Data ]')
+  p.parse()
+  Event = p.env.tys[b'Event']
+  n = 100000
+  events = [Event(Str(f'event {i}'), Int(i), Data(b'x' * 20)) for i in range(n)]
+  print(f'{n} records')
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'log.zoab')
+    def old():
+      with open(path, 'wb') as f:
+        for e in events: f.write(e.toZ().serialize().getvalue())
+    base = timeit(old)
+    report('toZ + serialize + write', base)
+    def writer():
+      os.remove(path)
+      with RecordWriter(path, fsync=Fsync.NEVER) as w:
+        for e in events: w.write(e)
+    report('RecordWriter', timeit(writer), base)
+    def reopen():
+      with open_records(path) as recs: return recs[n // 2]
+    report('open_records (footer) + 1 record', timeit(reopen), base)
+
+################################################################################
+# pdecode: from_zoab + frZ vs decode_records in a pool of processes
+
+def _eventN(e): return e.n
+
+def benchParallelDecode():
+  p = Parser(b'struct Event [ name: Str; n: Int; data: Data ]')
+  p.parse()
+  Event = p.env.tys[b'Event']
+  n = 200000
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'log.zoab')
+    with RecordWriter(path, fsync=Fsync.NEVER) as w:
+      for i in range(n): w.write(Event(Str(f'event {i}'), Int(i), Data(b'x' * 20)))
+    print(f'{n} records, {os.cpu_count()} cpus')
+    def old():
+      with open(path, 'rb') as f:
+        for _ in range(n): Event.frZ(from_zoab(f))
+    base = timeit(old, repeat=1)
+    report('from_zoab + frZ', base)
+    for workers in (1, 2, 4):
+      t = timeit(lambda: sum(1 for _ in decode_records(
+        path, Event, fn=_eventN, workers=workers)), repeat=1)
+      report(f'decode_records workers={workers}', t, base)
+
+################################################################################
+# pickle: pickling toZ() ZoaRaw vs the typed values themselves
+
+def benchPickle():
+  import pickle
+  p = Parser(b'struct Event [ name: Str; n: Int; data: Data ]')
+  p.parse()
+  Event = p.env.tys[b'Event']
+  events = [Event(Str(f'event {i}'), Int(i), Data(b'x' * 20)) for i in range(50000)]
+  def old(): return pickle.loads(pickle.dumps([e.toZ() for e in events]))
+  base = timeit(old)
+  report('pickle ZoaRaw (toZ)', base)
+  report('pickle typed values', timeit(
+    lambda: pickle.loads(pickle.dumps(events))), base)
+  print(f'  bytes: ZoaRaw {len(pickle.dumps([e.toZ() for e in events]))}'
+        f' typed {len(pickle.dumps(events))}')
+
+################################################################################
+# streams: ZOA_START framed values over asyncio socketpairs
+
+def benchStreams():
+  import asyncio, socket
+  z = ZoaRaw.frPy([b'sensor', b'\x01\x02', b'x' * 20])
+  async def conn(n):
+    a, b = socket.socketpair()
+    (_, wa), (rd, wb) = (await asyncio.open_connection(sock=a),
+                         await asyncio.open_connection(sock=b))
+    async def send():
+      w = ZoabStreamWriter(wa)
+      for _ in range(n): w.write(z)
+      await w.close()
+    async def recv():
+      return sum(1 for _ in [v async for v in ZoabStreamReader(rd)])
+    _, got = await asyncio.gather(send(), recv())
+    wb.close()
+    assert got == n
+  async def many(conns, n):
+    await asyncio.gather(*(conn(n) for _ in range(conns)))
+  def baseline():
+    bw = io.BytesIO()
+    for _ in range(100000): bw.write(encode_zoab(z))
+    br = io.BytesIO(bw.getvalue())
+    for _ in range(100000): from_zoab(br)
+  base = timeit(baseline)
+  report('from_zoab 100k values (BytesIO)', base)
+  report('1 connection x 100k values', timeit(lambda: asyncio.run(many(1, 100000))), base)
+  report('1000 connections x 100 values', timeit(lambda: asyncio.run(many(1000, 100))), base)
+
+################################################################################
+# project: full vs projected decode of wide structs
+
+def benchProject():
+  fields = ''.join(f'f{k}: {("Str", "Int", "Arr[Str]", "Data")[k % 4]}; '
+                   for k in range(40))
+  p = Parser(f'struct Wide [ {fields}]'.encode())
+  p.parse()
+  Wide = p.env.tys[b'Wide']
+  ArrStr = p.env.tys['Arr[Str]']
+  vals = [Str('a value'), Int(123456), ArrStr([Str('t'), Str('u')] * 3),
+          Data(b'x' * 30)]
+  bs = [Wide.encode(Wide(*(vals[k % 4] for k in range(40))))
+        for _ in range(20000)]
+  print(f'{len(bs)} structs of 40 fields, {len(bs[0])} bytes each')
+  def frZ():
+    for b in bs: Wide.frZ(from_zoab_buf(b)[0])
+  base = timeit(frZ)
+  report('from_zoab_buf + frZ', base)
+  def full():
+    for b in bs: Wide.decode(b)
+  report('decode', timeit(full), base)
+  sel = ['f0', 'f17', 'f38']
+  def projected():
+    for b in bs: Wide.decode(b, fields=sel)
+  report('decode fields=3', timeit(projected), base)
+
+################################################################################
+# select: from_zoab + frZ vs select of one nested value
+
+def benchSelect():
+  p = Parser(b'''
+  struct Item [ name: Str; n: Int; tags: Arr[Str] ]
+  struct Rec [ id: Int; title: Str; items: Arr[Item]; body: Data ]
+  ''')
+  p.parse()
+  Item, Rec = p.env.tys[b'Item'], p.env.tys[b'Rec']
+  ArrItem, ArrStr = Rec._fields[b'items'].ty, Item._fields[b'tags'].ty
+  r = Rec(Int(1), Str('title'), ArrItem(
+    Item(Str(f'item {k}'), Int(k), ArrStr([Str('a'), Str('b')])) for k in range(50)),
+    Data(b'x' * 1000))
+  b = Rec.encode(r)
+  print(f'{len(b)} byte record')
+  def old():
+    for _ in range(2000): Rec.frZ(from_zoab(io.BytesIO(b))).items[3].name
+  base = timeit(old)
+  report('from_zoab + frZ', base)
+  def full():
+    for _ in range(2000): Rec.decode(b).items[3].name
+  report('decode', timeit(full), base)
+  def sel():
+    for _ in range(2000): select(b, Rec, 'items[3].name')
+  report('select items[3].name', timeit(sel), base)
+
+################################################################################
+# intern: decode repetitive records with and without an Interner
+
+def benchIntern():
+  p = Parser(b'''
+  struct Log [ level: Str; host: Str; code: Int; tags: Arr[Str]; msg: Str ]
+  ''')
+  p.parse()
+  Log = p.env.tys[b'Log']
+  ArrStr = Log._fields[b'tags'].ty
+  levels, hosts = ['info', 'warn', 'error'], [f'host-{k}' for k in range(20)]
+  bs = [Log.encode(Log(Str(levels[k % 3]), Str(hosts[k % 20]), Int(200 + k % 5),
+                       ArrStr([Str('http'), Str(levels[k % 3])]), Str(f'msg {k % 100}')))
+        for k in range(100000)]
+  print(f'{len(bs)} log records')
+  def decode(): return [Log.decode(b) for b in bs]
+  def interned():
+    with Interner() as it: return [Log.decode(b) for b in bs], it
+  base = timeit(decode)
+  report('decode', base)
+  report('decode (Interner)', timeit(interned), base)
+  for name, fn in [('decode', decode), ('decode (Interner)', interned)]:
+    tracemalloc.start()
+    out = fn()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'  {name:<40} {used / 1e6:8.1f} MB')
+  print(f'  {out[1]}')
+
+################################################################################
+# dedup: encode_zoab vs encode_zoab_dedup on repetitive payloads
+
+def benchDedup():
+  tags = [[b'tag', b'%d' % i, b'x' * 30] for i in range(10)]
+  def payload(n, shared):
+    return ZoaRaw.frPy([
+      [b'%d' % i, tags[i % 10] if shared else [bytes(t) for t in tags[i % 10]],
+       [b'owner', b'someone@example.com', b'admin']]
+      for i in range(n)])
+  configs = [[[b'key%d' % j, b'value %d %d' % (i, j)] for j in range(20)]
+             for i in range(10)]
+  for name, v in [('shared subtrees', payload(50000, True)),
+                  ('equal subtrees', payload(50000, False)),
+                  ('large equal subtrees', ZoaRaw.frPy(
+                    [[b'%d' % i, configs[i % 10]] for i in range(20000)])),
+                  ('no repeats', ZoaRaw.frPy(
+                    [[b'%d' % i, b'name %d' % i, [b'%d' % (i * j) for j in range(5)]]
+                     for i in range(50000)]))]:
+    full, dedup = encode_zoab(v), encode_zoab_dedup(v)
+    print(f'{name}: {len(full) / 1e6:.2f}MB -> {len(dedup) / 1e6:.2f}MB')
+    base = timeit(lambda: encode_zoab(v))
+    report('encode_zoab', base)
+    report('encode_zoab_dedup', timeit(lambda: encode_zoab_dedup(v)), base)
+    base = timeit(lambda: from_zoab_buf(full))
+    report('from_zoab_buf', base)
+    report('from_zoab_dedup', timeit(lambda: from_zoab_dedup(dedup)), base)
+    report('from_zoab_dedup (share=False)',
+           timeit(lambda: from_zoab_dedup(dedup, share=False)), base)
+
+################################################################################
+# encode: BytesIO writer vs single-allocation encoder
+
+def benchEncode():
+  for name, v in [
+      ('small records', widePy(20000)),
+      ('1kB data',      [b'x' * 1000 for _ in range(2000)]),
+      ('64kB data',     [b'x' * 0x10000 for _ in range(128)]),
+      ('1MB data',      [b'x' * 1000000 for _ in range(8)])]:
+    print(name)
+    z = ZoaRaw.frPyDeep(v)
+    def old():
+      bw = io.BytesIO(); write_arr(bw, z.arr); return bw.getvalue()
+    base = timeit(old)
+    report('write_arr + BytesIO', base)
+    report('encode_zoab', timeit(lambda: encode_zoab(z)), base)
+    buf = bytearray(zoab_len(z))
+    report('encode_zoab_into (reused buf)',
+           timeit(lambda: encode_zoab_into(z, buf)), base)
+    tracemalloc.start()
+    encode_zoab_into(z, buf)
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    print(f'  encode_zoab_into peak memory: {peak / 1e3:,.1f}kB')
+
+################################################################################
+# typed: toZ + serialize vs direct encode/decode
+
+def benchTyped():
+  env = TyEnv()
+  Rec = env.struct(None, b'Rec', odict([
+    (b'id',   StructField(Int)),
+    (b'name', StructField(Data)),
+    (b'vals', StructField(ArrInt)),
+  ]))
+  Recs = env.arr(Rec)
+  v = Recs(Rec(id=Int(i), name=Data(b'rec%d' % i), vals=ArrInt.frPy(range(8)))
+           for i in range(5000))
+  b = v.toZ().serialize().getvalue()
+  base = timeit(lambda: v.toZ().serialize().getvalue())
+  report('toZ + serialize', base)
+  report('encode', timeit(lambda: Recs.encode(v)), base)
+  base = timeit(lambda: Recs.frZ(from_zoab(io.BytesIO(b))))
+  report('from_zoab + frZ', base)
+  report('decode', timeit(lambda: Recs.decode(b)), base)
+
+################################################################################
+# compiled: generic vs generated struct/enum codecs
+
+def benchCompiled():
+  p = Parser(b'''
+  declare Tag;
+  struct One [ a: U4 ]
+  struct Rec [ id: U4; name: Data; one: One; tag: Tag ]
+  enum Tag [ num: Int; txt: Str ]
+  ''')
+  # Tag is defined after Rec: exercises regenerating on _define
+  p.parse()
+  Rec, One, Tag = (p.env.tys[n] for n in (b'Rec', b'One', b'Tag'))
+  recs = [Rec(U4(i), Data(b'rec%d' % i), One(U4(i)), Tag(num=Int(i)))
+          for i in range(20000)]
+  zs = [r.toZ() for r in recs]
+  bs = [Rec.encode(r) for r in recs]
+  generic = {Rec: StructBase, One: StructBase, Tag: EnumBase}
+  compiled = {ty: dict((m, vars(ty)[m]) for m in ('toZ', 'frZ', '_enc', '_dec'))
+              for ty in generic}
+  cases = [
+    ('toZ',    lambda: [r.toZ() for r in recs]),
+    ('frZ',    lambda: [Rec.frZ(z) for z in zs]),
+    ('encode', lambda: [Rec.encode(r) for r in recs]),
+    ('decode', lambda: [Rec.decode(b) for b in bs]),
+  ]
+  for ty in generic:
+    for m in compiled[ty]: delattr(ty, m)
+  base = {name: timeit(fn) for name, fn in cases}
+  for ty, methods in compiled.items():
+    for m, fn in methods.items(): setattr(ty, m, fn)
+  for name, fn in cases:
+    report(name + ' (generic)', base[name])
+    report(name + ' (compiled)', timeit(fn), base[name])
+
+################################################################################
+# memory: bytes per struct/enum instance, __dict__ vs __slots__
+
+def bytesPer(make, n=20000) -> float:
+  tracemalloc.start()
+  start = tracemalloc.get_traced_memory()[0]
+  keep = [make(i) for i in range(n)]
+  used = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+  return used / len(keep)
+
+def benchMemory():
+  env = TyEnv()
+  Rec = env.struct(None, b'Rec', odict([
+    (b'id',   StructField(Int)),
+    (b'name', StructField(Data)),
+    (b'one',  StructField(Int)),
+  ]))
+  Tag = env.enum(None, b'Tag', [(b'num', EnumVar(Int)), (b'txt', EnumVar(Str))])
+  # the previous layout: the same dataclasses without slots
+  DRec = dataclasses.make_dataclass('DRec',
+    [(n.decode(), f.ty) for n, f in Rec._fields.items()], bases=(StructBase,))
+  DTag = dataclasses.make_dataclass('DTag',
+    [(n.decode(), v.ty, dataclasses.field(default=None))
+     for n, v in Tag._variants], bases=(EnumBase,))
+  i, d = Int(1), Data(b'x') # shared values: measure only the instances
+  for name, before, after in [
+      ('struct [id; name; one]', lambda _: DRec(i, d, i), lambda _: Rec(i, d, i)),
+      ('enum [num | txt]',       lambda _: DTag(num=i),   lambda _: Tag(num=i))]:
+    b, a = bytesPer(before), bytesPer(after)
+    print(f'  {name:<28} {b:6.1f} -> {a:6.1f} bytes/instance ({b / a:.2f}x)')
+
+################################################################################
+# sized: Arr[U2] as a list of boxed U2 vs array.array
+
+def benchSized():
+  env = TyEnv()
+  U2s = env.arr(U2)
+  Boxed = type('Boxed', (ArrBase,), {'_ty': U2, 'name': 'Boxed'})
+  vals = [(i * 7919) % 0x10000 for i in range(200000)]
+  boxed, packed = Boxed.frPy(vals), U2s.frPy(vals)
+  b = U2s.encode(packed)
+  for name, old, new in [
+      ('frPy',   lambda: Boxed.frPy(vals),    lambda: U2s.frPy(vals)),
+      ('encode', lambda: Boxed.encode(boxed), lambda: U2s.encode(packed)),
+      ('decode', lambda: Boxed.decode(b),     lambda: U2s.decode(b))]:
+    base = timeit(old)
+    report(name + ' (boxed)', base)
+    report(name + ' (array)', timeit(new), base)
+  mem = lambda a: sys.getsizeof(a) + (
+    sum(map(sys.getsizeof, a)) if isinstance(a, list) else 0)
+  print(f'  bytes/item: {mem(boxed) / len(vals):.1f} (boxed)'
+        f' -> {mem(packed) / len(vals):.1f} (array)')
+
+################################################################################
+# batched: per-item vs batched ArrInt / ArrData / ArrStr codecs
+
+def benchBatched(sizes=(1000, 100000, 10000000)):
+  kinds = [
+    (ArrInt,  lambda i: Int((i * 7919) % 100000)),
+    (ArrData, lambda i: Data(b'item%d' % i)),
+    (ArrStr,  lambda i: Str('item%d' % i)),
+  ]
+  for ty, item in kinds:
+    perItem = type(ty.name, (ArrBase,), {'_ty': ty._ty, 'name': ty.name})
+    for n in sizes:
+      print(f'{ty.name} n={n}')
+      repeat = 1 if n > 1000000 else 3
+      v = ty(map(item, range(n)))
+      base = timeit(lambda: perItem.encode(v), repeat)
+      report('encode (per item)', base)
+      report('encode (batched)', timeit(lambda: ty.encode(v), repeat), base)
+      b = ty.encode(v); del v
+      base = timeit(lambda: perItem.decode(b), repeat)
+      report('decode (per item)', base)
+      report('decode (batched)', timeit(lambda: ty.decode(b), repeat), base)
+      del b
+
+################################################################################
+# parse: a large synthetic .ty file
+
+def synthTy(n: int) -> bytes:
+  out = []
+  for i in range(n):
+    out.append(f'''
+\\ record {i}
+struct S{i} [
+  b: Arr[U2];
+  a: U4 = 0x{i:x};
+  c: Data = {{0102 0304}}
+  d: Int = {i};
+]
+enum E{i} [ x: Int; s: S{i}; ]
+bitmap B{i} [ on 0x01 0x01; off 0x00 0x01 ]
+const c{i}: U4 = {i * 7};
+''')
+  return ''.join(out).encode('utf-8')
+
+def benchParse():
+  for n in (1000, 5000):
+    buf = synthTy(n)
+    lines = buf.count(b'\n')
+    def parse(): p = Parser(buf); p.parse(); return p
+    t = timeit(parse)
+    report(f'parse {lines} lines', t)
+    print(f'  {lines / t:,.0f} lines/s')
+
+################################################################################
+# cache: process startup parsing a schema with no, a cold and a warm cache
+
+STARTUP = 'import sys, zoa; zoa.parse(sys.argv[1], cache=sys.argv[2] or None)'
+
+def benchCache():
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'synth.ty')
+    with open(path, 'wb') as f: f.write(synthTy(2000))
+    cache = os.path.join(tmp, 'cache')
+    here = os.path.dirname(os.path.abspath(__file__))
+    def start(c):
+      subprocess.run([sys.executable, '-c', STARTUP, path, c], check=True,
+                     env=dict(os.environ, PYTHONPATH=here))
+    def cold():
+      for e in os.listdir(cache) if os.path.exists(cache) else ():
+        os.remove(os.path.join(cache, e))
+      start(cache)
+    base = timeit(lambda: start(''))
+    report('startup: no cache', base)
+    report('startup: cold cache', timeit(cold), base)
+    report('startup: warm cache', timeit(lambda: start(cache)), base)
+    b = open(path, 'rb').read()
+    p = Parser(b); p.parse(); d = describeEnv(p.env)
+    base = timeit(lambda: Parser(b).parse())
+    report('Parser.parse', base)
+    report('loadEnv', timeit(lambda: loadEnv(d)), base)
+
+################################################################################
+# tree: parse a tree of modules in this process vs a pool of processes
+
+def benchTree(mods=16, n=250):
+  with tempfile.TemporaryDirectory() as tmp:
+    for m in range(mods):
+      uses = ''.join(f'struct U{i} [ s: m{m - 1}.S{i}; e: Arr[m{m - 1}.E{i}] ]\n'
+                     for i in range(n)) if m else ''
+      with open(os.path.join(tmp, f'm{m}.ty'), 'wb') as f:
+        f.write(synthTy(n) + uses.encode('utf-8'))
+    print(f'  {mods} modules of {n} records, {os.cpu_count()} cpus')
+    base = timeit(lambda: parseTree(tmp, workers=1))
+    report('parseTree workers=1', base)
+    for w in (2, 4):
+      report(f'parseTree workers={w}', timeit(lambda: parseTree(tmp, workers=w)), base)
+
+################################################################################
+# declare: resolving forward declarations of mutually referencing structs
+
+def declaredTy(n: int) -> bytes:
+  out = [f'declare S{i};\n' for i in range(n)]
+  for i in range(n):
+    out.append(f'struct S{i} [ next: S{(i + 1) % n}; prev: Arr[S{i - 1 if i else n - 1}] ]\n')
+  return ''.join(out).encode('utf-8')
+
+def benchDeclare():
+  for n in (1000, 4000):
+    buf = declaredTy(n)
+    t = timeit(lambda: Parser(buf).parse(), repeat=1)
+    report(f'parse {n} declared structs', t)
+    print(f'  {t / n * 1e6:,.1f} us/struct')
+
+################################################################################
+# zoat: reading large zoat documents
+
+def zoatDoc(n: int) -> bytes:
+  return b''.join(
+    b'{ record %d| %d| some text with \\| escapes\\tand\n'
+    b'  a second line| {a| b| c} |-%d }\n' % (i, i * 7, i) for i in range(n))
+
+def benchZoat():
+  for n in (10000, 100000):
+    doc = zoatDoc(n)
+    mb = len(doc) / 1e6
+    def read():
+      for _z in ZoatReader(io.BytesIO(doc)): pass
+    t = timeit(read)
+    report(f'ZoatReader {mb:.1f}MB', t)
+    print(f'  {mb / t:.1f} MB/s, {n / t:,.0f} records/s')
+  zb = b''.join(encode_zoab(z) for z in ZoatReader(doc))
+  def zoab():
+    i = 0
+    while i < len(zb): _z, i = from_zoab_buf(zb, i)
+  report(f'from_zoab_buf (same values, {len(zb) / 1e6:.1f}MB)', timeit(zoab), t)
+  with tempfile.TemporaryFile() as f:
+    f.write(zoatDoc(300000)); size = f.tell()
+    f.seek(0); tracemalloc.start()
+    for _ in ZoatReader(f): pass
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    print(f'  streaming {size / 1e6:.0f}MB: {peak / 1e3:,.0f}kB peak')
+
+def benchZoatWrite():
+  zs = list(ZoatReader(zoatDoc(100000)))
+  for name, indent in (('compact', None), ('indented', 2)):
+    f = io.BytesIO()
+    def write():
+      f.seek(0); w = ZoatWriter(f, indent)
+      for z in zs: w.write(z)
+      w.flush()
+    t = timeit(write)
+    report(f'ZoatWriter {name} {f.tell() / 1e6:.1f}MB', t)
+    print(f'  {f.tell() / 1e6 / t:.1f} MB/s, {len(zs) / t:,.0f} records/s')
+  with tempfile.TemporaryFile() as fin, open(os.devnull, 'wb') as fout:
+    for z in zs: fin.write(encode_zoab(z))
+    big = [b'x' * 1000000, 'ü'.encode() * 500000, b'\x00\xff' * 500000]
+    for _ in range(20): fin.write(encode_zoab(ZoaRaw.frPy(big)))
+    fin.write(encode_zoab(ZoaRaw.frPy([b'item'] * 1000000)))
+    size = fin.tell()
+    t = timeit(lambda: fin.seek(0) or zoab_to_zoat(fin, fout), repeat=1)
+    report(f'zoab_to_zoat {size / 1e6:.0f}MB', t)
+    fin.seek(0); tracemalloc.start()
+    zoab_to_zoat(fin, fout)
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    print(f'  {size / 1e6 / t:.1f} MB/s, {peak / 1e3:,.0f}kB peak')
+
+BENCHES = {
+  'deep': benchDeep,
+  'lazy': benchLazy,
+  'records': benchRecords,
+  'recordlog': benchRecordLog,
+  'pdecode': benchParallelDecode,
+  'pickle': benchPickle,
+  'streams': benchStreams,
+  'project': benchProject,
+  'select': benchSelect,
+  'intern': benchIntern,
+  'dedup': benchDedup,
+  'encode': benchEncode,
+  'typed': benchTyped,
+  'compiled': benchCompiled,
+  'memory': benchMemory,
+  'sized': benchSized,
+  'batched': benchBatched,
+  'parse': benchParse,
+  'cache': benchCache,
+  'tree': benchTree,
+  'declare': benchDeclare,
+  'zoat': benchZoat,
+  'zoatwrite': benchZoatWrite,
+}
+
+if __name__ == '__main__':
+  names = sys.argv[1:] or list(BENCHES)
+  for name in names:
+    print(f'# {name}')
+    BENCHES[name]()
@@ -1,4 +1,11 @@
+import array
 import io
+import marshal
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import unittest
 from zoa import *
 from zoa_export import *
@@ -75,6 +82,476 @@ class TestZoaRaw(unittest.TestCase):
     a = [ b'one', b'two', b'three', b'four', b'five' ] * 30 # 150
     assert_roundtrip(a)
 
+  def test_from_zoab_buf(self):
+    v = [b'hi', [b'bob', []], b'0123456789' * 13] + [b'x'] * 70
+    b = ZoaRaw.frPy(v).serialize().getvalue()
+    expected = from_zoab(io.BytesIO(b))
+    z, end = from_zoab_buf(b)
+    assert end == len(b)
+    assert z == expected
+    assert isinstance(z.arr[0].data, memoryview)
+    assert isinstance(z.arr[2].data, bytearray) # joined
+    z, _ = from_zoab_buf(bytearray(b), copy=True)
+    assert z == expected
+    assert isinstance(z.arr[0].data, bytearray)
+    assert z.to_py() == v
+
+  def test_extend_memoryview(self):
+    z, _ = from_zoab_buf(ZoaRaw.frPy([b'hi', [b'bob']]).serialize().getvalue())
+    out = ZoaRaw.new_arr()
+    for v in z.arr: out.extend(v)
+    joined = ZoaRaw.new_data(); joined.extend(z.arr[0].data)
+    z.arr[0].extend(z.arr[1].arr[0].data)
+    assert out.to_py() == [b'hibob', [b'bob']] and joined.data == b'hi'
+    assert ZoaRaw.frPy([memoryview(b'a'), [memoryview(b'b')]]).to_py() == [b'a', [b'b']]
+
+  def test_from_zoab_buf_offset(self):
+    b = b'junk' + ZoaRaw.frPy([b'a']).serialize().getvalue() + b'\x02hi'
+    z, end = from_zoab_buf(memoryview(b), 4)
+    assert z.to_py() == [b'a']
+    z, end = from_zoab_buf(b, end)
+    assert z.to_py() == b'hi'
+    assert end == len(b)
+    assert Str.frZ(z) == 'hi' and Data.frZ(z) == b'hi'
+    try: from_zoab_buf(b[:-1], 7); assert False
+    except Eof: pass
+
+  def test_deep_matches_recursive(self):
+    for n in (0, 1, 62, 63, 64, 126, 127):
+      v = [[b'a' * n, [b'b'] * n], [b'c'] * n, b'd' * n]
+      z = ZoaRaw.frPyDeep(v)
+      assert z == ZoaRaw.frPy(v)
+      assert z.to_py_deep() == v
+      bw, bwDeep = io.BytesIO(), io.BytesIO()
+      write_arr(bw, z.arr); write_arr_deep(bwDeep, z.arr)
+      b = bw.getvalue()
+      assert b == bwDeep.getvalue()
+      assert from_zoab_deep(io.BytesIO(b)) == z
+      assert from_zoab_buf(b) == (z, len(b))
+
+  def test_deep_nesting(self):
+    depth = 10000
+    v = b'bottom'
+    for _ in range(depth): v = [v]
+    z = ZoaRaw.frPyDeep(v)
+    bw = io.BytesIO(); write_arr_deep(bw, z.arr)
+    b = bw.getvalue()
+    assert b == b'\x41' * depth + b'\x06bottom'
+    for z in (from_zoab_deep(io.BytesIO(b)), from_zoab_buf(b)[0]):
+      result = z.to_py_deep()
+      for _ in range(depth): result, = result
+      assert result == b'bottom'
+
+class TestEncodeZoab(unittest.TestCase):
+  def test_matches_write(self):
+    for v in (b'', b'hi', b'a' * 63, b'b' * 127, bytes(range(256)) * 40,
+              [], [[]], [b''] * 63,
+              [b'x'] * 64, [b'y' * 70, [[b'z'] * 130], b'']):
+      z = ZoaRaw.frPy(v)
+      bw = io.BytesIO()
+      if isbytes(v): write_data(bw, v)
+      else:          write_arr(bw, z.arr)
+      expected = bw.getvalue()
+      assert zoab_len(z) == len(expected)
+      assert encode_zoab(z) == expected
+      assert z.serialize().getvalue() == expected
+
+  def test_into(self):
+    z = ZoaRaw.frPy([b'hi', [b'bob'] * 70])
+    b = encode_zoab(z)
+    buf = bytearray(b'..') + bytearray(len(b)) + bytearray(b'..')
+    assert encode_zoab_into(z, buf, 2) == 2 + len(b)
+    assert buf == b'..' + b + b'..'
+    buf = bytearray(len(b) + 1)
+    assert encode_zoab_into(z, memoryview(buf), 1) == len(buf)
+    assert buf[1:] == b
+    try: encode_zoab_into(z, bytearray(len(b)), 1); assert False
+    except ValueError: pass
+
+class TestLazyZoa(unittest.TestCase):
+  def test_skip(self):
+    for v in ([], b'', b'a' * 200, [[b'x'] * 100, [[]], b'y' * 70]):
+      b = ZoaRaw.frPy(v).serialize().getvalue()
+      assert zoab_skip(b'..' + b, 2) == len(b) + 2
+      try: zoab_skip(b[:-1]); assert False
+      except Eof: pass
+
+  def test_lazy(self):
+    v = [[b'rec', str(i).encode()] for i in range(200)] + [b'z' * 100]
+    b = ZoaRaw.frPy(v).serialize().getvalue()
+    lz = LazyZoa(b)
+    assert len(lz) == 201
+    assert lz.end == len(b)
+    assert lz[3].to_py() == [b'rec', b'3']
+    assert lz[-1].to_py() == b'z' * 100
+    assert [z.to_py() for z in lz[10:12]] == v[10:12]
+    assert [z.to_py() for z in lz] == v
+    assert list(lz.lazy(7)[1].data) == list(b'7')
+    assert lz.to_raw().to_py() == v
+    try: LazyZoa(b'\x02hi'); assert False
+    except TypeError: pass
+
+class TestZoabDecoder(unittest.TestCase):
+  VALUES = [
+    b'', b'hi', [], [[]], b'0123456789' * 13, [b'x'] * 130,
+    [b'a', [b'b' * 64, [], [[b'c']]], b''], [[b'y'] * 63, [b'z'] * 64],
+  ]
+
+  def encoded(self):
+    bw = io.BytesIO()
+    for v in self.VALUES:
+      if isbytes(v): write_data(bw, v)
+      else:          write_arr_deep(bw, ZoaRaw.frPy(v).arr)
+    return bw.getvalue()
+
+  def test_chunks(self):
+    b = self.encoded()
+    for size in (1, 2, 3, 7, 64, len(b)):
+      dec, got = ZoabDecoder(), []
+      for i in range(0, len(b), size):
+        got.extend(v.to_py() for v in dec.feed(b[i:i+size]))
+      assert got == self.VALUES, size
+      assert not dec.pending
+
+  def test_completes_on_last_byte(self):
+    b = ZoaRaw.frPy([b'a' * 70, [b'b']]).serialize().getvalue()
+    dec = ZoabDecoder()
+    assert dec.feed(b[:-1]) == []
+    assert dec.pending
+    assert [v.to_py() for v in dec.feed(b[-1:])] == [[b'a' * 70, [b'b']]]
+    assert not dec.pending
+
+  def test_join_different_types(self):
+    try: ZoabDecoder().feed(b'\x81a\x40'); assert False
+    except ValueError: pass
+
+class TestDedup(unittest.TestCase):
+  LEAF = [b'hello world', [b'x' * 20, b'y']]
+  VALUE = [LEAF] * 5 + [b'x' * 20, [], [[b'%d' % (i % 3), b'abcdefgh'] for i in range(100)]]
+
+  def test_roundtrip(self):
+    v = ZoaRaw.frPy(self.VALUE)
+    b = encode_zoab_dedup(v)
+    assert b.startswith(DEDUP_MAGIC) and len(b) < len(encode_zoab(v)) // 2
+    assert zoab_skip(b, len(DEDUP_MAGIC)) == len(b)
+    z, end = from_zoab_dedup(b)
+    assert end == len(b) and z == v
+    assert z.arr[0] is z.arr[4] and z.arr[5] is z.arr[0].arr[1].arr[0]
+    z, _ = from_zoab_dedup(b, share=False, copy=True)
+    assert z == v and z.arr[0] is not z.arr[4]
+    assert isinstance(z.arr[5].data, bytearray)
+    mvz = from_zoab_buf(encode_zoab(v))[0] # memoryview data
+    assert encode_zoab_dedup(mvz) == b
+    for v in (b'', b'x' * 100, [], [[]] * 3, [b'a' * 70] * 70):
+      z = ZoaRaw.frPy(v)
+      assert from_zoab_dedup(b'..' + encode_zoab_dedup(z), 2)[0] == z
+
+  def test_no_repeats(self):
+    M = len(DEDUP_MAGIC)
+    v = ZoaRaw.frPy([b'a' * 70, [b'b', [b'c' * 10]], b'c'])
+    assert encode_zoab_dedup(v)[M:] == encode_zoab(v)
+    v = ZoaRaw.frPy([b'abcdefgh'] * 3) # only pointers that are smaller
+    assert encode_zoab_dedup(v, minLen=100)[M:] == encode_zoab(v)
+    assert len(encode_zoab_dedup(v)) < M + len(encode_zoab(v))
+
+  def test_not_zoab(self):
+    b = encode_zoab_dedup(ZoaRaw.frPy([b'abcdefgh'] * 3))
+    with self.assertRaises(ValueError): from_zoab(io.BytesIO(b))
+    with self.assertRaises(ValueError): from_zoab_dedup(encode_zoab(ZoaRaw.frPy([])))
+    try: from_zoab_dedup(DEDUP_MAGIC + b'\x41\xc0\x01\x05'); assert False
+    except ValueError: pass
+
+  def test_bad_pointers(self):
+    selfPtr = DEDUP_MAGIC + b'\x41\xc0\x01\x01' # arr pointing at itself
+    innerData = DEDUP_MAGIC + b'\x42\x03abc\xc0\x01\x03' # into b'abc'
+    for b in (selfPtr, innerData):
+      for share in (True, False):
+        with self.assertRaises(ValueError): from_zoab_dedup(b, share=share)
+    ok = DEDUP_MAGIC + b'\x42\x03abc\xc0\x01\x04'
+    assert from_zoab_dedup(ok, share=False)[0].to_py() == [b'abc', b'abc']
+
+class TestRecords(unittest.TestCase):
+  VALUES = [[b'rec', str(i).encode()] for i in range(100)] + [b'z' * 100, []]
+
+  def write(self, tmp, values, tail=b''):
+    path = os.path.join(tmp, 'recs.zoab')
+    with open(path, 'wb') as f:
+      for v in values: f.write(ZoaRaw.frPy(v).serialize().getvalue())
+      f.write(tail)
+    return path
+
+  def test_index(self):
+    b = b''.join(ZoaRaw.frPy(v).serialize().getvalue() for v in self.VALUES)
+    offs, end = zoab_index(b)
+    assert len(offs) == len(self.VALUES) and end == len(b)
+    assert [zoab_skip(b, o) for o in offs] == list(offs[1:]) + [end]
+    assert zoab_index(b + b'\x45\x01') == (offs, end) # truncated tail
+
+  def test_records(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = self.write(tmp, self.VALUES, tail=b'\x05ab')
+      with open_records(path) as recs:
+        assert len(recs) == len(self.VALUES)
+        assert recs[7].to_py() == [b'rec', b'7']
+        assert recs[-2].to_py() == b'z' * 100
+        assert [z.to_py() for z in recs] == self.VALUES
+        view = recs[10:20:3]
+        assert [z.to_py() for z in view] == self.VALUES[10:20:3]
+        assert bytes(recs.raw(7)) == ZoaRaw.frPy(self.VALUES[7]).serialize().getvalue()
+        assert recs.end == recs.offset(-1) + len(recs.raw(-1))
+      with open_records(self.write(tmp, [])) as recs: assert list(recs) == []
+
+  def test_persisted_index(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = self.write(tmp, self.VALUES)
+      with open_records(path, index=True) as recs: offs = recs._offs
+      assert os.path.exists(path + '.zidx')
+      with open_records(path, index=True) as recs:
+        assert recs._offs == offs and recs[3].to_py() == self.VALUES[3]
+      self.write(tmp, self.VALUES[:5]) # stale index is rebuilt
+      with open_records(path, index=True) as recs:
+        assert [z.to_py() for z in recs] == self.VALUES[:5]
+
+  def test_typed(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'strs.zoab')
+      with open(path, 'wb') as f:
+        for i in range(50): f.write(Str.encode(f'value {i}'))
+      with open_records(path, ty=Str) as recs:
+        assert recs[42] == 'value 42' and isinstance(recs[42], Str)
+
+class TestRecordWriter(unittest.TestCase):
+  def test_write(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'log.zoab')
+      with RecordWriter(path, batch=64) as w:
+        for i in range(100): w.write(Str(f'record {i}'))
+        w.write(ZoaRaw.frPy([b'raw']))
+        w.write(Int(-7))
+      assert len(w) == 102
+      with open_records(path) as recs:
+        assert bytes(recs.buf[-8:]) == RECORDS_FOOTER_MAGIC
+        assert len(recs) == 102
+        assert Str.decode(recs.raw(42)) == 'record 42'
+        assert recs[100].to_py() == [b'raw']
+        assert Int.decode(recs.raw(-1)) == -7
+      with RecordWriter(path) as w: w.write(Str('more')) # footer is replaced
+      with open_records(path) as recs:
+        assert len(recs) == 103 and Str.decode(recs.raw(-1)) == 'more'
+      with RecordWriter(os.path.join(tmp, 'empty.zoab')): pass
+      with open_records(os.path.join(tmp, 'empty.zoab')) as recs:
+        assert len(recs) == 0 and recs.end == 0
+
+  def test_crash(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'log.zoab')
+      w = RecordWriter(path, fsync=Fsync.FLUSH)
+      for i in range(10): w.write(Str(f'record {i}'))
+      w.flush(); w._f.close() # crash before close()
+      with open(path, 'ab') as f: f.write(Str.encode('partial')[:-3])
+      with open_records(path) as recs: # no footer: every whole record
+        assert [Str.decode(recs.raw(i)) for i in range(len(recs))] == [
+          f'record {i}' for i in range(10)]
+      with RecordWriter(path) as w2: w2.write(Str('after'))
+      with open_records(path) as recs:
+        assert bytes(recs.buf[-8:]) == RECORDS_FOOTER_MAGIC
+        assert len(recs) == 11 and Str.decode(recs.raw(-1)) == 'after'
+
+  def test_partial_footer(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'log.zoab')
+      with RecordWriter(path) as w:
+        for i in range(2): w.write(Str(f'record {i}'))
+      with open(path, 'rb') as f: b = f.read()
+      for cut in (len(b) - 1, w._end + 40, w._end + 1):
+        with open(path, 'wb') as f: f.write(b[:cut]) # crash in close()
+        with open_records(path) as recs:
+          assert recs.end == w._end
+          assert [Str.decode(r) for r in map(recs.raw, range(len(recs)))] == [
+            'record 0', 'record 1']
+      with RecordWriter(path) as w: w.write(Str('after'))
+      with open_records(path) as recs: assert len(recs) == 3
+
+  def test_failed_write(self):
+    p = Parser(b'struct S [ a: U1; b: U1 ]'); p.parse()
+    S = p.env.tys[b'S']
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'log.zoab')
+      with RecordWriter(path) as w:
+        w.write(S(U1(1), U1(2)))
+        with self.assertRaises(ValueError): w.write(S(U1(3), U1(999)))
+        w.write(S(U1(4), U1(5)))
+        assert len(w) == 2
+      with open_records(path, ty=S) as recs:
+        assert list(recs) == [S(U1(1), U1(2)), S(U1(4), U1(5))]
+
+class TestStreams(unittest.TestCase):
+  def pipe(self):
+    import asyncio, socket
+    a, b = socket.socketpair()
+    return asyncio.open_connection(sock=a), asyncio.open_connection(sock=b)
+
+  def test_framed(self):
+    import asyncio
+    async def main():
+      ra, rb = self.pipe(); (_, wa), (rd, wb) = await ra, await rb
+      w, r = ZoabStreamWriter(wa), ZoabStreamReader(rd, chunk=7)
+      values = [[b'hello', [b'x' * 100]], b'', [], b'\x80\x03' * 5]
+      wa.write(b'garbage\x80')
+      for v in values: await w.send(ZoaRaw.frPy(v))
+      await w.close()
+      got = [z.to_py() async for z in r]
+      wb.close()
+      return got, r.skipped, r.corrupt
+    got, skipped, corrupt = asyncio.run(main())
+    assert got == [[b'hello', [b'x' * 100]], b'', [], b'\x80\x03' * 5]
+    assert (skipped, corrupt) == (8, 0)
+
+  def test_resync(self):
+    import asyncio
+    async def main():
+      ra, rb = self.pipe(); (_, wa), (rd, wb) = await ra, await rb
+      w, r = ZoabStreamWriter(wa), ZoabStreamReader(rd, ty=Str, maxSize=50)
+      wa.write(ZOA_START + b'\xC1\x02hi') # joins an arr to data
+      w.write(Str('one'))
+      wa.write(ZOA_START + b'\x3F' + b'x' * 30) # truncated by the next value
+      w.write(Str('two'))
+      w.write(Data(b'\x80\x03' + b'x' * 60)) # too large
+      w.write(Str('three'))
+      await w.close()
+      got = [s async for s in r]
+      wb.close()
+      return got, r.corrupt
+    got, corrupt = asyncio.run(main())
+    assert got == ['one', 'two', 'three'] and corrupt >= 3
+
+  def test_restart(self):
+    import asyncio
+    p = Parser(b'struct S [ a: Int ]'); p.parse()
+    S = p.env.tys[b'S']
+    async def main():
+      ra, rb = self.pipe(); (_, wa), (rd, wb) = await ra, await rb
+      w, r = ZoabStreamWriter(wa), ZoabStreamReader(rd, ty=S)
+      w.write(S(Int(1)))
+      wa.write(ZOA_START + b'\x43\x01\x05') # the device restarts mid-value
+      w.write(S(Int(2)))
+      wa.write(ZOA_START + b'\x42\x00\x42\x01\x09\x01\x01') # unknown zid 9
+      w.write(S(Int(3)))
+      await w.close()
+      got = [s.a async for s in r]
+      wb.close()
+      return got, r.corrupt
+    got, corrupt = asyncio.run(main())
+    assert got == [1, 2, 3] and corrupt == 2
+
+  def test_connections(self):
+    import asyncio
+    async def device(i):
+      ra, rb = self.pipe(); (_, wa), (rd, wb) = await ra, await rb
+      async def send():
+        w = ZoabStreamWriter(wa)
+        for n in range(20): await w.send(Int(i * 100 + n))
+        await w.close()
+      async def recv(): return [v async for v in ZoabStreamReader(rd, ty=Int)]
+      _, got = await asyncio.gather(send(), recv())
+      wb.close()
+      return got
+    async def main(): return await asyncio.gather(*(device(i) for i in range(200)))
+    for i, got in enumerate(asyncio.run(main())):
+      assert got == [i * 100 + n for n in range(20)]
+
+class TestZoatReader(unittest.TestCase):
+  def read(self, b):
+    got = [z.to_py() for z in ZoatReader(b)]
+    for size in (1, 2, 3, 7):
+      assert got == [z.to_py() for z in ZoatReader(io.BytesIO(b), chunk=size)], size
+    return got
+
+  def test_values(self):
+    assert [b'a string', [b'x', [b'y', b'z'], []]] == self.read(
+      b'a string| {x| {y| z} {||} |}|')
+    assert [b'one two', b'a\nb\t|{}\\ A', b'\nnew'] == self.read(
+      b'  one\n     two|\n a\\nb\\t\\|\\{\\}\\\\\\sA| |\\nnew')
+    assert [b'no space'] == self.read(b'no \\\n   space|')
+    assert [b'xy', [b'1', b'2', b'3']] == self.read(b'x|+y| {1| 2} |+ {3}')
+    assert [[b'*', [b'\x05'], b'\x10', b'A', b'']] == self.read(
+      b'{|42 |-5 |0x10 |0cA |0}')
+
+  def test_comments_raw(self):
+    assert [b'a ', b'b', b'c'] == self.read(
+      b'a |* line\n b| {* block {* nested *} *} c')
+    assert [b'raw { | } \\n\n  indented', b'next'] == self.read(b"""
+      |'''
+      raw { | } \\n
+        indented
+      ''' next""")
+
+  def test_streams(self):
+    f = io.BytesIO(b'{record| 1}' * 10000)
+    it = iter(ZoatReader(f, chunk=64))
+    assert [b'record', b'1'] == next(it).to_py()
+    assert f.tell() < 256 # did not read everything first
+
+  def test_errors(self):
+    for b in [b'}', b'{a', b'|.var|', b'|h1 x', b'a\\q', b"|'''x",
+              b'{* x', b'|+a', b'a|+{b}']:
+      with self.assertRaises(ParseError): self.read(b)
+    with self.assertRaisesRegex(ParseError, 'line 3'):
+      list(ZoatReader(io.BytesIO(b'a|\nb|\n\\q'), chunk=2))
+
+class TestZoatWriter(unittest.TestCase):
+  VALUES = [
+    b'', b' lead', b'*star', b'tail ', b'a|b{c}d\\e', b'\x00\x01\xff bin',
+    'ünï ✓'.encode(), b"multi\nline\n  indented\n'''quoted''''\n", b'\nstart',
+    b'tab\there', [], [[]], [b'', [b'x', b'']], b'x' * 70000,
+  ]
+
+  def test_layout(self):
+    v = [b'a', b'b c', [b'd', [], b''], b'line1\nline2']
+    assert b'{a| b c| {d| {} |0|} line1\\nline2|}' == to_zoat(v)
+    assert b'''{
+  a|
+  b c|
+  {
+    d|
+    {}
+    |0|
+  }
+  |\'\'\'
+  line1
+  line2
+  \'\'\'
+}''' == to_zoat(v, indent=2)
+    assert b'|-5|' == to_zoat(Int(-5))
+
+  def test_roundtrip(self):
+    for indent in (None, 2):
+      for v in self.VALUES + [self.VALUES]:
+        assert [v] == [z.to_py() for z in ZoatReader(to_zoat(v, indent))]
+
+  def test_zoab_to_zoat(self):
+    b = b''.join(encode_zoab(ZoaRaw.frPyDeep(v)) for v in self.VALUES)
+    for indent in (None, 2):
+      for chunk in (1, 7, 1 << 16):
+        out = io.BytesIO()
+        zoab_to_zoat(io.BytesIO(b), out, indent, chunk=chunk)
+        assert self.VALUES == [z.to_py() for z in ZoatReader(out.getvalue())]
+    with self.assertRaises(Eof): zoab_to_zoat(io.BytesIO(b[:-1]), io.BytesIO())
+
+  def test_zoab_to_zoat_chunks(self):
+    mixed = [b'\xff\xcd\x90 \xcd\x90\xe2\x9c\x93\xf0\x9f\x98\x80\xcd' * 3,
+             b'\xf0\x9f\x98\x80', b'a\xe2\x9c', b'\x90\xcd']
+    for v in self.VALUES + [mixed]:
+      b = encode_zoab(ZoaRaw.frPyDeep(v))
+      for indent in (None, 2):
+        outs = set()
+        for chunk in (1, 2, 3, 5, 7, 1 << 16):
+          out = io.BytesIO()
+          zoab_to_zoat(io.BytesIO(b), out, indent, chunk=chunk)
+          outs.add(out.getvalue())
+        assert len(outs) == 1
+        if indent is None: assert outs == {to_zoat(v)}
+
 class TestBase(unittest.TestCase):
   def setUp(self):
     self.env = TyEnv()
@@ -108,6 +585,27 @@ class TestZoaTy(TestBase):
     assert ai == ArrInt.frZ(z)
     assert repr(ai) == '[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]'
 
+  def test_arr_sized(self):
+    for ty in (U1, U2, U4, I1, I2, I4):
+      A = self.env.arr(ty)
+      vals = list(range(ty.minSize, ty.minSize + 100)) + [ty.maxSize, 0]
+      a = A.frPy(vals)
+      assert isinstance(a, array.array)
+      assert a.itemsize == (ty.maxSize - ty.minSize).bit_length() // 8
+      z = ZoaRaw.new_arr([ty(v).toZ() for v in vals])
+      assert z == a.toZ()
+      assert a == A.frZ(z)
+      assert z.serialize().getvalue() == A.encode(a)
+      assert a == A.decode(A.encode(a))
+      assert vals == a.toPy()
+      assert type(a[0]) is int and not isinstance(a[0], Int)
+      assert type(A._ty(a[-2])) is ty and A._ty(a[-2]).toZ() == z.arr[-2]
+      try: A.frPy([ty.maxSize + 1]); assert False
+      except ValueError: pass
+      try: A.decode(ArrInt.encode(ArrInt.frPy([ty.maxSize + 1]))); assert False
+      except ValueError: pass
+    assert [1, 2] == self.env.arr(U2).parse(Parser(b'{1, 2}')).tolist()
+
   def test_map(self):
     MapStrInt = self.env.map(Str, Int)
     m = MapStrInt.frPy({"foo": 3, "bar": 7})
@@ -137,6 +635,32 @@ class TestZoaTy(TestBase):
     assert s.a == 0x77
     assert z == s.toZ()
 
+  def test_struct_slots(self):
+    ty = self.env.struct(None, b'Named', odict([
+        (b'name', StructField(Data)),
+        (b'n', StructField(Int, default=Int(3))),
+    ]))
+    s = ty(Data(b'hi'))
+    assert not hasattr(s, '__dict__')
+    assert ty.name == b'Named' and s.name == b'hi' and s.n == 3
+    s.name = Data(b'yo'); assert s.name == b'yo'
+    assert ty.frZ(s.toZ()) == s
+    assert s.toPy() == {'name': b'yo', 'n': 3}
+
+  def test_dataclass(self):
+    import dataclasses
+    S = self.env.struct(None, b'S', odict([
+        (b'a', StructField(Data)), (b'n', StructField(Int, default=Int(3)))]))
+    E = self.env.enum(None, b'E', [(b'a', EnumVar(Int)), (b'b', EnumVar(Data))])
+    assert dataclasses.is_dataclass(S) and dataclasses.is_dataclass(E)
+    assert [(f.name, f.type) for f in dataclasses.fields(S)] == [('a', Data), ('n', Int)]
+    assert dataclasses.fields(S)[1].default_factory() == 3
+    assert [f.default for f in dataclasses.fields(E)] == [None, None]
+    assert dataclasses.asdict(S(Data(b'hi'))) == {'a': b'hi', 'n': 3}
+    assert dataclasses.astuple(E(b=Data(b'x'))) == (None, b'x')
+    assert dataclasses.replace(S(Data(b'hi')), n=Int(4)) == S(Data(b'hi'), Int(4))
+    assert S.__match_args__ == ('a', 'n') and repr(E(a=Int(1))) == 'E(a=1, b=None)'
+
   def test_enum(self):
     ty = self.env.enum(None, b'en', [
       (b'a',     EnumVar(Int)),
@@ -150,6 +674,10 @@ class TestZoaTy(TestBase):
     assert en.toZ() == ZoaRaw.new_arr([
       Int(1).toZ(), Data(b'hi there enum').toZ()])
     assert ty.frZ(en.toZ()) == en
+    for k in (-1, len(ty._variants)):
+      bad = ZoaRaw.new_arr([Int(k).toZ(), Int(3).toZ()])
+      with self.assertRaises(ValueError): ty.frZ(bad)
+      with self.assertRaises(ValueError): EnumBase.frZ.__func__(ty, bad)
 
   def test_bitmap(self):
     Bm = self.env.bitmap(None, b'Bm', [
@@ -207,6 +735,236 @@ class TestZoaTy(TestBase):
     assert expected.toZ() == z
     assert expected == result
 
+class TestDirectCodec(TestBase):
+  def check(self, ty, v):
+    b = ty.encode(v)
+    assert b == v.toZ().serialize().getvalue(), (ty, v)
+    assert v == ty.decode(b)
+    return b
+
+  def test_scalars(self):
+    for i in [0, 1, 0x42, 0x1234, -0x42, -1]: self.check(Int, Int(i))
+    self.check(U1, U1(0xFF))
+    try: U1.encode(0x100); assert False
+    except ValueError: pass
+    self.check(Data, Data(b'abc'))
+    self.check(Data, Data(b'x' * 200))
+    self.check(Str, Str('hello'))
+    assert 'hi'.encode('utf-8') == Str('hi').encode('utf-8')
+    assert 'hi' == Data(b'hi').decode('utf-8')
+
+  def test_containers(self):
+    self.check(ArrInt, ArrInt.frPy(range(100)))
+    MapStrInt = self.env.map(Str, Int)
+    self.check(MapStrInt, MapStrInt.frPy({str(i): i for i in range(70)}))
+
+  def test_batched_arrs(self):
+    for n in (0, 1, 63, 64, 200):
+      self.check(ArrInt, ArrInt.frPy((i * 7919) % 0x2000000 - 0x1000 for i in range(n)))
+      self.check(ArrData, ArrData.frPy(b'\0x' * (i % 40) for i in range(n)))
+      self.check(ArrStr, ArrStr.frPy('h\xe9llo %d' % i for i in range(n)))
+    self.check(ArrStr, ArrStr.frPy(['a\0b', '', 'c' * 100]))
+    b = ArrData.encode(ArrData.frPy([b'x' * 70, b'yz']))
+    assert [b'x' * 70, b'yz'] == ArrData.decode(bytearray(b'..' + b), 2)
+    assert all(type(v) is Str for v in ArrStr.decode(ArrStr.encode(['a', 'b'])))
+    p = Parser(b'declare B; struct A [ bs: Arr[B] ] struct B [ d: Data ]')
+    p.parse() # Arr of a declared (Undefined) type
+
+  def test_struct_enum(self):
+    ty = self.env.struct(None, b'foo', odict([
+        (b'a', StructField(Int)),
+        (b'b', StructField(Data)),
+    ]))
+    self.check(ty, ty(a=Int(0x77), b=Data(b'bee')))
+    En = self.env.enum(None, b'en', [
+      (b'a',     EnumVar(Int)),
+      (b'b',     EnumVar(Data)),
+    ])
+    self.check(En, En(a=Int(3)))
+    self.check(En, En(b=Data(b'hi')))
+    b = En.encode(En(a=Int(3)))
+    for k in (2, -1):
+      bad = b[:1] + Int.encode(Int(k)) + b[2:]
+      with self.assertRaises(ValueError): En.decode(bad)
+      with self.assertRaises(ValueError): EnumBase._dec.__func__(En, memoryview(bad), 0)
+    with self.assertRaises(Eof): En.decode(b[:-1])
+    Bm = self.env.bitmap(None, b'Bm', [(b'a', BmVar(0x01, 0x03))])
+    bm = Bm(); bm.set_a()
+    self.check(Bm, bm)
+
+  def test_field_names(self):
+    for n in (b'class', b'a.b', b'x=1'):
+      with self.assertRaises(TypeError):
+        self.env.struct(None, b'S', odict([(n, StructField(Int))]))
+      with self.assertRaises(TypeError):
+        self.env.enum(None, b'E', [(n, EnumVar(Int))])
+
+  def test_dyn(self):
+    self.check(Dyn, Dyn.frPy(4))
+    self.check(Dyn, Dyn.frPyArrInt([1, 2, 3, 4]))
+    self.check(Dyn, Dyn.frPyArrDyn([b'\x48', Dyn.frPyArrData([])]))
+
+  def test_compiled(self):
+    p = Parser(b'''
+    declare B;
+    struct A [ b: B; i: Int ]
+    enum E [ x: Int; a: A ]
+    struct B [ d: Data ]
+    ''')
+    p.parse()
+    A, E, B = (p.env.tys[n] for n in (b'A', b'E', b'B'))
+    assert A._fields[b'b'].ty is B
+    assert 'toZ' in vars(A) and 'toZ' in vars(E) # regenerated on define
+    e = E(a=A(B(Data(b'hi')), Int(3)))
+    assert e.toZ() == EnumBase.toZ(e)
+    assert e.a.toZ() == StructBase.toZ(e.a)
+    assert E.frZ(e.toZ()) == e
+    self.check(E, e)
+    try: E(x=Int(1), a=e.a).toZ(); assert False
+    except ValueError: pass
+    S = p.env.struct(None, b'S', odict([(b'b', StructField(B, zid=1))]))
+    b = S.encode(S(B(Data(b'hi'))))
+    assert S.decode(b) == S.frZ(from_zoab_buf(b)[0]) # generates S's codecs
+    B._compile() # regenerated on first use: S must use B's new codecs
+    assert not isinstance(vars(B)['_dec'], classmethod)
+    assert S.decode(b) == S(B(Data(b'hi')))
+    assert isinstance(vars(B)['_dec'], classmethod)
+
+  def test_struct_zid(self):
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)),
+      (b'c', StructField(Str, zid=5)),
+      (b'd', StructField(Int, zid=300)),
+    ]))
+    s = self.check(S, S(Int(1), Str('s'), Int(7)))
+    assert S.decode(s) == StructBase._dec.__func__(S, memoryview(s), 0)[0]
+    assert S.frZ(S.decode(s).toZ()) == StructBase.frZ.__func__(
+      S, from_zoab_buf(s)[0])
+
+  def test_struct_none_toZ(self):
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)), (b'b', StructField(Str)),
+      (b'c', StructField(Str, zid=5)), (b'd', StructField(Int, zid=6, default=Int(7)))]))
+    for s in (S(Int(1), None, None), S(None, None, Str('c'), Int(2))):
+      assert S.frZ(s.toZ()) == s
+      assert StructBase.frZ.__func__(S, s.toZ()) == s
+    assert S.frZ(S(None, None, None, None).toZ()) == S(None, None, None, Int(7))
+
+  def test_struct_none(self):
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)), (b'b', StructField(Str)),
+      (b'c', StructField(Str, zid=5)), (b'd', StructField(Int, zid=6, default=Int(7)))]))
+    for s in (S(Int(1), None, None), S(None, None, Str('c'), Int(2))):
+      b = S.encode(s)
+      assert S.decode(b) == s
+      assert StructBase._dec.__func__(S, memoryview(b), 0)[0] == s
+    assert S.decode(b'\x41\x00') == S(None, None, None, Int(7))
+    with self.assertRaises(TypeError): S(Int(1), None, None).encode()
+    with self.assertRaises(TypeError): ArrInt.frPy([1]).decode(b'\x40')
+
+  def test_projection(self):
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)),
+      (b'b', StructField(ArrInt)),
+      (b'c', StructField(Str)),
+      (b'd', StructField(Str, zid=5)),
+      (b'e', StructField(Int, zid=300)),
+    ]))
+    s = S(Int(1), ArrInt.frPy(range(100)), Str('x' * 70), Str('d'), Int(7))
+    b = S.encode(s)
+    assert S.decode(b, fields=['c', 'e']) == S(None, None, Str('x' * 70), None, Int(7))
+    assert S.decode(b, fields=['a', 'd']) == S(Int(1), None, None, Str('d'), None)
+    assert S.decode(b, fields=[]) == S(None, None, None, None, None)
+    try: S.decode(b, fields=['z']); assert False
+    except ValueError: pass
+    ArrS = self.env.arr(S)
+    arr = ArrS([s] * 70)
+    got = ArrS.decode(ArrS.encode(arr), fields=['a'])
+    assert len(got) == 70 and got[69] == S(Int(1), None, None, None, None)
+    M = self.env.map(Str, S)
+    m = M((Str(str(i)), s) for i in range(40))
+    got = M.decode(M.encode(m), fields={'3', '39'})
+    assert list(got) == ['3', '39'] and got['39'] == s
+    try: Int.decode(Int.encode(1), fields=['a']); assert False
+    except TypeError: pass
+
+  def test_select(self):
+    p = Parser(b'''
+    struct Item [ name: Str; n: Int ]
+    enum Val [ i: Int; s: Str ]
+    struct Rec [ id: Int; items: Arr[Item]; tags: Map[Str,Int]; v: Val ]
+    '''); p.parse()
+    Item, Val, Rec = (p.env.tys[n] for n in (b'Item', b'Val', b'Rec'))
+    ArrItem, MapSI = Rec._fields[b'items'].ty, Rec._fields[b'tags'].ty
+    r = Rec(Int(7), ArrItem(Item(Str(f'i{k}'), Int(k)) for k in range(70)),
+            MapSI({Str('a'): Int(1), Str('b'): Int(2)}), Val(s=Str('sv')))
+    b = Rec.encode(r)
+    assert select(b, Rec, 'id') == 7
+    assert select(b, Rec, 'items[3].name') == 'i3'
+    assert select(b, Rec, ['items', 65, 'n']) == 65
+    assert select(b, Rec, 'items[-1]') == Item(Str('i69'), Int(69))
+    assert select(b, Rec, "tags['b']") == 2
+    assert select(b, Rec, 'v.s') == 'sv'
+    assert select(b, Rec, 'v.i') is None # other variant
+    assert select(b, Rec, 'items[70]') is None
+    assert select(b, Rec, "tags['c']") is None
+    assert bytes(select(b, None, [2, 3, 1]).data) == b'i3' # [posArgs, id, items..]
+    try: select(b, Rec, 'items.name'); assert False
+    except ValueError: pass
+    try: select(b, Rec, 'nope'); assert False
+    except ValueError: pass
+    try: select(b[:20], Rec, 'items[60]'); assert False
+    except Eof: pass
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)), (b'b', StructField(Str)),
+      (b'c', StructField(Str, zid=5)), (b'd', StructField(Int, zid=300)),
+    ]))
+    b = S.encode(S(Int(1), None, None, Int(9)))
+    assert [select(b, S, n) for n in 'abcd'] == [1, None, None, 9]
+    b = S.encode(S(Int(1), Str('b'), Str('c'), None))
+    assert [select(b, S, n) for n in 'abcd'] == [1, 'b', 'c', None]
+    for b, ty, path in ((b'\x40', S, 'a'), (b'\x40', Val, 's'),
+                        (b'\x41\x41a', MapSI, "['a']")):
+      with self.assertRaises(Eof): select(b, ty, path) # empty or odd-length arr
+
+  def test_select_records(self):
+    S = self.env.struct(None, b'S', odict([
+      (b'a', StructField(Int)), (b'b', StructField(ArrStr))]))
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'recs.zoab')
+      with RecordWriter(path) as w:
+        for k in range(50): w.write(S(Int(k), ArrStr.frPy(['x'] * (k % 3))))
+      assert list(select_records(path, S, 'a')) == list(range(50))
+      assert list(select_records(path, S, 'b[1]'))[:3] == [None, None, 'x']
+
+  def test_interner(self):
+    p = Parser(b'struct E [ name: Str; n: Int; d: Data; tags: Arr[Str]; ns: Arr[Int] ]')
+    p.parse()
+    E = p.env.tys[b'E']
+    ArrS, ArrI = E._fields[b'tags'].ty, E._fields[b'ns'].ty
+    e = E(Str('name'), Int(5), Data(b'dd'), ArrS.frPy(['a', 'b']), ArrI.frPy([7]))
+    b = E.encode(e)
+    x, y = E.decode(b), E.decode(b)
+    assert x.name is not y.name
+    with Interner() as it:
+      x, y = E.decode(b), E.frZ(from_zoab_buf(b)[0])
+      assert x == y == e
+      for f in ('name', 'n', 'd'): assert getattr(x, f) is getattr(y, f), f
+      assert x.tags[1] is y.tags[1] and x.ns[0] is y.ns[0]
+      assert type(x.tags[0]) is Str and type(x.ns[0]) is Int
+    # 7 ints and data each: the struct's posArgs (5) is the same Int as n
+    assert (it.misses, it.hits, len(it)) == (6, 8, 6) and it.hitRate == 8 / 14
+    assert E.decode(b).name is not x.name # no longer active
+    with Interner(maxSize=2, maxLen=3) as it:
+      a = [Str.decode(Str.encode(s)) for s in ('x', 'y', 'z', 'x', 'long')]
+      assert a[0] is not a[3] and len(it) == 2 # started over at z: {z, x}
+      assert Str.decode(Str.encode('long')) is not a[4]
+
+  def test_truncated(self):
+    b = ArrInt.encode(ArrInt.frPy(range(10)))
+    try: ArrInt.decode(b[:-1]); assert False
+    except Eof: pass
+
 def tokens(buf):
   out, p = [], Parser(buf)
   while p.i < len(buf):
@@ -250,6 +1008,14 @@ class TestParse(TestBase):
   def test_tokens(self):
     assert tokens(b'a_b[foo.bar baz]') == [
       'a_b', '[', 'foo.bar', 'baz', ']']
+    assert tokens(b'x:=0x1F;}; %%(\x01a') == [
+      'x', ':=', '0x1F', ';};', '%', '%', '(', 'a']
+
+  def test_lines(self):
+    p = Parser(b'a\n\n  b \\ comment\n c')
+    assert p.token() == b'a' and p.line == 1
+    assert p.token() == b'b' and p.line == 3
+    assert p.token() == b'c' and p.line == 4
 
   def test_struct(self):
     p = Parser(b'struct foo [a: Int]')
@@ -321,11 +1087,29 @@ class TestParse(TestBase):
     assert B._variants == [(b's', EnumVar(S))]
     assert E._variants == [(b'a', EnumVar(Int))]
 
+  def test_declare_cycle(self):
+    p = Parser(b'''
+    declare Node; declare Leaf;
+    struct Tree [ root: Node; by: Map[Str, Node] ]
+    struct Node [ kids: Arr[Node]; next: Node; leaf: Leaf ]
+    struct Leaf [ v: Int ]
+    ''')
+    p.parse()
+    Tree, Node, Leaf = (p.env.tys[n] for n in (b'Tree', b'Node', b'Leaf'))
+    assert Tree._fields[b'root'].ty is Node and Tree._fields[b'by'].ty._vty is Node
+    assert Node._fields[b'kids'].ty._ty is Node and Node._fields[b'next'].ty is Node
+    assert Node._fields[b'leaf'].ty is Leaf
+    assert {} == p.env._deps
+
 class TestParseValue(TestBase):
   def testInt(self):
     assert 42 == Int.parse(Parser(b'42'))
     assert 0x42 == Int.parse(Parser(b'0x42'))
     assert 0x33 == Int.parse(Parser(b'{0x33}'))
+    assert 0b101 == Int.parse(Parser(b'0b101'))
+    assert 1000 == Int.parse(Parser(b'1_000'))
+    try: Int.parse(Parser(b'1.5')); assert False
+    except ParseError: pass
 
   def testData(self):
     expected = b'\x12\x34\x56\x78\x90'
@@ -438,6 +1222,232 @@ void  B_txZoab(Ring* r, B* t) {
 }
 '''.strip()
 
+class TestEnvCache(unittest.TestCase):
+  TY = b'''
+  declare Fwd;
+  struct Uses [ f: Fwd; m: Map[Str, Arr[Fwd]]; a: Arr[U2] ]
+  struct Fwd [ x: U4 = 3 ]
+  enum Tag [ a: Int; u: Uses ]
+  bitmap Bm [ on 0x01 0x01; off 0x00 0x01 ]
+  const t: U2 = 0x42;
+  const s: Str = |hi there|;
+  '''
+
+  def test_roundtrip(self):
+    p = Parser(self.TY); p.parse()
+    d = describeEnv(p.env, b'sha')
+    env = loadEnv(d, b'sha')
+    assert d == describeEnv(env, b'sha')
+    assert list(p.env.tys) == list(env.tys)
+    assert p.env.vals == env.vals and type(env.vals[b't']) is U2
+    Uses, Fwd = env.tys[b'Uses'], env.tys[b'Fwd']
+    assert Uses._fields[b'f'].ty is Fwd
+    assert issubclass(Uses._fields[b'a'].ty, ArrSizedBase)
+    assert type(Fwd().x) is U4 and Fwd().x == 3
+    try: loadEnv(d, b'other'); assert False
+    except ValueError: pass
+
+  def test_parseCached(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'a.ty')
+      with open(path, 'wb') as f: f.write(self.TY)
+      cache = os.path.join(tmp, 'cache')
+      r = parse(path, cache=cache)
+      entries = os.listdir(cache); assert 1 == len(entries)
+      assert list(r.tys) == list(parse(path, cache=cache).tys)
+      with open(os.path.join(cache, entries[0]), 'wb') as f: f.write(b'\x05junk!')
+      assert r.vals == parse(path, cache=cache).vals # corrupt: reparsed
+      with open(os.path.join(cache, entries[0]), 'rb') as f:
+        b = f.read(); loadEnv(b) # and rewritten
+      with open(os.path.join(cache, entries[0]), 'wb') as f:
+        f.write(b[:len(b) // 2]) # truncated marshal data
+      assert r.vals == parse(path, cache=cache).vals
+      n = len(ENV_CACHE_MAGIC); end = n + 1 + b[n]
+      unknown = marshal.dumps(((), ((b'c', b'NoSuchType', b''),)))
+      for bad in (b[:n], b[:n + 1], b[:end] + unknown):
+        with open(os.path.join(cache, entries[0]), 'wb') as f: f.write(bad)
+        assert r.vals == parse(path, cache=cache).vals
+      import zoa
+      version = zoa.ENV_CACHE_VERSION
+      try:
+        zoa.ENV_CACHE_VERSION = b'other-python'
+        parse(path, cache=cache)
+        assert 2 == len(os.listdir(cache)) # a separate entry
+      finally: zoa.ENV_CACHE_VERSION = version
+
+class TestPickle(unittest.TestCase):
+  SRC = b'''
+  enum E [ a: Int; b: Str ]
+  struct Ev [ name: Str; n: Int; tags: Arr[Str]; m: Map[Str,Int]; e: E ]
+  '''
+
+  def values(self, env):
+    Ev, E = env.tys[b'Ev'], env.tys[b'E']
+    ArrS, MapSI = env.tys['Arr[Str]'], env.tys['Map[Str,Int]']
+    ev = Ev(Str('a'), Int(1), ArrS([Str('x')]), MapSI({Str('k'): Int(2)}), E(a=Int(3)))
+    return [ev, E(b=Str('hi')), ArrS([Str('y')]), ev]
+
+  def test_roundtrip(self):
+    p = Parser(self.SRC); p.parse()
+    Bm = p.env.bitmap(None, b'Bm', [(b'a', BmVar(0x01, 0x03))])
+    vals = self.values(p.env) + [Bm(1)]
+    got = pickle.loads(pickle.dumps(vals))
+    assert got == vals and got[0] is got[3]
+    assert [type(v) for v in got] == [type(v) for v in vals] # same process
+    assert envRef(p.env) is envRef(p.env)
+
+  def test_compact(self):
+    p = Parser(b''.join(b'struct S%d [ a: Int; b: Str ]' % i for i in range(500)))
+    p.parse()
+    S = p.env.tys[b'S7']
+    one = len(pickle.dumps([S(Int(1), Str('hi'))]))
+    two = len(pickle.dumps([S(Int(1), Str('hi')), S(Int(2), Str('hi'))]))
+    assert two - one < 50 # the description is pickled once
+    ref = envRef(p.env)
+    p.env.vals[b'c'] = Int(3) # a new const: a new description
+    assert envRef(p.env) is not ref and envRef(p.env) is envRef(p.env)
+
+  def test_types(self):
+    p = Parser(self.SRC); p.parse()
+    tys = [p.env.tys[n] for n in (b'Ev', b'E', 'Arr[Str]', 'Map[Str,Int]')]
+    assert pickle.loads(pickle.dumps(tys)) == tys
+    q = Parser(self.SRC); q.parse() # the same sha: the last envRef is used
+    assert pickle.loads(pickle.dumps(q.env.tys[b'Ev'])) is q.env.tys[b'Ev']
+    assert pickle.loads(pickle.dumps(tys)) == tys
+    assert pickle.loads(pickle.dumps(Int)) is Int
+
+  def test_other_process(self):
+    p = Parser(self.SRC); p.parse()
+    vals = self.values(p.env)
+    b = pickle.dumps((vals, p.env.tys[b'Ev']))
+    out = subprocess.run([sys.executable, '-c',
+      'import pickle, sys, zoa\n'
+      'vals, Ev = pickle.loads(sys.stdin.buffer.read())\n'
+      'assert type(vals[0]) is Ev and Ev.name == b"Ev"\n'
+      'sys.stdout.buffer.write(pickle.dumps(vals))\n'],
+      input=b, capture_output=True, check=True,
+      cwd=os.path.dirname(os.path.abspath(__file__)))
+    got = pickle.loads(out.stdout)
+    assert got == vals and type(got[0]) is type(vals[0])
+    out = subprocess.run([sys.executable, '-c', # the same source: the same sha
+      'import pickle, sys, zoa\n'
+      f'p = zoa.Parser({self.SRC!r}); p.parse(); zoa.envRef(p.env)\n'
+      'vals, Ev = pickle.loads(sys.stdin.buffer.read())\n'
+      'assert type(vals[0]) is p.env.tys[b"Ev"] is Ev\n'],
+      input=b, capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.returncode == 0, out.stderr
+
+class TestTree(unittest.TestCase):
+  FILES = {
+    'base.ty': b'''
+      struct Point [ x: U4; y: U4 = 0x2 ]
+      bitmap Flags [ on 0x01 0x01; off 0x00 0x01 ]
+      const origin: U2 = 0x7;
+    ''',
+    'net/msg.ty': b'''
+      struct Msg [ at: base.Point; f: base.Flags; r: net.reply.Reply ]
+      enum Any [ m: Msg; p: base.Point ]
+    ''',
+    'net/reply.ty': b''' \\ a cycle with msg and a const of another module
+      struct Reply [ to: Arr[net.msg.Any]; code: U1 ]
+      const zero: base.Point = { |x| = 0x1 }
+    ''',
+  }
+
+  def tree(self, tmp, files):
+    for name, b in files.items():
+      path = os.path.join(tmp, name)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'wb') as f: f.write(b)
+    return tmp
+
+  def test_modules(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      self.tree(tmp, self.FILES)
+      assert [b'base', b'net.msg', b'net.reply'] == [m for m, _ in treeModules(tmp)]
+      for workers in (1, 2):
+        r = parseTree(tmp, workers=workers)
+        Point, Msg, Reply = r.tys['base.Point'], r.tys['net.msg.Msg'], r.tys['net.reply.Reply']
+        assert Msg._fields[b'at'].ty is Point and Msg._fields[b'r'].ty is Reply
+        assert Reply._fields[b'to'].ty._ty is r.tys['net.msg.Any']
+        assert 7 == r.vals['base.origin'] and Point(1) == r.vals['net.reply.zero']
+        m = Msg(Point(1), r.tys['base.Flags'](), Reply([], 3))
+        assert m == Msg.decode(Msg.encode(m))
+        assert list(r.tys) == list(parse(tmp).tys)
+
+  def test_errors(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      self.tree(tmp, {'a.ty': b'struct A [ b: b.Nope ]', 'b.ty': b'struct B []'})
+      with self.assertRaises(KeyError): parseTree(tmp, workers=2)
+    with tempfile.TemporaryDirectory() as tmp:
+      self.tree(tmp, {'a.ty': b'struct A [ b: B ]', 'b.ty': b''})
+      with self.assertRaises(KeyError): parseTree(tmp) # not b.B
+    with tempfile.TemporaryDirectory() as tmp:
+      self.tree(tmp, {'a.ty': b'const x: U2 = 0x1;\nconst x: U2 = 0x2;'})
+      with self.assertRaisesRegex(ParseError, 'a.ty:2'): parseTree(tmp)
+
+def _isEven(z): return int_from_bytes(z.arr[1].data) % 2 == 0
+def _recName(z): return bytes(z.arr[0].data)
+def _eventN(e): return int(e.n)
+def _isStr(v): return isinstance(v, Str)
+
+class TestDecodeRecords(unittest.TestCase):
+  def test_decode(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'recs.zoab')
+      with RecordWriter(path) as w:
+        for i in range(300): w.write(ZoaRaw.frPy([b'rec%d' % i, i.to_bytes(2, 'big')]))
+      expect = [[b'rec%d' % i, i.to_bytes(2, 'big')] for i in range(300)]
+      for workers in (1, 2):
+        got = decode_records(path, workers=workers, chunk=500)
+        assert [z.to_py() for z in got] == expect
+      got = decode_records(path, where=_isEven, fn=_recName, workers=2, chunk=500)
+      assert list(got) == [b'rec%d' % i for i in range(0, 300, 2)]
+      got = decode_records(path, fn=_recName, workers=2, ordered=False, chunk=500)
+      assert sorted(got) == sorted(b'rec%d' % i for i in range(300))
+      got = decode_records(path, fn=_recName, workers=2, chunk=50) # > window
+      assert list(got) == [b'rec%d' % i for i in range(300)]
+      empty = os.path.join(tmp, 'empty.zoab')
+      open(empty, 'wb').close()
+      assert list(decode_records(empty, workers=2)) == []
+
+  def test_typed(self):
+    p = Parser(b'struct Event [ name: Str; n: Int ]'); p.parse()
+    Event = p.env.tys[b'Event']
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'events.zoab')
+      with RecordWriter(path) as w:
+        for i in range(100): w.write(Event(Str(f'e{i}'), Int(i)))
+      got = decode_records(path, Event, fn=_eventN, workers=2, chunk=200)
+      assert list(got) == list(range(100))
+      for workers in (1, 2):
+        got = list(decode_records(path, Event, workers=workers, chunk=200))
+        assert got[7] == Event(Str('e7'), Int(7)) and type(got[7]) is Event
+      path = os.path.join(tmp, 'strs.zoab')
+      with RecordWriter(path) as w:
+        for s in ('a', 'b', 'c'): w.write(Str(s))
+      got = decode_records(path, Str, workers=2, chunk=1, where=_isStr)
+      assert list(got) == ['a', 'b', 'c'] # native types are sent as they are
+
+  def test_truncated(self):
+    p = Parser(b'struct Event [ name: Str; n: Int ]'); p.parse()
+    Event = p.env.tys[b'Event']
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'events.zoab')
+      with RecordWriter(path) as w:
+        for i in range(10): w.write(Event(Str(f'e{i}'), Int(i)))
+      with open(path, 'rb') as f: b = f.read()
+      end = b.index(RECORDS_FOOTER_START, zoab_index(b)[1])
+      with open(path, 'wb') as f: f.write(b[:end - 2]) # cut the last record
+      for workers in (1, 2):
+        got = decode_records(path, Event, fn=_eventN, workers=workers, chunk=20)
+        assert list(got) == list(range(9))
+      with open(path, 'wb') as f: # the last record is too short for an Event
+        f.write(b[:zoab_index(b)[0][3]] + b'\x40')
+      for workers in (1, 2):
+        with self.assertRaises(Eof):
+          list(decode_records(path, Event, workers=workers, chunk=20))
+
 class TestExportC(TestBase):
   def testStruct(self):
     r = parseBytes(b'''
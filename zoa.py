@@ -21,12 +21,24 @@ tys = _parser.env.tys
 
 """
 
+import array
 import ast
+import bisect
+import contextvars
+import copyreg
+import hashlib
 import io
+import keyword
+import marshal
+import mmap
+import os
+import re
+import sys
 import unittest
+import weakref
 import dataclasses
 
-from collections import OrderedDict as odict
+from collections import OrderedDict as odict, deque
 from collections.abc import Hashable
 from enum import Enum
 from typing import Any, Dict, List, Tuple, Iterable
@@ -49,17 +61,29 @@ class Result:
   tys: AttrDict
   vals: AttrDict
 
+def envResult(env: 'TyEnv') -> Result:
+  return Result(
+    tys = _fromBinaryAttrs(env.tys),
+    vals = _fromBinaryAttrs(env.vals),
+  )
+
 def parseBytes(b: bytes) -> Result:
   parser = Parser(b)
   parser.parse()
-  return Result(
-    tys = _fromBinaryAttrs(parser.env.tys),
-    vals = _fromBinaryAttrs(parser.env.vals),
-  )
+  return envResult(parser.env)
 
-def parse(path) -> Result:
+def parse(path, cache=None) -> Result:
+  """Parse the .ty file at path, or the tree of them if it is a directory
+  (see parseTree).
+
+  If cache is a directory then the parsed types are cached there (see
+  parseCached).
+  """
+  if os.path.isdir(path): return parseTree(path, cache=cache)
   with open(path, 'rb') as f:
-    return parseBytes(f.read())
+    b = f.read()
+  if cache is None: return parseBytes(b)
+  return parseCached(b, cache)
 
 ################################################################################
 # Utilities and Constants
@@ -71,7 +95,7 @@ ZOA_DATA = 0x00
 
 class Eof(Exception): pass
 
-def isbytes(v): return isinstance(v, (bytes, bytearray))
+def isbytes(v): return isinstance(v, (bytes, bytearray, memoryview))
 
 def _fromBinaryAttrs(a: AttrDict) -> AttrDict:
   return AttrDict((utf8(k), v) for (k, v) in a.items())
@@ -136,6 +160,37 @@ class ZoaRaw:
       out.append(v.to_py())
     return out
 
+  @classmethod
+  def frPyDeep(cls, value):
+    """Same as frPy but uses an explicit stack instead of recursion."""
+    if isbytes(value): return cls.new_data(value)
+    top = cls.new_arr(); stk = [(iter(value), top.arr)]
+    while stk:
+      it, out = stk[-1]
+      for v in it:
+        if isbytes(v): out.append(cls.new_data(v)); continue
+        z = cls.new_arr(); out.append(z)
+        stk.append((iter(v), z.arr))
+        break
+      else: stk.pop()
+    return top
+
+  def to_py_deep(self):
+    """Same as to_py but uses an explicit stack instead of recursion."""
+    if self.data is not None: return bytes(self.data)
+    if self.arr is None: raise ValueError(self)
+    top = []; stk = [(iter(self.arr), top)]
+    while stk:
+      it, out = stk[-1]
+      for v in it:
+        if v.data is not None: out.append(bytes(v.data)); continue
+        if v.arr is None: raise ValueError(v)
+        o = []; out.append(o)
+        stk.append((iter(v.arr), o))
+        break
+      else: stk.pop()
+    return top
+
   @classmethod
   def new_arr(cls, value=None):
     return cls(data=None, arr=value if value is not None else [])
@@ -146,14 +201,14 @@ class ZoaRaw:
 
   def serialize(self, bw=None):
     bw = bw if bw is not None else io.BytesIO()
-    if self.data: write_data(bw, self.data)
-    else:         write_arr(bw, self.arr)
+    bw.write(encode_zoab(self))
     bw.seek(0)
     return bw
 
   def extend(self, value):
     if isbytes(value):
       if self.data is None: raise ValueError("invalid extend")
+      if isinstance(self.data, memoryview): self.data = bytearray(self.data)
       self.data.extend(value)
     else:
       if self.arr is None: raise ValueError("invalid extend")
@@ -210,6 +265,92 @@ def write_arr(bw: io.BytesIO, arr: list[ZoaRaw]):
       j += 1
       i += 1
 
+def zoab_len(z: ZoaRaw) -> int:
+  """Return the exact number of bytes z encodes to."""
+  if z.data is not None: return _data_len(len(z.data))
+  if z.arr is None: raise ValueError(z)
+  size = 0; stk = [z.arr]
+  while stk:
+    arr = stk.pop(); n = len(arr)
+    size += 1 if n <= 63 else (n + 62) // 63
+    for v in arr:
+      d = v.data
+      if d is not None:
+        n = len(d)
+        size += n + 1 if n <= 63 else _data_len(n)
+      elif v.arr is not None: stk.append(v.arr)
+      else: raise ValueError(v)
+  return size
+
+def _data_len(n: int) -> int:
+  return n + ((n + 62) // 63 if n else 1)
+
+def encode_zoab(z: ZoaRaw) -> bytearray:
+  """Encode z into a single exactly-sized bytearray."""
+  buf = bytearray(zoab_len(z))
+  _encode_into(z, buf, 0)
+  return buf
+
+def encode_zoab_into(z: ZoaRaw, buf, i: int = 0) -> int:
+  """Encode z into buf (bytearray or writable memoryview) at offset i.
+
+  Returns the end offset. Raises ValueError if buf doesn't have room.
+  """
+  if i + zoab_len(z) > len(buf): raise ValueError("buffer too small")
+  return _encode_into(z, buf, i)
+
+def _encode_into(z: ZoaRaw, buf, i: int) -> int:
+  if z.data is not None: return _encode_data_into(z.data, buf, i)
+  if z.arr is None: raise ValueError(z)
+  # Stack of (arr, nextSegment, segmentIter). nextSegment=-1 for the last one.
+  stk = []
+  arr, k, it = z.arr, 0, None
+  while True:
+    if it is None: # start the next arr segment
+      remaining = len(arr) - k
+      if remaining > 63:
+        buf[i] = ZOA_ARR | ZOA_JOIN | 63
+        it = iter(arr[k:k+63]); k += 63
+      else:
+        buf[i] = ZOA_ARR | remaining
+        it = iter(arr[k:] if k else arr); k = -1
+      i += 1
+    for v in it:
+      d = v.data
+      if d is not None:
+        n = len(d)
+        if n <= 63:
+          buf[i] = n; i += 1
+          buf[i:i+n] = d; i += n
+        else: i = _encode_data_into(d, buf, i)
+      elif v.arr is not None:
+        stk.append((arr, k, it))
+        arr, k, it = v.arr, 0, None
+        break
+      else: raise ValueError(v)
+    else:
+      if k >= 0: it = None; continue
+      if not stk: return i
+      arr, k, it = stk.pop()
+
+def _encode_data_into(data, buf, i: int) -> int:
+  n = len(data)
+  if n <= 63:
+    buf[i] = n; i += 1
+    buf[i:i+n] = data
+    return i + n
+  m = (n - 1) // 63 # number of joined segments
+  k, span = 63 * m, 64 * m
+  # copy each segment between memoryviews: no slice of the data is created
+  src, dst = memoryview(data), memoryview(buf)
+  buf[i:i+span:64] = bytes((ZOA_JOIN | 63,)) * m
+  for j, o in zip(range(0, k, 63), range(i + 1, i + span, 64)):
+    dst[o:o+63] = src[j:j+63]
+  i += span
+  n -= k; buf[i] = n; i += 1
+  dst[i:i+n] = src[k:]
+  return i + n
+
 def readexact(br: io.BytesIO, to: bytearray, length: int):
   while length:
     got = br.read(length)
@@ -244,6 +385,1341 @@ def from_zoab(br: io.BytesIO, joinTo:ZoaRaw = None):
       return out
     prev_ty = ty
 
+def from_zoab_buf(buf, i: int = 0, copy=False) -> Tuple[ZoaRaw, int]:
+  """Decode one zoab value from buf (bytes/bytearray/memoryview) at offset i.
+
+  Returns (value, end) where end is the offset just past the value. Data nodes
+  are memoryview slices into buf unless copy=True (joined data is always
+  copied into a bytearray). The resulting tree is equal to from_zoab's.
+  """
+  mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+  return _from_zoab_buf(mv, i, len(mv), copy)
+
+def _from_zoab_buf(mv: memoryview, i: int, end: int, copy: bool):
+  # Explicit stack of (parentArr, remaining, join) so depth is unbounded.
+  top = []; stk = []
+  arr, rem, join = top, 1, 0
+  while True:
+    if not rem:
+      if join: # joined arr: read the next segment header
+        if i >= end: raise Eof()
+        meta = mv[i]; i += 1
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        rem, join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+        continue
+      if not stk: return top[0], i
+      arr, rem, join = stk.pop()
+      continue
+
+    rem -= 1
+    if i >= end: raise Eof()
+    meta = mv[i]; i += 1
+    if ZOA_ARR & meta:
+      z = ZoaRaw(None, []); arr.append(z)
+      stk.append((arr, rem, join))
+      arr, rem, join = z.arr, ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+      continue
+    j = i + (ZOA_LEN_MASK & meta)
+    if j > end: raise Eof()
+    if ZOA_JOIN & meta: data, j = _joinData(mv, i, j, end)
+    else:               data = bytearray(mv[i:j]) if copy else mv[i:j]
+    arr.append(ZoaRaw(data, None))
+    i = j
+
+def _joinData(mv: memoryview, i: int, j: int, end: int) -> Tuple[bytearray, int]:
+  """Join data segments, the first of which is mv[i:j] (with the join bit)."""
+  data = bytearray(mv[i:j])
+  while True:
+    if j >= end: raise Eof()
+    meta = mv[j]; i = j + 1
+    if ZOA_ARR & meta: raise ValueError("join different types")
+    j = i + (ZOA_LEN_MASK & meta)
+    if j > end: raise Eof()
+    data += mv[i:j]
+    if not ZOA_JOIN & meta: return data, j
+
+def from_zoab_deep(br: io.BytesIO) -> ZoaRaw:
+  """Same as from_zoab but uses an explicit stack instead of recursion.
+
+  This handles arbitrarily nested arrays.
+  """
+  top = []; stk = []
+  arr, rem, join = top, 1, 0
+  while True:
+    if not rem:
+      if join:
+        meta = br.read(1)
+        if not meta: raise Eof()
+        meta = meta[0]
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        rem, join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+        continue
+      if not stk: return top[0]
+      arr, rem, join = stk.pop()
+      continue
+
+    rem -= 1
+    meta = br.read(1)
+    if not meta: raise Eof()
+    meta = meta[0]
+    if ZOA_ARR & meta:
+      z = ZoaRaw(None, []); arr.append(z)
+      stk.append((arr, rem, join))
+      arr, rem, join = z.arr, ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+      continue
+    data = bytearray()
+    readexact(br, data, ZOA_LEN_MASK & meta)
+    while ZOA_JOIN & meta:
+      meta = br.read(1)
+      if not meta: raise Eof()
+      meta = meta[0]
+      if ZOA_ARR & meta: raise ValueError("join different types")
+      readexact(br, data, ZOA_LEN_MASK & meta)
+    arr.append(ZoaRaw(data, None))
+
+def write_arr_deep(bw: io.BytesIO, arr: list[ZoaRaw]):
+  """Same as write_arr but uses an explicit stack instead of recursion."""
+  stk = []; i = 0
+  while True:
+    n = len(arr)
+    if i % 63 == 0 and (i < n or i == 0): # segment header
+      remaining = n - i
+      join = ZOA_JOIN if remaining > 63 else 0
+      write_byte(bw, ZOA_ARR | join | min(63, remaining))
+    if i == n:
+      if not stk: return
+      arr, i = stk.pop()
+      continue
+    v = arr[i]; i += 1
+    if v.data  is not None: write_data(bw, v.data)
+    elif v.arr is not None:
+      stk.append((arr, i))
+      arr, i = v.arr, 0
+    else: raise ValueError(v)
+
+def zoab_skip(buf, i: int = 0) -> int:
+  """Return the offset just past the zoab value starting at buf[i].
+
+  Only the headers are read: data is jumped over and nothing is decoded.
+  """
+  end = len(buf); pending = 1
+  while pending:
+    if i >= end: raise Eof()
+    meta = buf[i]; i += 1
+    if ZOA_ARR & meta: pending += ZOA_LEN_MASK & meta
+    else:              i += ZOA_LEN_MASK & meta
+    if not ZOA_JOIN & meta: pending -= 1
+  if i > end: raise Eof()
+  return i
+
+class LazyZoa:
+  """A lazy view of an encoded zoab array.
+
+  Construction does a single structural scan of the headers and records the
+  offset of every child in a compact array. Children are only decoded (with
+  from_zoab_buf) when they are accessed.
+  """
+  __slots__ = ('buf', 'start', 'end', 'copy', '_offs')
+
+  def __init__(self, buf, i: int = 0, copy=False):
+    mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+    self.buf, self.start, self.copy = mv, i, copy
+    offs = array.array('Q'); end = len(mv)
+    if i >= end: raise Eof()
+    meta = mv[i]; i += 1
+    if not ZOA_ARR & meta: raise TypeError("LazyZoa requires an arr")
+    while True:
+      for _ in range(ZOA_LEN_MASK & meta):
+        offs.append(i)
+        i = zoab_skip(mv, i)
+      if not ZOA_JOIN & meta: break
+      if i >= end: raise Eof()
+      meta = mv[i]; i += 1
+      if not ZOA_ARR & meta: raise ValueError("join different types")
+    self.end, self._offs = i, offs
+
+  def __len__(self): return len(self._offs)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self._offs)))]
+    return from_zoab_buf(self.buf, self._offs[i], self.copy)[0]
+
+  def __iter__(self):
+    for off in self._offs:
+      yield from_zoab_buf(self.buf, off, self.copy)[0]
+
+  def lazy(self, i) -> 'LazyZoa':
+    """Return a LazyZoa of child i (which must be an arr)."""
+    return LazyZoa(self.buf, self._offs[i], self.copy)
+
+  def to_raw(self) -> ZoaRaw:
+    """Decode the whole value."""
+    return from_zoab_buf(self.buf, self.start, self.copy)[0]
+
+  def __repr__(self): return f'LazyZoa(len={len(self._offs)})'
+
+class ZoabDecoder:
+  """Incremental (push) zoab decoder.
+
+  feed() accepts chunks of any size and returns every top-level value that was
+  completed by that chunk. Partial values (including data split in the middle
+  of a join segment) are kept between calls and no byte is looked at twice.
+  """
+  def __init__(self):
+    self._stk = []     # parent frames: (arr ZoaRaw, remaining, join)
+    self._z = None     # arr currently being filled, None at the top-level
+    self._rem = 0      # values remaining in the current arr segment
+    self._join = 0     # the current arr segment has the join bit
+    self._data = None  # data currently being filled
+    self._need = 0     # bytes remaining in the current data segment
+    self._djoin = 0    # the current data segment has the join bit
+
+  @property
+  def pending(self) -> bool:
+    """True if a partially received value is buffered."""
+    return self._z is not None or self._data is not None
+
+  def feed(self, chunk) -> List[ZoaRaw]:
+    out = []
+    mv = memoryview(chunk); end = len(mv); i = 0
+    while True:
+      if self._need:
+        j = min(end, i + self._need)
+        self._data += mv[i:j]; self._need -= j - i; i = j
+        if self._need: return out
+        if not self._djoin: self._endData(out)
+        continue
+      if i >= end: return out
+      meta = mv[i]; i += 1
+
+      if self._data is not None: # joined data
+        if ZOA_ARR & meta: raise ValueError("join different types")
+      elif self._z is not None and not self._rem: # joined arr
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        self._rem, self._join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+        if not (self._rem or self._join): self._endArr(out)
+        continue
+      else: # new value
+        if self._z is not None: self._rem -= 1
+        if ZOA_ARR & meta:
+          self._stk.append((self._z, self._rem, self._join))
+          self._z = ZoaRaw(None, [])
+          self._rem, self._join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+          if not (self._rem or self._join): self._endArr(out)
+          continue
+        self._data = bytearray()
+      self._need, self._djoin = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+      if not (self._need or self._djoin): self._endData(out)
+
+  def _endData(self, out):
+    z = ZoaRaw(self._data, None); self._data = None
+    self._add(z, out)
+
+  def _endArr(self, out):
+    z = self._z
+    self._z, self._rem, self._join = self._stk.pop()
+    self._add(z, out)
+
+  def _add(self, z, out):
+    while self._z is not None:
+      self._z.arr.append(z)
+      if self._rem or self._join: return
+      z = self._z
+      self._z, self._rem, self._join = self._stk.pop()
+    out.append(z)
+
+################################################################################
+# Dedup: encode_zoab_dedup writes each repeated subtree as a ZOAB_PTR back to
+# its first occurrence: the header ZOAB_PTR followed by data holding the
+# (big-endian) distance from the pointer back to the start of that value.
+#
+# ZOAB_PTR is also the header of an empty joined arr, which other encoders may
+# write, so this is not zoab: it starts with DEDUP_MAGIC, which zoab decoders
+# reject (an empty joined data joined to an arr) and from_zoab_dedup requires.
+# It trades encode time for size: encode_zoab stays the default encoder.
+
+ZOAB_PTR = 0xC0
+DEDUP_MAGIC = b'\x80zoaptr1\n'
+DEDUP_MIN_LEN = 8 # smaller subtrees are always written out
+
+def _subtreeIds(z: ZoaRaw) -> Tuple[List[int], List[int], List[int]]:
+  """Number the distinct arrs of z by content (the bytes of their data items
+  and the numbers of their arr items).
+
+  Returns the number and the span (of arrs) of each arr of z in pre-order, and
+  the encoded size of each number.
+  """
+  keys, sizes, nums, spans = {}, [], [None], [None]
+  stk = []; arr, k, items, size, slot = z.arr, 0, [], 0, 0
+  while True:
+    n = len(arr)
+    while k < n:
+      c = arr[k]; k += 1
+      d = c.data
+      if d is not None: # data is its own key
+        if type(d) is not bytes: d = bytes(d)
+        items.append(d); m = len(d)
+        size += m + 1 if m <= 63 else _data_len(m)
+      elif c.arr is None: raise ValueError(c)
+      else: # number the items of c first
+        stk.append((arr, k, items, size, slot))
+        slot = len(nums); nums.append(None); spans.append(None)
+        arr, k, items, size = c.arr, 0, [], 0
+        break
+    else:
+      key = tuple(items)
+      m = keys.get(key)
+      if m is None:
+        m = keys[key] = len(sizes)
+        sizes.append(size + (1 if n <= 63 else (n + 62) // 63))
+      nums[slot] = m; spans[slot] = len(nums) - slot
+      if not stk: return nums, spans, sizes
+      arr, k, items, size, slot = stk.pop()
+      items.append(m); size += sizes[m]
+
+def _encPtr(out: bytearray, f: int, size: int) -> bool:
+  """Write a ZOAB_PTR to out[f] if it is smaller than size."""
+  dist = len(out) - f; b = (dist.bit_length() + 7) // 8
+  if 2 + b >= size: return False
+  out.append(ZOAB_PTR); out.append(b); out += dist.to_bytes(b, 'big')
+  return True
+
+def encode_zoab_dedup(z: ZoaRaw, minLen: int = DEDUP_MIN_LEN) -> bytearray:
+  """Encode z, writing each repeat of a subtree that encodes to at least minLen
+  bytes as a ZOAB_PTR to its first occurrence. Decode with from_zoab_dedup.
+
+  This only makes the output smaller: every subtree is hashed before it is
+  written, so unless much of z repeats it is slower than encode_zoab (about
+  0.75x with no repeats). Use encode_zoab when speed matters more than size.
+  """
+  out = bytearray(DEDUP_MAGIC)
+  if z.arr is None: out += encode_zoab(z); return out
+  nums, spans, sizes = _subtreeIds(z)
+  first, firstData = [-1] * len(sizes), {}
+  stk = []; arr, k, n = [z], 0, 1; p = 0
+  while True:
+    while k < n:
+      if stk and not k % 63: _enc_seg(out, n, k)
+      c = arr[k]; k += 1
+      d = c.data
+      if d is not None:
+        m = len(d)
+        if m >= minLen - 1: # (encodes to >= minLen bytes)
+          key = d if type(d) is bytes else bytes(d)
+          f = firstData.get(key)
+          if f is None: firstData[key] = len(out)
+          elif _encPtr(out, f, _data_len(m)): continue
+        if m <= 63: out.append(m); out += d
+        else: _enc_data(out, d)
+        continue
+      m = nums[p]; f = first[m]
+      if f < 0: first[m] = len(out)
+      elif sizes[m] >= minLen and _encPtr(out, f, sizes[m]):
+        p += spans[p]; continue
+      p += 1
+      if not c.arr: out.append(ZOA_ARR)
+      else:
+        stk.append((arr, k, n))
+        arr, k, n = c.arr, 0, len(c.arr)
+    if not stk: return out
+    arr, k, n = stk.pop()
+
+def from_zoab_dedup(buf, i: int = 0, share=True, copy=False) -> Tuple[ZoaRaw, int]:
+  """from_zoab_buf for the output of encode_zoab_dedup (at buf[i]).
+
+  Each ZOAB_PTR is resolved to the value it points to: the very ZoaRaw
+  decoded there if share, else a new copy of it.
+  """
+  mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+  j = i + len(DEDUP_MAGIC)
+  if mv[i:j] != DEDUP_MAGIC: raise ValueError("Not encode_zoab_dedup output")
+  mv = mv[j:] # pointers can't reach before the value
+  z, end = _from_zoab_dedup(mv, 0, len(mv), {}, share, copy)
+  return z, j + end
+
+def _from_zoab_dedup(mv: memoryview, i: int, end: int, done: dict, share: bool,
+                     copy: bool):
+  # _from_zoab_buf, resolving a ZOAB_PTR where a value starts. done maps the
+  # start of every fully decoded value to it: a pointer to anything else (an
+  # arr still being decoded, the inside of a value) is invalid.
+  top = []; stk = []
+  arr, rem, join, cur, cstart = top, 1, 0, None, 0
+  while True:
+    if not rem:
+      if join: # joined arr: read the next segment header
+        if i >= end: raise Eof()
+        meta = mv[i]; i += 1
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        rem, join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+        continue
+      if not stk: return top[0], i
+      done[cstart] = cur
+      arr, rem, join, cur, cstart = stk.pop()
+      continue
+
+    rem -= 1
+    if i >= end: raise Eof()
+    meta = mv[i]
+    if meta == ZOAB_PTR:
+      d, j = _dec_data(mv, i + 1)
+      to = i - int.from_bytes(d, 'big')
+      z = done.get(to) if to < i else None
+      if z is None: raise ValueError(f"Invalid pointer at {i}")
+      if not share: z = _from_zoab_dedup(mv, to, end, done, False, copy)[0]
+      arr.append(z); i = j
+      continue
+    start = i; i += 1
+    if ZOA_ARR & meta:
+      z = ZoaRaw(None, []); arr.append(z)
+      stk.append((arr, rem, join, cur, cstart))
+      arr, rem, join = z.arr, ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+      cur, cstart = z, start
+      continue
+    j = i + (ZOA_LEN_MASK & meta)
+    if j > end: raise Eof()
+    if ZOA_JOIN & meta: data, j = _joinData(mv, i, j, end)
+    else:               data = bytearray(mv[i:j]) if copy else mv[i:j]
+    z = ZoaRaw(data, None); arr.append(z)
+    done[start] = z
+    i = j
+
+################################################################################
+# Records: files of zoab values stored back to back. open_records() maps the
+# file and indexes the offset of every record so that any record can be decoded
+# straight from the mapped pages. The index can be kept next to the file (as
+# .zidx) so that it is only rebuilt when the file changes.
+#
+# RecordWriter appends records and ends the file with an index footer: the
+# byte RECORDS_FOOTER_START, the offsets (u64 little-endian), the end of the
+# records (u64) and RECORDS_FOOTER_MAGIC. A file without a valid footer (i.e.
+# after a crash) is indexed by scanning it instead, which stops at the
+# RECORDS_FOOTER_START of a partially written footer.
+
+RECORDS_INDEX_MAGIC = b'zoaidx1\n'
+RECORDS_FOOTER_MAGIC = b'zoaftr1\n'
+RECORDS_FOOTER_START = ZOA_JOIN # empty joined data: never written as a value
+RECORDS_BATCH = 0x10000
+
+def zoab_index(buf, i: int = 0) -> Tuple[array.array, int]:
+  """Return the offsets of the zoab values stored back to back in buf[i:] and
+  the end of the last whole one.
+
+  A truncated value or RECORDS_FOOTER_START (where a value would start) ends
+  the scan.
+  """
+  mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+  end = len(mv); offs = array.array('Q')
+  while i < end:
+    if mv[i] == RECORDS_FOOTER_START: break
+    j = i; pending = 1 # inlined zoab_skip
+    while pending:
+      if j >= end: return offs, i
+      meta = mv[j]; j += 1
+      if ZOA_ARR & meta: pending += ZOA_LEN_MASK & meta
+      else:              j += ZOA_LEN_MASK & meta
+      if not ZOA_JOIN & meta: pending -= 1
+    if j > end: break
+    offs.append(i); i = j
+  return offs, i
+
+def _indexKey(st) -> bytes:
+  return RECORDS_INDEX_MAGIC + b''.join(
+    v.to_bytes(8, 'little') for v in (st.st_size, st.st_mtime_ns))
+
+def _loadIndex(path: str, key: bytes):
+  """Return (offs, end) of the index file path if it has key, else None."""
+  try:
+    with open(path, 'rb') as f: b = f.read()
+  except OSError: return None
+  n = len(key) + 8
+  if not b.startswith(key) or len(b) < n or (len(b) - n) % 8: return None
+  offs = array.array('Q'); offs.frombytes(b[n:])
+  if sys.byteorder == 'big': offs.byteswap()
+  return offs, int.from_bytes(b[len(key):n], 'little')
+
+def _storeIndex(path: str, key: bytes, offs: array.array, end: int):
+  if sys.byteorder == 'big': offs = array.array('Q', offs); offs.byteswap()
+  try:
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(key); f.write(end.to_bytes(8, 'little')); f.write(offs)
+    os.replace(tmp, path)
+  except OSError: pass # the index is only an optimization
+
+def _footerIndex(mv: memoryview):
+  """Return (offs, end) of the index footer ending mv, else None."""
+  size = len(mv) - len(RECORDS_FOOTER_MAGIC) - 8
+  if size < 1 or mv[size + 8:] != RECORDS_FOOTER_MAGIC: return None
+  end = int.from_bytes(mv[size:size + 8], 'little')
+  if end >= size or (size - end - 1) % 8: return None
+  if mv[end] != RECORDS_FOOTER_START: return None
+  offs = array.array('Q'); offs.frombytes(mv[end + 1:size])
+  if sys.byteorder == 'big': offs.byteswap()
+  try: # the footer must agree with the records
+    if (offs[0] if offs else end) or offs and zoab_skip(mv, offs[-1]) != end:
+      return None
+  except Eof: return None
+  return offs, end
+
+class ZoabRecords:
+  """Random access to the records of a mapped file (see open_records).
+
+  Records are decoded with from_zoab_buf, or ty.decode if ty is given. Slices
+  are views sharing the same mapping. With copy=False decoded data references
+  the mapping, which stays open until the last of it is gone.
+  """
+  __slots__ = ('path', 'buf', 'end', 'ty', 'copy', '_offs', '_mm')
+
+  def __len__(self): return len(self._offs)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      v = object.__new__(ZoabRecords)
+      v.path, v.buf, v.end, v.ty, v.copy = (
+        self.path, self.buf, self.end, self.ty, self.copy)
+      v._offs, v._mm = self._offs[i], None # only the owner closes
+      return v
+    return self._decode(self._offs[i])
+
+  def __iter__(self):
+    for off in self._offs: yield self._decode(off)
+
+  def _decode(self, off: int):
+    if self.ty is not None: return self.ty.decode(self.buf, off)
+    return from_zoab_buf(self.buf, off, self.copy)[0]
+
+  def offset(self, i: int) -> int:
+    """The offset of record i in the file."""
+    return self._offs[i]
+
+  def raw(self, i: int) -> memoryview:
+    """The (undecoded) zoab bytes of record i."""
+    off = self._offs[i]
+    return self.buf[off:zoab_skip(self.buf, off)]
+
+  def close(self):
+    if self._mm is None: return
+    self.buf.release()
+    try: self._mm.close()
+    except BufferError: pass # decoded data still uses it
+    self._mm = None
+
+  def __enter__(self): return self
+  def __exit__(self, *exc): self.close()
+
+  def __repr__(self): return f'ZoabRecords({self.path!r}, len={len(self._offs)})'
+
+def open_records(path: str, index=None, ty=None, copy=False) -> ZoabRecords:
+  """Map the file of zoab records at path and index the start of each record.
+
+  The index footer (see RecordWriter) is used if the file has one. Else index
+  is the path of an index file to load, or to (re)write if it is missing or was
+  built from a different version of the file (True is path + '.zidx').
+  A truncated last record (i.e. of a file being written) is left out: end is
+  the offset just past the last whole record.
+  """
+  r = object.__new__(ZoabRecords)
+  r.path, r.ty, r.copy, r._mm = path, ty, copy, None
+  with open(path, 'rb') as f:
+    st = os.fstat(f.fileno())
+    if st.st_size: r._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  r.buf = memoryview(r._mm if r._mm is not None else b'')
+  if index is True: index = path + '.zidx'
+  key = index and _indexKey(st)
+  loaded = _footerIndex(r.buf) or index and _loadIndex(index, key)
+  if loaded: r._offs, r.end = loaded
+  else:
+    r._offs, r.end = zoab_index(r.buf)
+    if index: _storeIndex(index, key, r._offs, r.end)
+  return r
+
+class Fsync(Enum):
+  NEVER = 0 # leave it to the OS
+  CLOSE = 1 # once the footer is written
+  FLUSH = 2 # after every batch
+
+def _encValue(v, out: bytearray):
+  """Append the zoab of a ZoaRaw, zty or toZ() value to out."""
+  if isinstance(v, ZTy):       type(v)._enc(v, out)
+  elif isinstance(v, ZoaRaw):  out += encode_zoab(v)
+  else:                        out += encode_zoab(v.toZ())
+
+class RecordWriter:
+  """Append records to the file at path, ending it with an index footer.
+
+  Records are encoded into a buffer which is written once it holds batch
+  bytes. Values are ZoaRaw, zty values (encoded directly) or anything with
+  toZ(). An existing file is appended to: its footer, or a truncated last
+  record left by a crash, is removed first.
+  """
+  def __init__(self, path: str, batch: int = RECORDS_BATCH,
+               fsync: Fsync = Fsync.CLOSE):
+    self.path, self.batch, self.fsync = path, batch, fsync
+    self._offs, self._end = array.array('Q'), 0
+    if os.path.exists(path):
+      with open_records(path) as recs: self._offs, self._end = recs._offs, recs.end
+    self._f = open(path, 'ab')
+    self._f.truncate(self._end)
+    self._buf = bytearray()
+
+  def __len__(self): return len(self._offs)
+
+  def write(self, v):
+    buf = self._buf; n = len(buf)
+    self._offs.append(self._end + n)
+    try: _encValue(v, buf)
+    except BaseException: # leave nothing of a value that failed to encode
+      del buf[n:]; self._offs.pop()
+      raise
+    if len(buf) >= self.batch: self.flush()
+
+  def flush(self):
+    self._f.write(self._buf); self._end += len(self._buf)
+    self._buf.clear()
+    self._f.flush()
+    if self.fsync is Fsync.FLUSH: os.fsync(self._f.fileno())
+
+  def close(self):
+    if self._f.closed: return
+    self.flush()
+    offs = self._offs
+    if sys.byteorder == 'big': offs = array.array('Q', offs); offs.byteswap()
+    self._f.write(bytes((RECORDS_FOOTER_START,)))
+    self._f.write(offs)
+    self._f.write(self._end.to_bytes(8, 'little') + RECORDS_FOOTER_MAGIC)
+    self._f.flush()
+    if self.fsync is not Fsync.NEVER: os.fsync(self._f.fileno())
+    self._f.close()
+
+  def __enter__(self): return self
+  def __exit__(self, *exc): self.close()
+
+  def __repr__(self): return f'RecordWriter({self.path!r}, len={len(self._offs)})'
+
+################################################################################
+# Streams: values framed by ZOA_START (the start signal C devices send before
+# each value on serial IO, see zoac/zoa.h) over asyncio streams. The reader
+# skips anything before a ZOA_START and resynchronizes on the next one after a
+# corrupt value, so a device can be read from the middle of its output. A
+# header of ZOA_START[0] (empty joined data, which encoders never write) within
+# a value is corrupt: it is where a device that restarted began a new value.
+
+ZOA_START = b'\x80\x03'
+STREAM_CHUNK = 0x10000
+STREAM_MAX_SIZE = 0x100000 # larger values are treated as corrupt
+
+class ZoabStreamReader:
+  """Read values framed by ZOA_START from an asyncio.StreamReader.
+
+  Values are decoded as ZoaRaw, or as ty if given. A value that can't be
+  decoded or is larger than maxSize is dropped: skipped counts the bytes
+  dropped and corrupt the values.
+  """
+  def __init__(self, reader, ty=None, maxSize: int = STREAM_MAX_SIZE,
+               chunk: int = STREAM_CHUNK):
+    self.reader, self.ty, self.maxSize, self.chunk = reader, ty, maxSize, chunk
+    self.skipped = 0; self.corrupt = 0
+    self._buf = bytearray(); self._i = 0
+
+  async def _more(self) -> bool:
+    b = await self.reader.read(self.chunk)
+    self._buf += b
+    return bool(b)
+
+  async def read(self):
+    """Return the next value. Raises Eof at the end of the stream."""
+    buf = self._buf
+    if self._i >= self.chunk: del buf[:self._i]; self._i = 0
+    while True:
+      s = buf.find(ZOA_START, self._i)
+      if s < 0: # drop all but a trailing ZOA_START[0]
+        keep = len(buf) - (buf[-1:] == ZOA_START[:1])
+        self.skipped += keep - self._i
+        del buf[:keep]; self._i = 0
+        if not await self._more(): raise Eof()
+        continue
+      self.skipped += s - self._i; self._i = s
+      j, pending, resync = s + 2, 1, s + 1 # a resumable zoab_skip
+      while pending or j > len(buf):
+        if j - s - 2 > self.maxSize: break
+        if j >= len(buf):
+          if not await self._more(): raise Eof()
+          continue
+        meta = buf[j]; j += 1
+        if meta == ZOA_JOIN: resync = j - 1; break # a new value starts there
+        if ZOA_ARR & meta: pending += ZOA_LEN_MASK & meta
+        else:              j += ZOA_LEN_MASK & meta
+        if not ZOA_JOIN & meta: pending -= 1
+      else:
+        try:
+          with memoryview(buf) as mv, mv[s + 2:j] as v:
+            if self.ty is None: z = from_zoab_buf(v, 0, True)[0]
+            else:               z = self.ty.decode(v)
+          self._i = j
+          return z
+        except (ValueError, TypeError, KeyError, IndexError, Eof): pass
+      self.corrupt += 1; self.skipped += resync - s; self._i = resync
+
+  def __aiter__(self): return self
+
+  async def __anext__(self):
+    try: return await self.read()
+    except Eof: raise StopAsyncIteration
+
+class ZoabStreamWriter:
+  """Write values framed by ZOA_START to an asyncio.StreamWriter.
+
+  Values are ZoaRaw, zty values (encoded directly) or anything with toZ().
+  """
+  def __init__(self, writer): self.writer = writer
+
+  def write(self, v):
+    out = bytearray(ZOA_START); _encValue(v, out)
+    self.writer.write(out)
+
+  async def drain(self): await self.writer.drain()
+
+  async def send(self, v):
+    """Write v and wait until the transport can take more."""
+    self.write(v); await self.writer.drain()
+
+  async def close(self):
+    self.writer.close(); await self.writer.wait_closed()
+
+################################################################################
+# Zoat: the text format (see README). ZoatReader reads zoat from a binary file
+# (or bytes) in chunks, yielding each top-level value as ZoaRaw once it (and
+# anything joined to it with |+) is complete. Variables (|.) are not supported.
+
+ZOAT_CHUNK = 0x10000
+RE_ZOAT_WS = re.compile(rb'[ \t\r\n]*')
+RE_ZOAT_INDENT = re.compile(rb'[ \t]*')
+RE_ZOAT_TEXT = re.compile(rb'[^|{}\\\n]*')
+RE_ZOAT_INT = re.compile(rb'-?[0-9][0-9a-zA-Z_]*')
+RE_ZOAT_QUOTES = re.compile(rb"'+")
+RE_ZOAT_BLOCK = re.compile(rb'\{\*|\*\}')
+# Fast path: skip whitespace and plain pipes, then match data without escapes or
+# newlines if its end is in the buffer, or a { or }.
+RE_ZOAT_FAST = re.compile(
+  rb'(?:[ \t\r\n]+|\|(?=[ \t\r\n|{}]))*'
+  rb'(?:([^|{}\\\n \t\r][^|{}\\\n]*)(?=[|{}])|(\{)(?=[^*])|(\}))?')
+ZOAT_ESCAPES = {ord(k): v for k, v in {
+  'n': b'\n', 't': b'\t', 's': b' ', ' ': b' ',
+  '|': b'|', '{': b'{', '}': b'}', '\\': b'\\'}.items()}
+ZOAT_END = frozenset(b'|{}')
+ZOAT_WS = frozenset(b' \t\r\n')
+
+class ZoatReader:
+  """Pull reader of zoat: iterate it for the top-level values."""
+  def __init__(self, f, chunk: int = ZOAT_CHUNK, path=None):
+    if isbytes(f): self.f, self.buf = None, bytes(f)
+    else:          self.f, self.buf = f, b''
+    self.chunk, self.path = chunk, path
+    self.i = 0
+    self._line, self._col = 0, 0 # of buf[0]
+
+  def error(self, msg):
+    line = self._line + self.buf.count(b'\n', 0, self.i) + 1
+    raise ParseError(line, msg, self.path)
+
+  def _more(self) -> bool:
+    """Read another chunk, dropping the read part of buf."""
+    if self.f is None: return False
+    b = self.f.read(self.chunk)
+    if not b: self.f = None; return False
+    k = self.buf.rfind(b'\n', 0, self.i)
+    self._col = self.i - k - 1 if k >= 0 else self._col + self.i
+    self._line += self.buf.count(b'\n', 0, self.i)
+    self.buf = self.buf[self.i:] + b; self.i = 0
+    return True
+
+  def _need(self, n: int) -> bool:
+    """Make n bytes available at i, False at EOF."""
+    while len(self.buf) - self.i < n:
+      if not self._more(): return False
+    return True
+
+  def _match(self, regex) -> bytes:
+    """Match regex at i (which may need more chunks), consuming it."""
+    while True:
+      m = regex.match(self.buf, self.i)
+      if m is None: return None
+      if m.end() < len(self.buf) or not self._more():
+        self.i = m.end(); return m.group()
+
+  def __iter__(self) -> Iterable[ZoaRaw]:
+    PIPE, OPEN, CLOSE, STAR, PLUS, QUOTE, ESC = b"|{}*+'\\"
+    top = into = [] # into: the values of the current array
+    stk = [] # (into, arr, join) of each open array
+    join = False # the next value joins the previous (|+)
+    fast = RE_ZOAT_FAST.match
+    while True:
+      if len(top) > 1: yield top.pop(0) # nothing can join it anymore
+      m = fast(self.buf, self.i); self.i = m.end()
+      k = m.lastindex
+      if k == 1: z = ZoaRaw(bytearray(m.group(1)), None)
+      elif k == 2:
+        z = ZoaRaw(None, []); stk.append((into, z, join))
+        into, join = z.arr, False
+        continue
+      elif k == 3:
+        if not stk: self.error("Unmatched }")
+        into, z, join = stk.pop()
+      elif not self._need(1): break
+      elif (c := self.buf[self.i]) in ZOAT_WS: continue # at the end of buf
+      elif c == PIPE:
+        self.i += 1
+        if not self._need(1): continue
+        c = self.buf[self.i]
+        if c in ZOAT_WS or c in ZOAT_END: continue
+        if   c == PLUS:
+          self.i += 1; join = True
+          if self._joinsArr(): continue
+          z = self._data()
+        elif c == QUOTE: z = self._raw()
+        elif c == ESC:   z = self._data()
+        elif c == STAR:  self._lineComment(); continue
+        elif c == ord('.'): self.error("zoat variables (|.) are not supported")
+        elif c == ord('-') or ord('0') <= c <= ord('9'): z = self._int()
+        else: self.error(f"Unknown command: |{chr(c)}")
+      elif c == OPEN: # {* or at the end of buf
+        if self._need(2) and self.buf[self.i + 1] == STAR:
+          self._blockComment(); continue
+        self.i += 1
+        z = ZoaRaw(None, []); stk.append((into, z, join))
+        into, join = z.arr, False
+        continue
+      elif c == CLOSE: continue # after a refill, the fast path has it
+      else: z = self._data()
+      if not join: into.append(z); continue
+      join = False
+      prev = into[-1] if into else None
+      if prev is None or (prev.data is None) != (z.data is None):
+        self.error("|+ must join a value of the same type")
+      if z.data is None: prev.arr.extend(z.arr)
+      else:              prev.data.extend(z.data)
+    if stk: self.error("Unclosed {")
+    yield from top
+
+  def _joinsArr(self) -> bool:
+    """Whether the value after |+ is an array. Else it is data, which starts
+    immediately (including any whitespace)."""
+    j = self.i
+    while True:
+      j = RE_ZOAT_WS.match(self.buf, j).end()
+      if j < len(self.buf): break
+      j -= self.i
+      if not self._more(): return False
+      j += self.i
+    if self.buf[j] != ord('{'): return False
+    self.i = j; return True
+
+  def _data(self) -> ZoaRaw:
+    out = bytearray()
+    while True:
+      buf, i = self.buf, self.i
+      j = RE_ZOAT_TEXT.match(buf, i).end()
+      out += buf[i:j]; self.i = j
+      if j == len(buf):
+        if self._more(): continue
+        break
+      c = buf[j]
+      if c == ord('\n'):
+        self._match(RE_ZOAT_WS)
+        if not self._need(1) or self.buf[self.i] in ZOAT_END: break
+        out.append(ord(' '))
+      elif c == ord('\\'):
+        if not self._need(2): self.error("EOF in escape")
+        e = self.buf[self.i + 1]; self.i += 2
+        if e == ord('\n'): self._match(RE_ZOAT_INDENT); continue
+        if e == ord('x'):
+          if not self._need(2): self.error("EOF in escape")
+          try: out.append(int(self.buf[self.i:self.i + 2], 16))
+          except ValueError: self.error("Invalid \\x escape")
+          self.i += 2; continue
+        esc = ZOAT_ESCAPES.get(e)
+        if esc is None: self.error(f"Unknown escape: \\{chr(e)}")
+        out += esc
+      else: break # | { or }
+    return ZoaRaw(out, None)
+
+  def _int(self) -> ZoaRaw:
+    self._need(2) # |-<digit>
+    t = self._match(RE_ZOAT_INT)
+    if t is None: self.error("Unknown command: |-")
+    neg = t.startswith(b'-'); t = t[neg:]
+    if t[:2] in (b'0c', b'0C') and len(t) == 3: v = t[2]
+    else:
+      try: v = int(t, 0)
+      except ValueError: self.error(f"Invalid int: {t}")
+    return Int(-v if neg else v).toZ()
+
+  def _raw(self) -> ZoaRaw:
+    k = self.buf.rfind(b'\n', 0, self.i)
+    col = (self.i - k - 1 if k >= 0 else self._col + self.i) - 1 # of the |
+    end = self._match(RE_ZOAT_QUOTES)
+    j = self.buf.find(end, self.i)
+    while j < 0:
+      j = max(0, len(self.buf) - self.i - len(end) + 1)
+      if not self._more(): self.error("Unclosed raw block")
+      j = self.buf.find(end, self.i + j)
+    text = self.buf[self.i:j]; self.i = j + len(end)
+    if col > 0: text = re.sub(rb'\n[ \t]{0,%d}' % col, b'\n', text)
+    if text.startswith(b'\n'): text = text[1:]
+    if text.endswith(b'\n'):   text = text[:-1]
+    return ZoaRaw.new_data(bytearray(text))
+
+  def _lineComment(self):
+    while True:
+      k = self.buf.find(b'\n', self.i)
+      if k >= 0: self.i = k + 1; return
+      self.i = len(self.buf)
+      if not self._more(): return
+
+  def _blockComment(self):
+    depth, pos = 0, self.i
+    while True:
+      m = RE_ZOAT_BLOCK.search(self.buf, pos)
+      if m is None: # keep a last '{' or '*', it may start a token
+        self.i = max(pos, len(self.buf) - 1)
+        if not self._more(): self.error("Unclosed {*")
+        pos = self.i; continue
+      pos = m.end()
+      depth += 1 if m.group() == b'{*' else -1
+      if not depth: self.i = pos; return
+
+def from_zoat(f) -> List[ZoaRaw]:
+  """Read all the top-level values of the zoat in f (a binary file or bytes)."""
+  return list(ZoatReader(f))
+
+# ZoatWriter writes zoat to a binary file in chunks, compact (one line per
+# top-level value) or indented. Data is written with escapes, or as a |'''
+# raw block when it is multi-line text (indented only).
+
+# The escape of each byte in data. Bytes >= 0x80 are only escaped if they are
+# not part of a valid utf-8 character, so that the escaping of data doesn't
+# depend on how it is split into parts. A first ' ' or '*' is also escaped.
+_ZOAT_ESCAPE = {v[0]: b'\\' + bytes([k])
+                for k, v in ZOAT_ESCAPES.items() if k not in b's '}
+ZOAT_ESCAPE = [_ZOAT_ESCAPE.get(c, bytes([c]) if 0x20 <= c < 0x7F else b'\\x%02X' % c)
+               for c in range(0x100)]
+_UTF8_CHAR = (rb'[\xC2-\xDF][\x80-\xBF]|\xE0[\xA0-\xBF][\x80-\xBF]'
+              rb'|[\xE1-\xEC\xEE\xEF][\x80-\xBF]{2}|\xED[\x80-\x9F][\x80-\xBF]'
+              rb'|\xF0[\x90-\xBF][\x80-\xBF]{2}|[\xF1-\xF3][\x80-\xBF]{3}'
+              rb'|\xF4[\x80-\x8F][\x80-\xBF]{2}')
+# (runs are limited: bytes.join uses ~80 bytes per item)
+RE_ZOAT_ESCAPE = re.compile(rb'((?:' + _UTF8_CHAR + rb')+)' # kept
+  rb'|(?:[\x00-\x1f\x7f|{}\\]|(?!' + _UTF8_CHAR + rb')[\x80-\xff]){1,1024}')
+RE_ZOAT_NOT_RAW = re.compile(rb'[\x00-\x08\x0b-\x1f\x7f]')
+
+def _zoatEscapeRun(m) -> bytes:
+  if m.group(1): return m.group(1)
+  return b''.join(map(ZOAT_ESCAPE.__getitem__, m.group()))
+
+def _zoatEscape(b, first: bool) -> bytes:
+  out = RE_ZOAT_ESCAPE.sub(_zoatEscapeRun, b)
+  if first and out[:1] in (b' ', b'*'): out = b'\\x%02X' % out[0] + out[1:]
+  return out
+
+def _utf8Len(lead: int) -> int:
+  return 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+
+class ZoatWriter:
+  """Streaming zoat writer: call write(value) then flush().
+
+  indent=None is compact, else the number of spaces to indent arrays by. Use
+  startArr/endArr/data/int (and dataStart/dataPart/dataEnd for data in parts)
+  to write values piece by piece.
+  """
+  def __init__(self, f, indent: int = None, chunk: int = ZOAT_CHUNK):
+    self.f, self.indent, self.chunk = f, indent, chunk
+    self.out = bytearray()
+    self.depth = 0
+    self._last = b'' # the last token written: b'' { } | or '
+    self._part = None # data not yet escaped
+    self._first = True # nothing of the data is written yet
+
+  def flush(self):
+    self.f.write(self.out); self.out = bytearray()
+
+  def _flushIf(self):
+    if len(self.out) >= self.chunk: self.flush()
+
+  def _value(self):
+    """Write the separator before a value."""
+    if not self.depth:
+      if self._last: self.out += b'\n'
+    elif self.indent is not None:
+      self.out += b'\n' + b' ' * (self.indent * self.depth)
+    elif self._last != b'{': self.out += b' '
+
+  def startArr(self):
+    self._value(); self.out += b'{'
+    self.depth += 1; self._last = b'{'
+
+  def endArr(self):
+    self.depth -= 1
+    if self.indent is not None and self._last != b'{':
+      self.out += b'\n' + b' ' * (self.indent * self.depth)
+    self.out += b'}'; self._last = b'}'
+    self._flushIf()
+
+  def int(self, v: int):
+    self._value(); self.out += b'|%d|' % v; self._last = b'|'
+    self._flushIf()
+
+  def data(self, b):
+    if self.indent is not None and b'\n' in b and not RE_ZOAT_NOT_RAW.search(b):
+      try: str(b, 'utf-8'); return self._raw(b)
+      except UnicodeDecodeError: pass
+    self.dataStart(); self.dataPart(b); self.dataEnd()
+
+  def _raw(self, b):
+    self._value()
+    q = b"'" * max(3, 1 + max(map(len, re.findall(rb"'+", b)), default=0))
+    pad = b' ' * (self.indent * self.depth)
+    self.out += b'|' + q + b'\n'
+    self.out += b'\n'.join(pad + l if l else l for l in b.split(b'\n'))
+    self.out += b'\n' + pad + q; self._last = b"'"
+    self._flushIf()
+
+  def dataStart(self):
+    self._value(); self._part = bytearray(); self._first = True
+
+  def dataPart(self, b):
+    self._part += b
+    if len(self._part) >= self.chunk: self._escape(final=False)
+
+  def dataEnd(self):
+    self._escape(final=True); self._part = None
+    self.out += b'|0|' if self._first else b'|' # |0 is empty data
+    self._last = b'|'
+    self._flushIf()
+
+  def _escape(self, final: bool):
+    b, k = self._part, len(self._part)
+    if not final: # don't split a utf-8 character
+      j = k - 1
+      while j > k - 4 and j > 0 and 0x80 <= b[j] < 0xC0: j -= 1
+      if b[j] >= 0xC0 and j + _utf8Len(b[j]) > k: k = j
+    if not k: return
+    self.out += _zoatEscape(b[:k], self._first); self._first = False
+    del b[:k]
+    self._flushIf()
+
+  def write(self, v):
+    """Write a ZoaRaw, typed (ZTy) or python (bytes and lists) value."""
+    if isinstance(v, Int): return self.int(v)
+    if isinstance(v, ZTy): v = v.toZ()
+    elif not isinstance(v, ZoaRaw): v = ZoaRaw.frPyDeep(v)
+    if v.data is not None: return self.data(v.data)
+    self.startArr(); stk = [iter(v.arr)]
+    while stk:
+      for z in stk[-1]:
+        if z.data is not None: self.data(z.data); continue
+        self.startArr(); stk.append(iter(z.arr))
+        break
+      else: stk.pop(); self.endArr()
+
+def to_zoat(v, indent: int = None) -> bytes:
+  """The zoat of the value v (see ZoatWriter.write)."""
+  f = io.BytesIO(); w = ZoatWriter(f, indent)
+  w.write(v); w.flush()
+  return f.getvalue()
+
+def zoab_to_zoat(fin, fout, indent: int = None, chunk: int = ZOAT_CHUNK):
+  """Write the zoab values of the binary file fin as zoat to fout.
+
+  Values are converted as they are read, so memory stays constant regardless
+  of their size. The output doesn't depend on chunk and is the same as
+  to_zoat's, except that data is never written as a raw block.
+  """
+  w = ZoatWriter(fout, indent, chunk)
+  stk = [] # (rem, join) of the parents of the current arr
+  rem = join = 0 # values remaining in the current arr segment, it has join
+  need = djoin = 0 # bytes remaining in the current data segment, it has join
+  inData = False
+  def done(): # a value is done, end the arrs it completes
+    nonlocal rem, join
+    while stk and not (rem or join):
+      w.endArr(); rem, join = stk.pop()
+  while b := fin.read(chunk):
+    mv = memoryview(b); end = len(mv); i = 0
+    while True:
+      if need:
+        j = min(end, i + need)
+        w.dataPart(mv[i:j]); need -= j - i; i = j
+        if need: break
+        if not djoin: w.dataEnd(); inData = False; done()
+        continue
+      if i >= end: break
+      meta = mv[i]; i += 1
+      if inData: # joined data
+        if ZOA_ARR & meta: raise ValueError("join different types")
+      elif stk and not rem: # joined arr
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        rem, join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+        if not (rem or join): w.endArr(); rem, join = stk.pop(); done()
+        continue
+      else: # new value
+        if stk: rem -= 1
+        if ZOA_ARR & meta:
+          w.startArr(); stk.append((rem, join))
+          rem, join = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+          if not (rem or join): w.endArr(); rem, join = stk.pop(); done()
+          continue
+        w.dataStart(); inData = True
+      need, djoin = ZOA_LEN_MASK & meta, ZOA_JOIN & meta
+      if not (need or djoin): w.dataEnd(); inData = False; done()
+  if inData or stk: raise Eof("zoab ended in a value")
+  w.flush()
+
+################################################################################
+# Direct Codec: typed values <-> zoab bytes without ZoaRaw
+
+def _enc_data(out: bytearray, data):
+  """Append data to out."""
+  n = len(data)
+  if n <= 63: out.append(n); out += data; return
+  i = len(out); out += bytes(_data_len(n))
+  _encode_data_into(data, out, i)
+
+def _enc_seg(out: bytearray, n: int, k: int):
+  """Append the arr segment header that comes before item k (of n)."""
+  remaining = n - k
+  out.append(ZOA_ARR | ZOA_JOIN | 63 if remaining > 63 else ZOA_ARR | remaining)
+
+def _enc_arr(out: bytearray, n: int, items: Iterable[Any], enc):
+  """Append an arr of n items, each appended with enc(item, out)."""
+  if n <= 63:
+    out.append(ZOA_ARR | n)
+    for v in items: enc(v, out)
+    return
+  for k, v in enumerate(items):
+    if not k % 63: _enc_seg(out, n, k)
+    enc(v, out)
+
+def _dec_data(mv: memoryview, i: int):
+  """Decode data at mv[i]. Returns (memoryview or bytearray, end)."""
+  meta = mv[i]; i += 1
+  if ZOA_ARR & meta: raise TypeError(f"Expected data at {i - 1}")
+  j = i + (ZOA_LEN_MASK & meta)
+  if ZOA_JOIN & meta: return _joinData(mv, i, j, len(mv))
+  if j > len(mv): raise Eof()
+  return mv[i:j], j
+
+def _dec_arr(mv: memoryview, i: int, dec, vdec=None):
+  """Decode an arr at mv[i], decoding each item with dec(mv, i).
+
+  If vdec is given then items alternate between dec and vdec (i.e. a map).
+  Returns (list, end).
+  """
+  meta = mv[i]; i += 1
+  if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+  out = []; decs = (dec, vdec); k = 0
+  while True:
+    if vdec is None:
+      for _ in range(ZOA_LEN_MASK & meta):
+        v, i = dec(mv, i); out.append(v)
+    else:
+      for _ in range(ZOA_LEN_MASK & meta):
+        v, i = decs[k](mv, i); out.append(v); k ^= 1
+    if not ZOA_JOIN & meta: return out, i
+    meta = mv[i]; i += 1
+    if not ZOA_ARR & meta: raise ValueError("join different types")
+
+def _dec_fixed(mv: memoryview, i: int, n: int) -> int:
+  """Check that mv[i] is an unjoined arr of length n and return i + 1."""
+  if mv[i] != ZOA_ARR | n:
+    raise TypeError(f"Expected arr of length {n} at {i}")
+  return i + 1
+
+def _skip(mv: memoryview, i: int) -> int:
+  """zoab_skip with a fast path for (unjoined) data."""
+  meta = mv[i]
+  if meta < ZOA_ARR: return i + 1 + meta
+  return zoab_skip(mv, i)
+
+def _enc_zid(v: Tuple[int, Any, Any], out: bytearray):
+  """Append a struct field with an id: [zid, value]."""
+  zid, ty, value = v
+  out.append(ZOA_ARR | 2)
+  Int._enc(zid, out)
+  ty._enc(value, out)
+
+def _posArgErr(name) -> ValueError:
+  return ValueError(
+    f"{name} has value after previous positional arg wasn't specified")
+
+def _variantErr(cls, k: int) -> ValueError:
+  return ValueError(f"{cls.name}: invalid variant {k}")
+
+def _identifier(name) -> str:
+  """The field (or variant) name as a str, which must be an identifier as
+  generated code uses it as one.
+  """
+  n = name if isinstance(name, str) else name.decode('utf-8')
+  if not n.isidentifier(): raise TypeError(f'Field names must be valid identifiers: {n!r}')
+  if keyword.iskeyword(n): raise TypeError(f'Field names must not be keywords: {n!r}')
+  return n
+
+def _multiVarErr(variants, k: int, j: int) -> ValueError:
+  return ValueError(f"Multiple variants set: {variants[k]} and {variants[j]}")
+
+def _codegen(src: str, ns: dict) -> dict:
+  """exec the generated src in namespace ns, returning ns."""
+  exec(compile(src, '<zoa codegen>', 'exec'), ns)
+  return ns
+
+CODEC_METHODS = ('toZ', 'frZ', '_enc', '_dec')
+
+class _LazyCodec:
+  """Stands in for a generated method: the first access generates it (by
+  calling cls.<gen>(), by default the type's codecs) and then returns the real
+  method.
+  """
+  __slots__ = ('name', 'gen')
+  def __init__(self, name, gen='_generate'): self.name, self.gen = name, gen
+  def __get__(self, obj, cls=None):
+    cls = cls or type(obj)
+    getattr(cls, self.gen)()
+    return getattr(cls if obj is None else obj, self.name)
+
+def _lazyCodecs(cls):
+  """(Re)generate cls's codecs on first use."""
+  for m in CODEC_METHODS: setattr(cls, m, _LazyCodec(m))
+
+def _clearCodecs(cls):
+  """Remove cls's generated codecs, leaving the generic ones."""
+  for m in CODEC_METHODS:
+    if m in vars(cls): delattr(cls, m)
+
+def _codecRef(ns: dict, ty, key: str, meth: str) -> str:
+  """Put ty's codec meth into ns and return the expression to call it.
+
+  Struct and enum codecs can be regenerated so they are looked up on the type
+  at call time. Everything else is bound once.
+  """
+  if hasattr(ty, '_compile'): ns[key] = ty; return f'{key}.{meth}'
+  ns[key] = getattr(ty, meth); return key
+
+class _tymethod:
+  """A classmethod that leaves instances with their builtin method of the same
+  name (i.e. Str('a').encode() is still str.encode).
+
+  On instances without one, calling it raises TypeError.
+  """
+  def __init__(self, fn): self.fn = fn
+  def __set_name__(self, owner, name): self.name = name
+  def __get__(self, obj, cls=None):
+    if obj is None: return self.fn.__get__(cls)
+    try: return getattr(super(ZTy, obj), self.name)
+    except AttributeError: pass
+    name, arg = type(obj).__name__, 'value' if self.name == 'encode' else 'buf'
+    def notBuiltin(*args, **kwargs):
+      raise TypeError(f"{name} instances have no {self.name}(): "
+                      f"use {name}.{self.name}({arg})")
+    return notBuiltin
+
+class ZTy:
+  """Mixin giving zty types a direct zoab codec.
+
+  Types implement _enc(value, out) which appends the zoab encoding of value to
+  the bytearray out and _dec(mv, i) which decodes the value at memoryview
+  offset i and returns (value, end). The bytes are identical to
+  value.toZ().serialize().
+  """
+  __slots__ = ()
+
+  @_tymethod
+  def encode(cls, value) -> bytes:
+    out = bytearray()
+    cls._enc(value, out)
+    return bytes(out)
+
+  @_tymethod
+  def decode(cls, buf, i: int = 0, fields=None):
+    """Decode the value at buf[i].
+
+    If fields is given only those fields (of a struct, or of the structs in an
+    arr) or keys (of a map) are decoded: the rest are skipped by their headers
+    and left out (None in a struct).
+    """
+    mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+    try:
+      if fields is None: return cls._dec(mv, i)[0]
+      return cls._proj(mv, i, fields)[0]
+    except IndexError: raise Eof()
+
+  @classmethod
+  def _proj(cls, mv: memoryview, i: int, fields):
+    """Like _dec but only decodes fields (see decode)."""
+    raise TypeError(f"{cls.name} has no fields to select")
+
+################################################################################
+# Interning: an opt-in decode mode where repeated values (tag names, enum-ish
+# strings, map keys) share one instance instead of each being a new object.
+
+INTERN_MAX_SIZE = 0x10000 # values in the table
+INTERN_MAX_LEN = 0x40     # longer data (and strs) are not interned
+INTERN_MAX_INT = 0x10000  # larger (absolute) ints are not interned
+
+_interner = contextvars.ContextVar('zoa.interner', default=None)
+
+class Interner:
+  """While active (with Interner() as it:) equal Str, Data and small Int values
+  decoded in this context (thread or task) are the same instance.
+
+  The table keeps up to maxSize values and starts over when it is full. hits
+  and misses count the lookups (see hitRate).
+  """
+  def __init__(self, maxSize: int = INTERN_MAX_SIZE, maxLen: int = INTERN_MAX_LEN):
+    self.maxSize, self.maxLen = maxSize, maxLen
+    self.hits = self.misses = 0
+    self._strs, self._datas, self._ints = {}, {}, {}
+    self._tokens = []
+
+  def __enter__(self): self._tokens.append(_interner.set(self)); return self
+  def __exit__(self, *exc): _interner.reset(self._tokens.pop())
+
+  def __len__(self): return len(self._strs) + len(self._datas) + len(self._ints)
+
+  @property
+  def hitRate(self) -> float:
+    n = self.hits + self.misses
+    return self.hits / n if n else 0.0
+
+  def __repr__(self):
+    return (f'Interner(len={len(self)}, hits={self.hits}, misses={self.misses},'
+            f' hitRate={self.hitRate:.3f})')
+
+  def _add(self, table: dict, key, v):
+    self.misses += 1
+    if len(self) >= self.maxSize:
+      self._strs.clear(); self._datas.clear(); self._ints.clear()
+    table[key] = v
+    return v
+
+  def str(self, b) -> 'Str':
+    """The Str of the utf-8 b."""
+    if len(b) > self.maxLen: return Str(str(b, 'utf-8'))
+    key = bytes(b); v = self._strs.get(key)
+    if v is None: return self._add(self._strs, key, Str(key.decode('utf-8')))
+    self.hits += 1; return v
+
+  def data(self, b) -> 'Data':
+    if len(b) > self.maxLen: return Data(b)
+    key = bytes(b); v = self._datas.get(key)
+    if v is None: return self._add(self._datas, key, Data(key))
+    self.hits += 1; return v
+
+  def int(self, v: int) -> 'Int':
+    if not -INTERN_MAX_INT <= v <= INTERN_MAX_INT: return Int(v)
+    i = self._ints.get(v)
+    if i is None: return self._add(self._ints, v, Int(v))
+    self.hits += 1; return i
+
 ################################################################################
 # Native Types (zty)
 
@@ -265,7 +1741,7 @@ def intBytesLen(v: int) -> int:
   if v <= 0xFFFFFFFF: return 4
   raise ValueError(f"Int too large: {v}")
 
-class Int(int):
+class Int(ZTy, int):
   name = 'Int'
 
   @classmethod
@@ -275,8 +1751,10 @@ class Int(int):
   def frZ(cls, raw: ZoaRaw) -> int:
     if raw.arr:
       assert 1 == len(raw.arr)
-      return -_rawInt(raw.arr[0].data)
-    return _rawInt(raw.data)
+      v = -_rawInt(raw.arr[0].data)
+    else: v = _rawInt(raw.data)
+    it = _interner.get()
+    return v if it is None else it.int(v)
 
   def toZ(self) -> ZoaRaw:
     if 0 == self: return ZoaRaw.new_data(b'')
@@ -286,6 +1764,24 @@ class Int(int):
     if self >= 0: return z
     return ZoaRaw.new_arr([z])
 
+  @classmethod
+  def _enc(cls, v: int, out: bytearray):
+    if v < 0: out.append(ZOA_ARR | 1); v = -v
+    elif not v: out.append(0); return
+    n = intBytesLen(v)
+    out.append(n); out += v.to_bytes(n, 'big')
+
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    if ZOA_ARR & mv[i]:
+      b, i = _dec_data(mv, _dec_fixed(mv, i, 1))
+      v = -_rawInt(b)
+    else:
+      b, i = _dec_data(mv, i)
+      v = _rawInt(b)
+    it = _interner.get()
+    return (v if it is None else it.int(v)), i
+
   def toPy(self) -> 'Int': return self
 
   @classmethod
@@ -293,8 +1789,9 @@ class Int(int):
     bracket = p.peek() == b'{'
     if bracket: p.need('{')
     t = p.singleData()
-    i = ast.literal_eval(t.decode('utf-8'))
-    if not isinstance(i, int): p.error("Not an int: " + t)
+    try: i = int(t, 0)
+    except ValueError: i = ast.literal_eval(t.decode('utf-8'))
+    if not isinstance(i, int): p.error(f"Not an int: {t}")
     if bracket: p.need('}')
     return cls(i)
 
@@ -320,6 +1817,11 @@ class SizedInt(Int):
     self.check()
     return super().toZ()
 
+  @classmethod
+  def _enc(cls, v: int, out: bytearray):
+    if not cls.minSize <= v <= cls.maxSize: raise ValueError(v)
+    Int._enc(v, out)
+
   def toPy(self) -> 'Int':
     return self.check()
 
@@ -328,21 +1830,39 @@ class SizedInt(Int):
     v = super().parse(p)
     return cls.frPy(v).check()
 
-class U1(SizedInt, int): name = 'U1'; minSize = 0;           maxSize = 0xFF
-class U2(SizedInt, int): name = 'U2'; minSize = 0;           maxSize = 0xFFFF
-class U4(SizedInt, int): name = 'U4'; minSize = 0;           maxSize = 0xFFFFFFFF
-class I1(SizedInt, int): name = 'I1'; minSize = -0x80;       maxSize = 0x7F
-class I2(SizedInt, int): name = 'I2'; minSize = -0x8000;     maxSize = 0x7FFF
-class I4(SizedInt, int): name = 'I4'; minSize = -0x80000000; maxSize = 0x7FFFFFFF
-
-class Data(bytes):
+def _typecode(codes: str, size: int) -> str:
+  """The first array.array typecode in codes whose items are size bytes (the
+  sizes of the C types vary by platform).
+  """
+  for c in codes:
+    if array.array(c).itemsize == size: return c
+  raise TypeError(f"No {size} byte typecode in {codes}")
+
+# typecode: the array.array typecode with the same range (see ArrSizedBase)
+class U1(SizedInt, int): name = 'U1'; minSize = 0;           maxSize = 0xFF;       typecode = _typecode('B', 1)
+class U2(SizedInt, int): name = 'U2'; minSize = 0;           maxSize = 0xFFFF;     typecode = _typecode('HI', 2)
+class U4(SizedInt, int): name = 'U4'; minSize = 0;           maxSize = 0xFFFFFFFF; typecode = _typecode('ILQ', 4)
+class I1(SizedInt, int): name = 'I1'; minSize = -0x80;       maxSize = 0x7F;       typecode = _typecode('b', 1)
+class I2(SizedInt, int): name = 'I2'; minSize = -0x8000;     maxSize = 0x7FFF;     typecode = _typecode('hi', 2)
+class I4(SizedInt, int): name = 'I4'; minSize = -0x80000000; maxSize = 0x7FFFFFFF; typecode = _typecode('ilq', 4)
+
+class Data(ZTy, bytes):
   name = 'Data'
 
   @classmethod
   def frPy(cls, *args, **kwargs): return cls(*args, **kwargs)
   @classmethod
-  def frZ(cls, raw: ZoaRaw) -> "Data": return cls(raw.data)
+  def frZ(cls, raw: ZoaRaw) -> "Data":
+    it = _interner.get()
+    return cls(raw.data) if it is None else it.data(raw.data)
   def toZ(self) -> ZoaRaw: return ZoaRaw.new_data(self)
+  @classmethod
+  def _enc(cls, v: bytes, out: bytearray): _enc_data(out, v)
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    b, i = _dec_data(mv, i)
+    it = _interner.get()
+    return (cls(b) if it is None else it.data(b)), i
   def toPy(self) -> 'Data': return self
   def __repr__(self): return reprData(self)
 
@@ -376,14 +1896,23 @@ class Data(bytes):
 
 STR_ESC_LIT = {ord(c) for c in ('\\', '|', ' ')}
 
-class Str(str):
+class Str(ZTy, str):
   name = 'Str'
 
   @classmethod
   def frPy(cls, *args, **kwargs): return cls(*args, **kwargs)
   @classmethod
-  def frZ(cls, raw: ZoaRaw) -> "Str": return cls(raw.data.decode('utf-8'))
+  def frZ(cls, raw: ZoaRaw) -> "Str":
+    it = _interner.get()
+    return cls(str(raw.data, 'utf-8')) if it is None else it.str(raw.data)
   def toZ(self) -> ZoaRaw: return ZoaRaw.new_data(self.encode('utf-8'))
+  @classmethod
+  def _enc(cls, v: str, out: bytearray): _enc_data(out, v.encode('utf-8'))
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    b, i = _dec_data(mv, i)
+    it = _interner.get()
+    return (cls(str(b, 'utf-8')) if it is None else it.str(b)), i
   def toPy(self) -> 'Str': return self
 
   @classmethod
@@ -420,12 +1949,22 @@ class Str(str):
 # Container Types (zty)
 # Note: the full type information and methods are created by the Parser.
 
-class ArrBase(list):
+class ArrBase(ZTy, list):
   @classmethod
   def frPy(cls, l: Iterable[Any]): return cls([cls._ty.frPy(i) for i in l])
   @classmethod
   def frZ(cls, raw: ZoaRaw): return cls(cls._ty.frZ(z) for z in raw.arr)
   def toZ(self) -> ZoaRaw: return ZoaRaw.new_arr([v.toZ() for v in self])
+  @classmethod
+  def _enc(cls, v: list, out: bytearray): _enc_arr(out, len(v), v, cls._ty._enc)
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    items, i = _dec_arr(mv, i, cls._ty._dec); return cls(items), i
+  @classmethod
+  def _proj(cls, mv: memoryview, i: int, fields):
+    ty = cls._ty
+    items, i = _dec_arr(mv, i, lambda mv, j: ty._proj(mv, j, fields))
+    return cls(items), i
   def toPy(self) -> list: return [v.toPy() for v in self]
   def __repr__(self): return reprArr(self)
 
@@ -443,7 +1982,170 @@ class ArrBase(list):
   def _define(cls, name, ty):
     cls._ty = updateUndefined(cls._ty, name, ty)
 
-class MapBase(odict):
+def _intZoab(v: int) -> bytes:
+  """The zoab of Int(v)."""
+  if v < 0: return b'\x41' + _intZoab(-v)
+  n = intBytesLen(v) if v else 0
+  return (v | n << (n << 3)).to_bytes(n + 1, 'big')
+
+# zoab of the ints -0xFF..0xFF, index with the int itself (negatives wrap)
+_ZOAB_SMALL = [_intZoab(v) for v in range(0x100)] + [
+               _intZoab(v) for v in range(-0x100, 0)]
+_DATA_HDR = [bytes([n]) for n in range(ZOA_LEN_MASK + 1)]
+
+# Batched arr codecs: these format every item of a homogeneous arr at once and
+# join them a segment at a time, or decode all the items in a single loop.
+
+def _enc_parts(out: bytearray, n: int, parts: list, per: int = 1):
+  """Append an arr of n items where each item is `per` bytes in parts."""
+  if n <= 63: out.append(ZOA_ARR | n); out += b''.join(parts); return
+  for k in range(0, n, 63):
+    _enc_seg(out, n, k)
+    out += b''.join(parts[k * per:(k + 63) * per])
+
+def _intZoabs(v: Iterable[int]) -> List[bytes]:
+  """The zoab of each int in v."""
+  tbl = _ZOAB_SMALL
+  if not v or (-0x100 < min(v) and max(v) < 0x100):
+    return list(map(tbl.__getitem__, v))
+  if not isinstance(v, array.array):
+    try: v = array.array('q', v) # unbox: arithmetic on plain ints is faster
+    except OverflowError: pass
+  return [tbl[i] if -0x100 < i < 0x100 else
+          (i | 0x20000).to_bytes(3, 'big') if 0 < i < 0x10000 else
+          (i | 0x3000000).to_bytes(4, 'big') if 0 < i < 0x1000000 else
+          _intZoab(i) for i in v]
+
+def _enc_datas(out: bytearray, v: List[bytes]):
+  """Append an arr of data."""
+  n = len(v); lens = list(map(len, v))
+  if n and max(lens) > ZOA_LEN_MASK: return _enc_arr(out, n, v, Data._enc)
+  parts = [None] * (2 * n)
+  parts[0::2] = map(_DATA_HDR.__getitem__, lens); parts[1::2] = v
+  _enc_parts(out, n, parts, 2)
+
+def _arrBuf(mv: memoryview):
+  """The bytes under mv when possible (slicing them is cheaper), else mv."""
+  return mv.obj if type(mv.obj) is bytes and len(mv.obj) == mv.nbytes else mv
+
+def _dec_ints(mv: memoryview, i: int):
+  """Decode an arr of ints into a list of int. Returns (list, end)."""
+  b = _arrBuf(mv); end = len(b)
+  meta = b[i]; i += 1
+  if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+  out = []; add = out.append
+  while True:
+    for _ in range(ZOA_LEN_MASK & meta):
+      m = b[i]
+      if m == 1:   add(b[i + 1]); i += 2
+      elif not m:  add(0); i += 1
+      elif m <= 8: add(int.from_bytes(b[i + 1:i + 1 + m], 'big')); i += 1 + m
+      else:        v, i = Int._dec(mv, i); add(v)
+    if i > end: raise Eof()
+    if not ZOA_JOIN & meta: return out, i
+    meta = b[i]; i += 1
+    if not ZOA_ARR & meta: raise ValueError("join different types")
+
+def _dec_datas(mv: memoryview, i: int):
+  """Decode an arr of data into a list of bytes. Returns (list, end)."""
+  b = _arrBuf(mv); end = len(b)
+  meta = b[i]; i += 1
+  if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+  out = []; add = out.append
+  while True:
+    for _ in range(ZOA_LEN_MASK & meta):
+      j = i + 1 + b[i]
+      if j <= i + 64: add(b[i + 1:j]); i = j
+      else: d, i = _dec_data(mv, i); add(d)
+    if i > end: raise Eof()
+    if not ZOA_JOIN & meta: return out, i
+    meta = b[i]; i += 1
+    if not ZOA_ARR & meta: raise ValueError("join different types")
+
+def _dec_strs(mv: memoryview, i: int):
+  """Decode an arr of utf-8 data into a list of str."""
+  items, i = _dec_datas(mv, i)
+  n = len(items); b = b'\0'.join(items)
+  if b.count(0) == n - 1: return b.decode('utf-8').split('\0'), i
+  return [str(d, 'utf-8') for d in items], i
+
+class ArrSizedBase(ZTy, array.array):
+  """Arr of a fixed-width SizedInt stored unboxed in an array.array.
+
+  Items are plain ints, not instances of the item type (cls._ty): they have no
+  toZ() etc and aren't Ints, use cls._ty(item) for that. Bounds are checked in
+  bulk by the array, which raises ValueError (instead of OverflowError) for an
+  out of range item.
+  """
+  __slots__ = ()
+
+  def __new__(cls, init=()):
+    try: return super().__new__(cls, cls._ty.typecode, init)
+    except OverflowError as e: raise ValueError(f"{cls.name}: {e}") from e
+
+  def __reduce_ex__(self, protocol): return type(self), (self.tolist(),)
+  def __copy__(self): return type(self)(self)
+  def __deepcopy__(self, memo): return type(self)(self)
+
+  @classmethod
+  def frPy(cls, l: Iterable[int]): return cls(l)
+  @classmethod
+  def frZ(cls, raw: ZoaRaw): return cls(Int.frZ(z) for z in raw.arr)
+  def toZ(self) -> ZoaRaw: return ZoaRaw.new_arr([Int(v).toZ() for v in self])
+
+  @classmethod
+  def _enc(cls, v: array.array, out: bytearray):
+    _enc_parts(out, len(v), _intZoabs(v))
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    items, i = _dec_ints(mv, i); return cls(items), i
+
+  def toPy(self) -> list: return self.tolist()
+  def __repr__(self): return reprArr(self)
+
+  @classmethod
+  def parse(cls, p: "Parser"): return ArrBase.parse.__func__(cls, p)
+
+class ArrIntBase(ArrBase):
+  """Arr[Int] with batched encode/decode."""
+  @classmethod
+  def _enc(cls, v: list, out: bytearray):
+    _enc_parts(out, len(v), _intZoabs(v))
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    items, i = _dec_ints(mv, i)
+    it = _interner.get()
+    return cls(map(Int if it is None else it.int, items)), i
+
+class ArrDataBase(ArrBase):
+  """Arr[Data] with batched encode/decode."""
+  @classmethod
+  def _enc(cls, v: list, out: bytearray): _enc_datas(out, v)
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    items, i = _dec_datas(mv, i)
+    it = _interner.get()
+    return cls(map(Data if it is None else it.data, items)), i
+
+class ArrStrBase(ArrBase):
+  """Arr[Str] with batched encode/decode."""
+  @classmethod
+  def _enc(cls, v: list, out: bytearray):
+    n = len(v); s = '\0'.join(v)
+    if n > 1 and s.count('\0') == n - 1: v = s.encode('utf-8').split(b'\0')
+    else: v = [s.encode('utf-8') for s in v]
+    _enc_datas(out, v)
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    it = _interner.get()
+    if it is not None:
+      items, i = _dec_datas(mv, i); return cls(map(it.str, items)), i
+    items, i = _dec_strs(mv, i); return cls(map(Str, items)), i
+
+# Arr bases for item types with batched codecs (see also ArrSizedBase)
+ARR_BASES = {Int: ArrIntBase, Data: ArrDataBase, Str: ArrStrBase}
+
+class MapBase(ZTy, odict):
   @classmethod
   def frPy(cls, l: Iterable[Any]):
     if isinstance(l, dict): l = l.items()
@@ -467,6 +2169,47 @@ class MapBase(odict):
         yield key.toZ(); yield value.toZ()
     return ZoaRaw.new_arr(list(flatten()))
 
+  @classmethod
+  def _enc(cls, v: dict, out: bytearray):
+    kenc, venc = cls._kty._enc, cls._vty._enc
+    n = 2 * len(v)
+    if n <= 63:
+      out.append(ZOA_ARR | n)
+      for key, value in v.items(): kenc(key, out); venc(value, out)
+      return
+    k = 0
+    for key, value in v.items():
+      if not k % 63: _enc_seg(out, n, k)
+      kenc(key, out); k += 1
+      if not k % 63: _enc_seg(out, n, k)
+      venc(value, out); k += 1
+
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    items, i = _dec_arr(mv, i, cls._kty._dec, cls._vty._dec)
+    if len(items) % 2 != 0: raise ValueError(f"length not even: {len(items)}")
+    it = iter(items)
+    return cls(zip(it, it)), i
+
+  @classmethod
+  def _proj(cls, mv: memoryview, i: int, keys):
+    kdec, vdec = cls._kty._dec, cls._vty._dec
+    keys = keys if isinstance(keys, (set, frozenset)) else set(keys)
+    meta = mv[i]; i += 1
+    if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+    out = cls(); key = None
+    while True:
+      for _ in range(ZOA_LEN_MASK & meta):
+        if key is None: key, i = kdec(mv, i); continue
+        if key in keys: out[key], i = vdec(mv, i)
+        else:           i = _skip(mv, i)
+        key = None
+      if not ZOA_JOIN & meta: break
+      meta = mv[i]; i += 1
+      if not ZOA_ARR & meta: raise ValueError("join different types")
+    if key is not None: raise ValueError("length not even")
+    return out, i
+
   def toPy(self) -> odict: return odict((k.toPy(), v.toPy()) for k, v in self.items())
   def __repr__(self): return repr(self.toPy())
 
@@ -495,8 +2238,58 @@ class StructField:
   def _define(self, name, ty):
     self.ty = updateUndefined(self.ty, name, ty)
 
-@dataclass(init=False)
-class StructBase:
+class _FieldsBase(ZTy):
+  """repr and == over the _fieldNames, like a dataclass."""
+  __slots__ = ()
+  _fieldNames = ()
+
+  def __repr__(self):
+    return type(self).__qualname__ + '(' + ', '.join(
+      f'{n}={getattr(self, n)!r}' for n in self._fieldNames) + ')'
+
+  def __eq__(self, other):
+    if other.__class__ is not self.__class__: return NotImplemented
+    return all(getattr(self, n) == getattr(other, n) for n in self._fieldNames)
+
+def _tyClass(name: bytes, base, names: Tuple[str]):
+  """Create a struct or enum class with a slot for each field name.
+
+  It is a dataclass (for dataclasses.fields, asdict, etc), but much faster to
+  create than with make_dataclass: its __init__ is generated on first use by
+  cls._genInit(), its dataclass fields by cls._genDataclass() and repr/== come
+  from _FieldsBase.
+  """
+  for n in names: _identifier(n)
+  return _TyMeta(name.decode('utf-8'), (base,), {
+    '__slots__': names, '__match_args__': names, '_fieldNames': names,
+    '__init__': _LazyCodec('__init__', '_genInit'),
+    '__dataclass_fields__': _LazyCodec('__dataclass_fields__', '_genDataclass'),
+  })
+
+def _setDataclass(cls, fields: List[Tuple[str, Any, Any]]):
+  """Set the dataclass fields of cls to fields: (name, type, default)."""
+  ns = {'__annotations__': {n: ty for n, ty, _ in fields}}
+  ns.update((n, d) for n, _, d in fields if d is not dataclasses.MISSING)
+  dc = dataclasses.dataclass(init=False, repr=False, eq=False)(
+    type(cls.__name__, (), ns))
+  cls.__dataclass_fields__ = dc.__dataclass_fields__
+  cls.__dataclass_params__ = dc.__dataclass_params__
+
+def _setInit(cls, defaults: Dict[str, Any]):
+  """Generate cls.__init__ which sets each of cls._fieldNames.
+
+  defaults has the default value of each optional field.
+  """
+  params = ''.join(f', {n}=D[{n!r}]' if n in defaults else f', {n}'
+                   for n in cls._fieldNames)
+  body = ''.join(f'\n  __zoa_self__.{n} = {n}' for n in cls._fieldNames)
+  ns = _codegen(f'def __init__(__zoa_self__{params}):{body or " pass"}\n',
+                {'D': defaults})
+  cls.__init__ = ns['__init__']
+
+class StructBase(_FieldsBase):
+  __slots__ = ()
+
   @classmethod
   def frZ(cls, z: ZoaRaw):
     args = []
@@ -507,10 +2300,21 @@ class StructBase:
       assert f.zid is None
       args.append(f.ty.frZ(z.arr[1 + pos]))
     kwargs = {}
-    byId = {f.zid: (name, f.ty) for name, f in cls._fields.items()}
-    for z in z.arr[1+posArgs:]:
-      name, ty = byId[Int.frZ(zi[0])]
-      kwargs[name] = ty.frZ(zi[1])
+    byId = {f.zid: (name.decode('utf-8'), f.ty)
+            for name, f in cls._fields.items()}
+    for zi in z.arr[1+posArgs:]:
+      name, ty = byId[Int.frZ(zi.arr[0])]
+      kwargs[name] = ty.frZ(zi.arr[1])
+    return cls._new(args, kwargs)
+
+  @classmethod
+  def _new(cls, args: list, kwargs: dict):
+    """cls(*args, **kwargs), where omitted fields (encoded from None) are None.
+
+    Fields with a default get their default instead.
+    """
+    for name, f in list(cls._fields.items())[len(args):]:
+      if f.default is None: kwargs.setdefault(name.decode('utf-8'), None)
     return cls(*args, **kwargs)
 
   def toZ(self) -> ZoaRaw:
@@ -519,16 +2323,103 @@ class StructBase:
     for name, f in self._fields.items():
       if f.zid is None: # positional arg
         if getattr(self, name.decode('utf-8')) is None: posArgsDone = True
-        elif posArgsDone: raise ValueError(
-          f"{name} has value after previous positional arg wasn't specified")
+        elif posArgsDone: raise _posArgErr(name)
         else: posArgs += 1
 
     out = [Int(posArgs).toZ()] # starts with number of positional arguments
     for name, f in self._fields.items():
-      if f.zid is None: out.append(getattr(self, name.decode('utf-8')).toZ())
-      else: out.append(ZoaRaw.new_arr([f.zid, self.get(name).toZ()]))
+      value = getattr(self, name.decode('utf-8'))
+      if value is None: continue
+      if f.zid is None: out.append(value.toZ())
+      else: out.append(ZoaRaw.new_arr([Int(f.zid).toZ(), value.toZ()]))
     return ZoaRaw.new_arr(out)
 
+  @classmethod
+  def _enc(cls, v: 'StructBase', out: bytearray):
+    pos, named = [], []; posArgsDone = False
+    for name, f in cls._fields.items():
+      value = getattr(v, name.decode('utf-8'))
+      if f.zid is not None:
+        if value is not None: named.append((_enc_zid, (f.zid, f.ty, value)))
+      elif value is None: posArgsDone = True
+      elif posArgsDone: raise _posArgErr(name)
+      else: pos.append((f.ty._enc, value))
+    items = [(Int._enc, len(pos))] + pos + named
+    n = len(items)
+    for k, (enc, value) in enumerate(items):
+      if not k % 63: _enc_seg(out, n, k)
+      enc(value, out)
+
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    meta = mv[i]
+    if meta & ZOA_JOIN: # more than 63 items: use the ZoaRaw path
+      z, i = from_zoab_buf(mv, i)
+      return cls.frZ(z), i
+    if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i}")
+    n = ZOA_LEN_MASK & meta
+    posArgs, i = Int._dec(mv, i + 1)
+    if n < 1 + posArgs: raise ValueError(f"{cls.name}: too few items")
+    args = []; fields = iter(cls._fields.values())
+    for _ in range(posArgs):
+      v, i = next(fields).ty._dec(mv, i); args.append(v)
+    kwargs = {}
+    if n > 1 + posArgs:
+      byId = {f.zid: (name.decode('utf-8'), f.ty)
+              for name, f in cls._fields.items()}
+      for _ in range(n - 1 - posArgs):
+        zid, i = Int._dec(mv, _dec_fixed(mv, i, 2))
+        name, ty = byId[zid]
+        kwargs[name], i = ty._dec(mv, i)
+    return cls._new(args, kwargs), i
+
+  @classmethod
+  def _proj(cls, mv: memoryview, i: int, fields):
+    key = tuple(fields)
+    plan = cls._projs.get(key)
+    if plan is None: plan = cls._projs[key] = cls._projPlan(key)
+    pos, byId, nones = plan
+    v = cls(*nones)
+    meta = mv[i]; i += 1
+    if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+    k = 0
+    while True:
+      for _ in range(ZOA_LEN_MASK & meta):
+        if k == 0:
+          posArgs, i = Int._dec(mv, i)
+          if posArgs > len(pos): raise ValueError(f"{cls.name}: too many items")
+        elif k <= posArgs:
+          sel = pos[k - 1]
+          if sel is None: # inlined _skip
+            m = mv[i]; i = i + 1 + m if m < ZOA_ARR else zoab_skip(mv, i)
+          else: name, ty = sel; value, i = ty._dec(mv, i); setattr(v, name, value)
+        else:
+          zid, j = Int._dec(mv, _dec_fixed(mv, i, 2))
+          sel = byId.get(zid)
+          if sel is None: i = _skip(mv, i)
+          else: name, ty = sel; value, i = ty._dec(mv, j); setattr(v, name, value)
+        k += 1
+      if not ZOA_JOIN & meta: break
+      meta = mv[i]; i += 1
+      if not ZOA_ARR & meta: raise ValueError("join different types")
+    return v, i
+
+  @classmethod
+  def _projPlan(cls, names):
+    """The (name, ty) of each selected positional field (else None), of each
+    selected field by zid and the args to create a struct of Nones.
+    """
+    names = {n if isinstance(n, str) else n.decode('utf-8') for n in names}
+    pos, byId = [], {}
+    for n, f in cls._fields.items():
+      n = n.decode('utf-8')
+      sel = (n, f.ty) if n in names else None
+      names.discard(n)
+      if f.zid is None: pos.append(sel)
+      elif sel:         byId[f.zid] = sel
+    if names: raise ValueError(f"{cls.name}: no fields {sorted(names)}")
+    return pos, byId, (None,) * len(cls._fieldNames)
+
   def toPy(self) -> dict:
     out = {}
     for name, f in self._fields.items():
@@ -550,8 +2441,130 @@ class StructBase:
 
   @classmethod
   def _define(cls, name, ty):
+    changed = False
     for f in cls._fields.values():
-      f._define(name, ty)
+      prev = f.ty; f._define(name, ty); changed |= f.ty is not prev
+    if changed: cls._compile()
+
+  @classmethod
+  def _genInit(cls):
+    _setInit(cls, {n.decode('utf-8'): f.default
+                   for n, f in cls._fields.items() if f.default is not None})
+
+  @classmethod
+  def _genDataclass(cls):
+    _setDataclass(cls, [
+      (n.decode('utf-8'), f.ty, dataclasses.MISSING if f.default is None else
+       dataclasses.field(default_factory=lambda f=f: f.default))
+      for n, f in cls._fields.items()])
+
+  @classmethod
+  def _compile(cls): cls._projs = {}; _lazyCodecs(cls)
+
+  @classmethod
+  def _generate(cls):
+    """Generate frZ/toZ/_enc/_dec with this struct's fields baked in.
+
+    Structs with undefined fields (or too many to fit a single arr segment)
+    keep the generic methods.
+    """
+    _clearCodecs(cls)
+    fields = list(cls._fields.items())
+    if len(fields) >= ZOA_LEN_MASK: return
+    if any(isinstance(f.ty, Undefined) for _, f in fields): return
+    ns = {
+      'Int': Int, 'IE': Int._enc, 'ID': Int._dec, 'IF': Int.frZ,
+      'NEW': ZoaRaw.new_arr, 'FIXED': _dec_fixed, 'POSERR': _posArgErr,
+      'GFRZ': StructBase.frZ.__func__, 'GDEC': StructBase._dec.__func__,
+    }
+    pos = [(n, f) for n, f in fields if f.zid is None]
+    named = [(n, f) for n, f in fields if f.zid is not None]
+    P = len(pos)
+    pv = [f'p{k}' for k in range(P)]; zv = [f'z{k}' for k in range(len(named))]
+    args = ''.join(v + ', ' for v in pv)
+    byId = {} # the codecs are looked up at call time (as in _codecRef)
+    for k, (n, f) in enumerate(named):
+      zid = bytearray([ZOA_ARR | 2]); Int._enc(f.zid, zid)
+      ns[f'ZH{k}'] = bytes(zid)
+      byId[f.zid] = (n.decode('utf-8'), f.ty)
+    ns['BYID'] = byId
+
+    # load the field values and count the positional args
+    load = [f'  {v} = v.{_identifier(n)}'
+            for v, (n, _) in zip(pv + zv, pos + named)]
+    if not P: load.append('  np = 0')
+    for k, v in enumerate(pv):
+      load.append(f'  {"if" if k == 0 else "elif"} {v} is None: np = {k}')
+    if P: load.append(f'  else: np = {P}')
+    if P > 1:
+      ns['POSNAMES'] = [n for n, _ in pos]
+      load.append(f'  if np < {P - 1}:')
+      load.append(f'    for k, x in enumerate(({args})[np + 1:], np + 1):')
+      load.append(f'      if x is not None: raise POSERR(POSNAMES[k])')
+    load = '\n'.join(load)
+
+    enc, toZ, dec, frZ = [], [], [], []
+    for k, (v, (n, f)) in enumerate(zip(pv, pos)):
+      e = _codecRef(ns, f.ty, f'E{k}', '_enc')
+      d = _codecRef(ns, f.ty, f'D{k}', '_dec')
+      fz = _codecRef(ns, f.ty, f'F{k}', 'frZ')
+      enc.append(f'  if np > {k}: {e}({v}, out)')
+      toZ.append(f'  if np > {k}: out.append({v}.toZ())')
+      dec.append(f'  {v}, j = {d}(mv, j)')
+      frZ.append(f'{fz}(arr[{k + 1}]), ')
+    for k, (v, (n, f)) in enumerate(zip(zv, named)):
+      e = _codecRef(ns, f.ty, f'ZE{k}', '_enc')
+      enc.append(f'  if {v} is not None: out += ZH{k}; {e}({v}, out)')
+      toZ.append(f'  if {v} is not None: '
+                 f'out.append(NEW([Int({f.zid}).toZ(), {v}.toZ()]))')
+    count = ''.join(f' + ({v} is not None)' for v in zv)
+    # named fields without a default are None when omitted
+    omit = [n.decode('utf-8') for n, f in named if f.default is None]
+    omitKw = ''.join(f'{n!r}: None, ' for n in omit)
+    omit = ''.join(f'{n}=None, ' for n in omit)
+    enc, toZ, dec, frZ = ('\n'.join(enc), '\n'.join(toZ),
+                          '\n'.join(dec), ''.join(frZ))
+
+    ns = _codegen(f'''
+def _enc(cls, v, out):
+{load}
+  out.append({ZOA_ARR} | (1 + np{count}))
+  IE(np, out)
+{enc}
+
+def toZ(v):
+{load}
+  out = [Int(np).toZ()]
+{toZ}
+  return NEW(out)
+
+def _dec(cls, mv, i):
+  meta = mv[i]
+  if meta & {ZOA_ARR | ZOA_JOIN} != {ZOA_ARR}: return GDEC(cls, mv, i)
+  n = (meta & {ZOA_LEN_MASK}) - 1
+  np, j = ID(mv, i + 1)
+  if np != {P} or n < {P}: return GDEC(cls, mv, i)
+{dec}
+  if n == {P}: return cls({args}{omit}), j
+  kw = {{{omitKw}}}
+  for _ in range(n - {P}):
+    zid, j = ID(mv, FIXED(mv, j, 2))
+    name, ty = BYID[zid]
+    kw[name], j = ty._dec(mv, j)
+  return cls({args}**kw), j
+
+def frZ(cls, z):
+  arr = z.arr; n = len(arr) - 1
+  if IF(arr[0]) != {P} or n < {P}: return GFRZ(cls, z)
+  if n == {P}: return cls({frZ}{omit})
+  kw = {{{omitKw}}}
+  for zi in arr[{P + 1}:]:
+    name, ty = BYID[IF(zi.arr[0])]
+    kw[name] = ty.frZ(zi.arr[1])
+  return cls({frZ}**kw)
+''', ns)
+    cls._enc, cls._dec = classmethod(ns['_enc']), classmethod(ns['_dec'])
+    cls.frZ, cls.toZ = classmethod(ns['frZ']), ns['toZ']
 
 @dataclass
 class EnumVar:
@@ -560,11 +2573,13 @@ class EnumVar:
   def _define(self, name, ty):
     self.ty = updateUndefined(self.ty, name, ty)
 
-@dataclass(init=False)
-class EnumBase:
+class EnumBase(_FieldsBase):
+  __slots__ = ()
+
   @classmethod
   def frZ(cls, z: ZoaRaw) -> 'EnumBase':
     variant = Int.frZ(z.arr[0])
+    if not 0 <= variant < len(cls._variants): raise _variantErr(cls, variant)
     name, var = cls._variants[variant]
     return cls(**{name.decode('utf-8'): var.ty.frZ(z.arr[1])})
 
@@ -573,13 +2588,33 @@ class EnumBase:
     for i, (n, v) in enumerate(self._variants):
       ty = v.ty
       v = getattr(self, n.decode('utf-8'))
-      if v:
-        if variant is not None: raise ValueError(
-          f"Multiple variants set: {self._variants[variant]} and {(n, ty)}")
+      if v is not None:
+        if variant is not None: raise _multiVarErr(self._variants, variant, i)
         variant, value = i, v
     if variant is None: raise ValueError("No variant set")
     return ZoaRaw.new_arr([Int(variant).toZ(), value.toZ()])
 
+  @classmethod
+  def _enc(cls, v: 'EnumBase', out: bytearray):
+    variant, value = None, None
+    for i, (n, var) in enumerate(cls._variants):
+      val = getattr(v, n.decode('utf-8'))
+      if val is not None:
+        if variant is not None: raise _multiVarErr(cls._variants, variant, i)
+        variant, value = i, (var.ty, val)
+    if variant is None: raise ValueError("No variant set")
+    out.append(ZOA_ARR | 2)
+    Int._enc(variant, out)
+    value[0]._enc(value[1], out)
+
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    variant, i = Int._dec(mv, _dec_fixed(mv, i, 2))
+    if not 0 <= variant < len(cls._variants): raise _variantErr(cls, variant)
+    name, var = cls._variants[variant]
+    value, i = var.ty._dec(mv, i)
+    return cls(**{name.decode('utf-8'): value}), i
+
   def toPy(self) -> Enum: return self
 
   @classmethod
@@ -593,8 +2628,77 @@ class EnumBase:
 
   @classmethod
   def _define(cls, name, ty):
+    changed = False
     for _n, v in cls._variants:
-      v._define(name, ty)
+      prev = v.ty; v._define(name, ty); changed |= v.ty is not prev
+    if changed: cls._compile()
+
+  @classmethod
+  def _genInit(cls): _setInit(cls, dict.fromkeys(cls._fieldNames))
+
+  @classmethod
+  def _genDataclass(cls):
+    _setDataclass(cls, [(n.decode('utf-8'), v.ty, None) for n, v in cls._variants])
+
+  @classmethod
+  def _compile(cls): _lazyCodecs(cls)
+
+  @classmethod
+  def _generate(cls):
+    """Generate frZ/toZ/_enc/_dec with this enum's variants baked in."""
+    _clearCodecs(cls)
+    variants = cls._variants
+    if any(isinstance(v.ty, Undefined) for _, v in variants): return
+    ns = {'Int': Int, 'ID': Int._dec, 'IF': Int.frZ, 'NEW': ZoaRaw.new_arr,
+          'FIXED': _dec_fixed, 'MULTIERR': _multiVarErr, 'VARS': variants,
+          'VARERR': _variantErr}
+    load, vdec, vfrZ = [], [], []
+    for k, (n, v) in enumerate(variants):
+      n = _identifier(n)
+      hdr = bytearray([ZOA_ARR | 2]); Int._enc(k, hdr); ns[f'H{k}'] = bytes(hdr)
+      e = _codecRef(ns, v.ty, f'E{k}', '_enc')
+      d = _codecRef(ns, v.ty, f'D{k}', '_dec')
+      fz = _codecRef(ns, v.ty, f'F{k}', 'frZ')
+      load.append(f'''  x = v.{n}
+  if x is not None:
+    if k is not None: raise MULTIERR(VARS, k, {k})
+    k, val, hdr, enc = {k}, x, H{k}, {e}''')
+      vdec.append(f'''def _d{k}(cls, mv, i):
+  x, i = {d}(mv, i); return cls({n}=x), i''')
+      vfrZ.append(f'def _f{k}(cls, z): return cls({n}={fz}(z))')
+    load = '\n'.join(load); vdec = '\n'.join(vdec); vfrZ = '\n'.join(vfrZ)
+    ns = _codegen(f'''
+def _load(v):
+  k = None
+{load}
+  if k is None: raise ValueError("No variant set")
+  return k, val, hdr, enc
+
+def _enc(cls, v, out):
+  k, val, hdr, enc = _load(v)
+  out += hdr; enc(val, out)
+
+def toZ(v):
+  k, val, _hdr, _enc = _load(v)
+  return NEW([Int(k).toZ(), val.toZ()])
+
+def _dec(cls, mv, i):
+  k, i = ID(mv, FIXED(mv, i, 2))
+  if not 0 <= k < {len(variants)}: raise VARERR(cls, k)
+  return DECS[k](cls, mv, i)
+
+def frZ(cls, z):
+  k = IF(z.arr[0])
+  if not 0 <= k < {len(variants)}: raise VARERR(cls, k)
+  return FRZS[k](cls, z.arr[1])
+
+{vdec}
+{vfrZ}
+DECS = ({''.join(f'_d{k}, ' for k in range(len(variants)))})
+FRZS = ({''.join(f'_f{k}, ' for k in range(len(variants)))})
+''', ns)
+    cls._enc, cls._dec = classmethod(ns['_enc']), classmethod(ns['_dec'])
+    cls.frZ, cls.toZ = classmethod(ns['frZ']), ns['toZ']
 
 @dataclass
 class BmVar: # Bitmap Variant
@@ -631,12 +2735,17 @@ class BmVar: # Bitmap Variant
     return closure
 
 @dataclass
-class BitmapBase:
+class BitmapBase(ZTy):
   value: int = 0
 
   @classmethod
   def frZ(cls, z: ZoaRaw) -> 'BitmapBase': return cls(int(Int.frZ(z)))
   def toZ(self) -> ZoaRaw: return Int(self.value).toZ()
+  @classmethod
+  def _enc(cls, v: 'BitmapBase', out: bytearray): Int._enc(v.value, out)
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    v, i = Int._dec(mv, i); return cls(int(v)), i
   def toPy(self) -> 'BitmapBase': return self
 
 ################################################################################
@@ -660,9 +2769,10 @@ class DynType(Enum):
   MapStrStr = 0x43
 
 dynFrZMethod = {}  # note: updated later
+dynTy = {}         # note: updated later
 
 @dataclass
-class Dyn:
+class Dyn(ZTy):
   value: Any
   ty: DynType
   name = "Dyn"
@@ -710,6 +2820,21 @@ class Dyn:
       self.value.toZ(),
     ])
 
+  @classmethod
+  def _enc(cls, v: 'Dyn', out: bytearray):
+    if v.ty is DynType.Empty: out.append(ZOA_ARR); return
+    out.append(ZOA_ARR | 2)
+    Int._enc(v.ty.value, out)
+    dynTy[v.ty]._enc(v.value, out)
+
+  @classmethod
+  def _dec(cls, mv: memoryview, i: int):
+    if mv[i] == ZOA_ARR: return cls._none(), i + 1
+    ty, i = Int._dec(mv, _dec_fixed(mv, i, 2))
+    ty = DynType(ty)
+    value, i = dynTy[ty]._dec(mv, i)
+    return cls(value=value, ty=ty), i
+
   def toPy(self) -> Any: return self.value.toPy()
 
   def __repr__(self):    return repr(self.value)
@@ -718,9 +2843,9 @@ class Dyn:
 ArrDyn   = type('ArrDyn', (ArrBase,),  {'_ty': Dyn,  'name': 'ArrDyn'})
 dynFrZMethod[DynType.ArrDyn] = ArrDyn.frZ
 
-ArrStr  = type('ArrStr', (ArrBase,),  {'_ty': Str,  'name': 'ArrStr'})
-ArrData = type('ArrData', (ArrBase,), {'_ty': Data, 'name': 'ArrData'})
-ArrInt  = type('ArrInt', (ArrBase,),  {'_ty': Int,  'name': 'ArrInt'})
+ArrStr  = type('ArrStr', (ArrStrBase,),   {'_ty': Str,  'name': 'ArrStr'})
+ArrData = type('ArrData', (ArrDataBase,), {'_ty': Data, 'name': 'ArrData'})
+ArrInt  = type('ArrInt', (ArrIntBase,),   {'_ty': Int,  'name': 'ArrInt'})
 
 MapStrDyn  = type('MapStrDyn', (MapBase,),  {'_vty': Str, '_kty': Dyn, 'name': 'MapStrDyn'})
 MapDataDyn = type('MapDataDyn', (MapBase,), {'_vty': Data,'_kty': Dyn, 'name': 'MapDataDyn'})
@@ -737,6 +2862,19 @@ dynFrZMethod.update({
   DynType.MapStrStr: MapStrStr.frZ,
 })
 
+dynTy.update({
+  DynType.Str:       Str,
+  DynType.Data:      Data,
+  DynType.Int:       Int,
+  DynType.ArrDyn:    ArrDyn,
+  DynType.ArrStr:    ArrStr,
+  DynType.ArrData:   ArrData,
+  DynType.ArrInt:    ArrInt,
+  DynType.MapStr:    MapStrDyn,
+  DynType.MapData:   MapDataDyn,
+  DynType.MapStrStr: MapStrStr,
+})
+
 def _frPyArrDyn(cls, arr): return cls._arrDyn(ArrDyn.frPy(arr))
 
 BASE_TYPES = {
@@ -758,20 +2896,45 @@ BASE_TYPES = {
 ################################################################################
 # Env: this contains all native and user-defined types found during parsing.
 
-def modname(mod, name): return mod + '.' + name if mod else name
+def modname(mod, name): return mod + b'.' + name if mod else name
+
+class _TyName:
+  """The type's name on the class, a field (slot) of the same name on
+  instances.
+  """
+  __slots__ = ('name', 'slot')
+  def __init__(self, name, slot): self.name, self.slot = name, slot
+  def __get__(self, obj, cls=None):
+    return self.name if obj is None else self.slot.__get__(obj, cls)
+  def __set__(self, obj, value): self.slot.__set__(obj, value)
+  def __delete__(self, obj): self.slot.__delete__(obj)
+
+def _setTyName(ty, name):
+  slot = vars(ty).get('name')
+  ty.name = name if slot is None else _TyName(name, slot)
 
 class TyEnv:
   def __init__(self):
     self.tys = AttrDict(BASE_TYPES)
     self.vals = AttrDict()
+    self.defs = [] # (kind, name) of each type as it is created, see describeEnv
+    self._deps = {} # undefined name: {types that use it}, see _register
+    self._ref = None # see envRef
 
   def arr(self, ty: Any) -> ArrBase:
     """Create or get generic array type."""
     name = f'Arr[{ty.name}]'
     existing = self.tys.get(name)
     if existing: return existing
-    arrTy = type(name, (ArrBase,), {'_ty': ty, 'name': name})
+    base = ArrBase
+    if isinstance(ty, type): # not Undefined
+      if issubclass(ty, SizedInt): base = ArrSizedBase
+      else:                        base = ARR_BASES.get(ty, ArrBase)
+    arrTy = _TyMeta(name, (base,), {'_ty': ty, 'name': name})
+    self._own(arrTy)
+    self._use(arrTy, ty)
     self.tys[name] = arrTy
+    self.defs.append((b'Arr', name))
     return arrTy
 
   def map(self, kty: Any, vty: Any) -> MapBase:
@@ -779,8 +2942,11 @@ class TyEnv:
     name = f'Map[{kty.name},{vty.name}]'
     existing = self.tys.get(name)
     if existing: return existing
-    mapTy = type(name, (MapBase,), {'_kty': kty, '_vty': vty, 'name': name})
+    mapTy = _TyMeta(name, (MapBase,), {'_kty': kty, '_vty': vty, 'name': name})
+    self._own(mapTy)
+    self._use(mapTy, kty, vty)
     self.tys[name] = mapTy
+    self.defs.append((b'Map', name))
     return mapTy
 
   def undefined(self, name):
@@ -789,6 +2955,7 @@ class TyEnv:
     if existing: return existing
     ty = Undefined(name)
     self.tys[name] = ty
+    self.defs.append((b'declare', name))
     return ty
 
   def struct(self, mod: bytes, name: bytes, fields: Dict[bytes, StructField]):
@@ -796,22 +2963,16 @@ class TyEnv:
     undefined = self.tys.get(mn)
     if isinstance(undefined, Undefined): pass
     elif mn in self.tys: raise KeyError(f"Modname {mn} already exists")
-    dfields = []
+    hasDefault = False
     for n, f in fields.items():
-      n = n.decode('utf-8')
-      if f.default is None:
-        item = [n, f.ty]
-      else:
-        item = [n, f.ty, dataclasses.field(default_factory=lambda: f.default)]
-      dfields.append(item)
-
-    ty = dataclasses.make_dataclass(
-      name.decode('utf-8'),
-      dfields,
-      bases=(StructBase,),
-    )
-    ty.name = mn
+      if f.default is not None: hasDefault = True
+      elif hasDefault: raise TypeError(
+        f"non-default argument {n.decode('utf-8')!r} follows default argument")
+    ty = _tyClass(name, StructBase, tuple(n.decode('utf-8') for n in fields))
+    _setTyName(ty, mn)
     ty._fields = fields
+    ty._compile()
+    self._use(ty, *(f.ty for f in fields.values()))
     return self._register(mn, ty, undefined)
 
   def enum(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, Any]]):
@@ -819,21 +2980,18 @@ class TyEnv:
     undefined = self.tys.get(mn)
     if isinstance(undefined, Undefined): pass
     elif mn in self.tys: raise KeyError(f"Modname {mn} already exists")
-    ty = dataclasses.make_dataclass(
-      name.decode('utf-8'),
-      [
-        (n.decode('utf-8'), ty, dataclasses.field(default=None))
-        for (n, ty) in variants
-      ],
-      bases=(EnumBase,),
-    )
-    ty.name = mn
+    ty = _tyClass(name, EnumBase, tuple(n.decode('utf-8') for n, _ in variants))
+    _setTyName(ty, mn)
     ty._variants = variants
+    ty._compile()
+    self._use(ty, *(v.ty for _, v in variants))
     return self._register(mn, ty, undefined)
 
   def bitmap(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, BmVar]]):
     mn = modname(mod, name)
-    if mn in self.tys: raise KeyError(f"Modname {mn} already exists")
+    undefined = self.tys.get(mn)
+    if isinstance(undefined, Undefined): pass
+    elif mn in self.tys: raise KeyError(f"Modname {mn} already exists")
     methods = {'name': mn, '_variants': variants}
     for n, var in variants:
       n = n.decode('utf-8')
@@ -841,19 +2999,29 @@ class TyEnv:
       methods['set_' + n] = var._setVariantClosure()
       methods['is_' + n] = var._isVariantClosure()
       methods['tog_' + n] = var._togVariantClosure()
-    ty = type(name.decode('utf-8'), (BitmapBase,), methods)
-    self.tys[mn] = ty
-    return ty
+    ty = _TyMeta(name.decode('utf-8'), (BitmapBase,), methods)
+    return self._register(mn, ty, undefined)
 
   def _register(self, name, ty, undefined):
+    self._own(ty)
     self.tys[name] = ty
+    self.defs.append((b'struct' if issubclass(ty, StructBase)
+                 else b'enum'   if issubclass(ty, EnumBase) else b'bitmap', name))
     if undefined: self._define(name, ty)
     return ty
 
+  def _own(self, ty):
+    """Make the instances of ty picklable (see Pickling)."""
+    ty._tyEnv = self
+    ty.__reduce_ex__ = _reduceTy
+
+  def _use(self, ty, *used):
+    """Record that ty uses the types used, so that it is defined when they are."""
+    for u in used:
+      if isinstance(u, Undefined): self._deps.setdefault(u.name, {})[ty] = None
+
   def _define(self, name, ty):
-    for v in self.tys.values():
-      if hasattr(v, '_define'):
-        v._define(name, ty)
+    for v in self._deps.pop(name, ()): v._define(name, ty)
 
 ################################################################################
 # Parser: parses tokens to create types
@@ -887,8 +3055,23 @@ def coaleseTG(group: TG) -> TG:
     return TG.T_ALPHA
   return group
 
+# Byte class table: the (coalesced) TG of every byte.
+TG_TABLE = tuple(coaleseTG(TG.fromChr(c)) for c in range(256))
+
+def _tgClass(group: TG) -> bytes:
+  """A regex character class matching the bytes in group."""
+  return b'[' + b''.join(re.escape(bytes([c]))
+                         for c in range(256) if TG_TABLE[c] is group) + b']'
+
+RE_WHITE = re.compile(_tgClass(TG.T_WHITE) + b'*')
+RE_TOKEN = re.compile(b'|'.join([
+  _tgClass(TG.T_ALPHA) + b'+', _tgClass(TG.T_SINGLE),
+  _tgClass(TG.T_SYMBOL) + b'+']))
+
 class ParseError(RuntimeError):
-  def __init__(self, line, msg): return super().__init__(f'line {line}: {msg}')
+  def __init__(self, line, msg, path=None):
+    where = f'line {line}' if path is None else f'{path}:{line}'
+    return super().__init__(f'{where}: {msg}')
 
 @dataclass
 class Parser:
@@ -897,28 +3080,21 @@ class Parser:
   i: int = 0
   line: int = 1
   env: TyEnv = dataclasses.field(default_factory=TyEnv)
+  path: str = None # for errors
 
-  def error(self, msg): raise ParseError(self.line, msg)
+  def error(self, msg): raise ParseError(self.line, msg, self.path)
 
   def skipWhitespace(self, skipNewlines=True):
-    while self.i < len(self.buf) and TG.fromChr(self.buf[self.i]) is TG.T_WHITE:
-      if skipNewlines and self.buf[self.i] == ord('\n'):
-        self.line += 1
-      self.i += 1
+    j = RE_WHITE.match(self.buf, self.i).end()
+    if skipNewlines: self.line += self.buf.count(b'\n', self.i, j)
+    self.i = j
 
   def _token(self) -> bytes:
     self.skipWhitespace()
-    if self.i == len(self.buf): return
-    starti = self.i
-    group = coaleseTG(TG.fromChr(self.buf[self.i]))
-    self.i += 1
-    if group is TG.T_SINGLE:
-      return self.buf[starti:self.i]
-    while self.i < len(self.buf):
-      if coaleseTG(TG.fromChr(self.buf[self.i])) is not group:
-        return self.buf[starti:self.i]
-      self.i += 1
-    return self.buf[starti: self.i]
+    m = RE_TOKEN.match(self.buf, self.i)
+    if m is None: return
+    starti, self.i = self.i, m.end()
+    return self.buf[starti:self.i]
 
   def token(self, allowEof=False):
     if not allowEof and self.i >= len(self.buf): self.error("Unexpected EOF")
@@ -985,11 +3161,22 @@ class Parser:
     if not isinstance(kty, Hashable): raise TypeError(f'Key {kty.name} is not hashable')
     return self.env.map(kty, vty)
 
+  def qualify(self, name: bytes) -> bytes:
+    """The full name of a name defined in this module."""
+    return name if b'.' in name else modname(self.mod, name)
+
+  def lookup(self, name: bytes) -> Any:
+    """Get the type name refers to, preferring this module's."""
+    if self.mod and b'.' not in name:
+      ty = self.env.tys.get(modname(self.mod, name))
+      if ty is not None: return ty
+    return self.env.tys[name]
+
   def parseTy(self) -> Any:
     name = self.token()
     if name == b'Arr': return self.parseArr()
     if name == b'Map': return self.parseMap()
-    return self.env.tys[name]
+    return self.lookup(name)
 
   def parseField(self) -> StructField:
     name = self.token(); self.need(':')
@@ -1022,7 +3209,7 @@ class Parser:
     return int(t, 10)
 
   def parseDeclare(self) -> Undefined:
-    return self.env.undefined(self.token())
+    return self.env.undefined(self.qualify(self.token()))
 
   def parseStruct(self) -> StructBase:
     name, fields = self._parseStruct()
@@ -1055,10 +3242,10 @@ class Parser:
     return self.env.bitmap(self.mod, name, variants)
 
   def parseConst(self):
-    name = self.token(); self.need(':');
+    name = self.qualify(self.token()); self.need(':');
     if name in self.env.vals: self.error(f"const {name} already defined")
-    tyName = self.token(); self.need('=')
-    self.env.vals[name] = self.env.tys[tyName].parse(self)
+    ty = self.lookup(self.token()); self.need('=')
+    self.env.vals[name] = ty.parse(self)
 
   def parse(self):
     while self.i < len(self.buf):
@@ -1069,3 +3256,541 @@ class Parser:
       elif token == b'enum':    self.parseEnum()
       elif token == b'bitmap':  self.parseBitmap()
       elif token == b'const':   self.parseConst()
+
+################################################################################
+# Env Cache: store a description of a parsed TyEnv and rebuild it without
+# lexing. The description is the TyEnv.defs (replayed in order) and the consts
+# as nested tuples, stored with marshal (the format of python's own bytecode
+# cache, which loads much faster than decoding an equivalent zoab tree):
+#
+#   magic len(sha) sha marshal((def...), ((name, tyRef, value)...))
+#   def:   (b'declare', name)
+#          (b'Arr', tyRef) | (b'Map', tyRef, tyRef)
+#          (b'struct', mod, name, ((name, tyRef, zid, default)...))
+#          (b'enum',   mod, name, ((name, tyRef)...))
+#          (b'bitmap', mod, name, ((name, var, msk)...))
+#   tyRef: name | (b'Arr', tyRef) | (b'Map', tyRef, tyRef)
+#
+# Values (defaults and consts) are zoab: ty.encode(value). A missing zid or
+# default is None.
+
+ENV_CACHE_MAGIC = b'zoaenv1\n'
+# marshal's format can change with the python version: it is part of the key
+ENV_CACHE_VERSION = b'%s-%d.%d-marshal%d' % (
+  sys.implementation.name.encode(), *sys.version_info[:2], marshal.version)
+
+def _tyRef(env: TyEnv, ty):
+  name = ty.name if isbytes(ty.name) else ty.name.encode('utf-8')
+  if env.tys.get(name) is ty: return name
+  if hasattr(ty, '_kty'): return (b'Map', _tyRef(env, ty._kty), _tyRef(env, ty._vty))
+  if hasattr(ty, '_ty'):  return (b'Arr', _tyRef(env, ty._ty))
+  raise TypeError(f"Can not describe type {name}")
+
+def _frTyRef(env: TyEnv, ref):
+  if isbytes(ref): return env.tys[ref]
+  if ref[0] == b'Arr': return env.arr(_frTyRef(env, ref[1]))
+  if ref[0] == b'Map': return env.map(_frTyRef(env, ref[1]), _frTyRef(env, ref[2]))
+  raise ValueError(f"Unknown tyRef: {ref[0]}")
+
+def _frValue(ty, b: bytes):
+  v = ty.decode(b)
+  return v if isinstance(v, ty) else ty(v)
+
+def _modName(ty):
+  """Split ty.name into (mod, name)."""
+  name = ty.__name__.encode('utf-8')
+  return ty.name[:-len(name) - 1] if ty.name != name else None, name
+
+def _describe(env: TyEnv):
+  """The (defs, vals) describing env."""
+  defs = []
+  for kind, name in env.defs:
+    ty = env.tys[name]
+    if kind == b'declare':       defs.append((kind, name)); continue
+    if kind in (b'Arr', b'Map'): defs.append(_tyRef(env, ty)); continue
+    if kind == b'struct': items = tuple(
+      (n, _tyRef(env, f.ty), f.zid,
+       None if f.default is None else f.ty.encode(f.default))
+      for n, f in ty._fields.items())
+    elif kind == b'enum': items = tuple(
+      (n, _tyRef(env, v.ty)) for n, v in ty._variants)
+    else: items = tuple((n, v.var, v.msk) for n, v in ty._variants)
+    defs.append((kind, *_modName(ty), items))
+  vals = tuple((n, _tyRef(env, type(v)), type(v).encode(v))
+               for n, v in env.vals.items())
+  return tuple(defs), vals
+
+def describeEnv(env: TyEnv, sha: bytes = b'') -> bytes:
+  """Serialize the types and consts of env (see Env Cache)."""
+  return (ENV_CACHE_MAGIC + bytes([len(sha)]) + sha
+          + marshal.dumps(_describe(env)))
+
+def loadEnv(b: bytes, sha: bytes = None) -> TyEnv:
+  """Rebuild the TyEnv described by b (from describeEnv).
+
+  Raises ValueError if b is not a description (or not of sha).
+  """
+  n = len(ENV_CACHE_MAGIC)
+  if b[:n] != ENV_CACHE_MAGIC: raise ValueError("Not an env description")
+  end = n + 1 + b[n]
+  if sha is not None and b[n + 1:end] != sha:
+    raise ValueError("Stale env description")
+  env = TyEnv()
+  _loadDefs(env, *marshal.loads(b[end:]))
+  return env
+
+def _loadDefs(env: TyEnv, defs, vals):
+  """Replay the (defs, vals) of _describe into env.
+
+  Declares of already defined types are skipped.
+  """
+  for d in defs:
+    kind = d[0]
+    if kind == b'declare':
+      if d[1] not in env.tys: env.undefined(d[1])
+      continue
+    if kind in (b'Arr', b'Map'): _frTyRef(env, d); continue
+    _kind, mod, name, items = d
+    if kind == b'struct':
+      fields = odict()
+      for n, ty, zid, default in items:
+        ty = _frTyRef(env, ty)
+        fields[n] = StructField(ty, zid=zid,
+          default=None if default is None else _frValue(ty, default))
+      env.struct(mod, name, fields)
+    elif kind == b'enum':
+      env.enum(mod, name, [(n, EnumVar(_frTyRef(env, ty))) for n, ty in items])
+    elif kind == b'bitmap':
+      env.bitmap(mod, name, [(n, BmVar(var, msk)) for n, var, msk in items])
+    else: raise ValueError(f"Unknown def: {kind}")
+  for n, ty, v in vals:
+    if n in env.vals: raise KeyError(f"const {n} already defined")
+    env.vals[n] = _frValue(_frTyRef(env, ty), v)
+
+def _cachedEnv(sha: bytes, cache: str, build) -> TyEnv:
+  """Load the env of sha from the directory cache, else build() and store it.
+
+  Entries are keyed by sha and ENV_CACHE_VERSION. A missing, stale or corrupt
+  entry is (re)built.
+  """
+  sha = hashlib.sha256(ENV_CACHE_VERSION + sha).digest()
+  path = os.path.join(cache, sha.hex() + '.zenv')
+  try:
+    with open(path, 'rb') as f: return loadEnv(f.read(), sha)
+  except Exception:
+    pass # missing, stale or corrupt: (re)build it
+  env = build()
+  try:
+    os.makedirs(cache, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f: f.write(describeEnv(env, sha))
+    os.replace(tmp, path)
+  except OSError: pass # the cache is only an optimization
+  return env
+
+def parseCached(b: bytes, cache: str) -> Result:
+  """Parse the .ty bytes b, caching the result in the directory cache.
+
+  Entries are keyed by the sha256 of b.
+  """
+  def build():
+    parser = Parser(b)
+    parser.parse()
+    return parser.env
+  return envResult(_cachedEnv(hashlib.sha256(b).digest(), cache, build))
+
+################################################################################
+# Pickling: the types a TyEnv creates can't be pickled by reference, so they
+# are pickled as (env ref, type name) and their instances as (env ref, type
+# name, zoab bytes). The env ref pickles as the sha256 of the env's description
+# (see Env Cache) and the description itself, once per pickle. On unpickle the
+# sha is looked up in a registry of the envs of this process, else the env is
+# rebuilt from the description (once per process) when its types are first
+# used. An env built from the same source has the same sha, so a process can
+# also provide it with envRef(env).
+
+_ENV_REFS = weakref.WeakValueDictionary() # sha: _EnvRef
+
+def _envState(env: 'TyEnv'): return len(env.defs), len(env.vals)
+
+class _EnvRef:
+  __slots__ = ('sha', 'desc', 'env', 'state', '__weakref__')
+  def __init__(self, sha, desc, env=None, state=None):
+    self.sha, self.desc, self.env, self.state = sha, desc, env, state
+
+  def __reduce__(self): return (_loadEnvRef, (self.sha, self.desc))
+
+  def load(self) -> 'TyEnv':
+    if self.env is None:
+      if hashlib.sha256(self.desc).digest() != self.sha:
+        raise ValueError(f"Corrupt env description: {self.sha.hex()}")
+      env = loadEnv(self.desc)
+      env._ref, self.env, self.state = self, env, _envState(env)
+    return self.env
+
+def _loadEnvRef(sha: bytes, desc: bytes) -> _EnvRef:
+  ref = _ENV_REFS.get(sha)
+  if ref is None: ref = _ENV_REFS[sha] = _EnvRef(sha, desc)
+  return ref
+
+def envRef(env: 'TyEnv') -> _EnvRef:
+  """The (picklable) ref of env in its current state.
+
+  Its sha then unpickles to env in this process, even if another env (of the
+  same source) was registered for it.
+  """
+  ref, state = env._ref, _envState(env)
+  if ref is None or ref.state != state:
+    desc = describeEnv(env)
+    ref = env._ref = _EnvRef(hashlib.sha256(desc).digest(), desc, env, state)
+  _ENV_REFS[ref.sha] = ref
+  return ref
+
+class _TyMeta(type):
+  """The metaclass of the types a TyEnv creates, so that they pickle by env
+  ref (see _reduceTyClass) instead of by (unimportable) name.
+  """
+
+def _reduceTyClass(ty):
+  if '_tyEnv' not in vars(ty): return ty.__qualname__ # a subclass: by name
+  return (_tyFromRef, (envRef(ty._tyEnv), ty.name))
+
+def _tyFromRef(ref: _EnvRef, name): return ref.load().tys[name]
+
+copyreg.pickle(_TyMeta, _reduceTyClass)
+
+def _reduceTy(v, protocol):
+  ty = type(v)
+  return (_unpickleTy, (envRef(ty._tyEnv), ty.name, ty.encode(v)))
+
+def _unpickleTy(ref: _EnvRef, name, b: bytes):
+  return ref.load().tys[name].decode(b)
+
+################################################################################
+# Tree: parse a tree of .ty files into one TyEnv. Each file is a module named
+# by its path (a/b.ty is a.b) and defines its names in that module (a.b.Foo).
+# Within the module a name can be used by itself (Foo), other modules must use
+# the full name.
+#
+# The modules are parsed into the env in dependency order, each declaring the
+# names it uses from modules not yet parsed (which happens in cycles). With a
+# pool of processes (for large trees) each module is instead parsed on its own
+# into the description of the Env Cache, and the descriptions are replayed in
+# that order. A module that can't be parsed on its own (i.e. it has a const of
+# another module's type) is parsed into the env instead.
+
+PARALLEL_MIN_BYTES = 0x40000 # smaller trees are parsed in this process
+
+def treeModules(paths) -> List[Tuple[bytes, str]]:
+  """The sorted (mod, path) of the .ty files in paths (files or directories)."""
+  if isinstance(paths, (str, os.PathLike)): paths = [paths]
+  mods = {}
+  for root in paths:
+    if os.path.isdir(root):
+      found = []
+      for d, _dirs, files in os.walk(root):
+        for f in files:
+          if not f.endswith('.ty'): continue
+          path = os.path.join(d, f)
+          rel = os.path.relpath(path, root)[:-len('.ty')]
+          found.append(('.'.join(rel.split(os.sep)), path))
+    else: found = [(os.path.splitext(os.path.basename(root))[0], root)]
+    for mod, path in found:
+      mod = mod.encode('utf-8')
+      if mod in mods: raise KeyError(f"Module {mod} is both {mods[mod]} and {path}")
+      mods[mod] = path
+  return sorted(mods.items())
+
+@dataclass
+class _ModuleParser(Parser):
+  """Parses a module on its own, declaring the names it uses from mods."""
+  mods: frozenset = frozenset()
+  used: set = dataclasses.field(default_factory=set)
+
+  def lookup(self, name: bytes) -> Any:
+    try: return super().lookup(name)
+    except KeyError:
+      mod = name.rpartition(b'.')[0]
+      if mod == self.mod or mod not in self.mods: raise
+      self.used.add(name)
+      return self.env.undefined(name)
+
+RE_FULLNAME = re.compile(
+  _tgClass(TG.T_ALPHA) + b'*\\.' + _tgClass(TG.T_ALPHA) + b'*')
+
+def _scanDeps(mod: bytes, b: bytes, mods: frozenset) -> List[bytes]:
+  """The other mods that the module b uses names of."""
+  deps = {n.rpartition(b'.')[0] for n in RE_FULLNAME.findall(b)}
+  return sorted(deps.intersection(mods) - {mod})
+
+def _parseModule(mod: bytes, path: str, b: bytes, mods: frozenset):
+  """Parse the module on its own: (description, deps, used).
+
+  The description is None if it can't be.
+  """
+  p = _ModuleParser(b, mod=mod, path=path, mods=mods)
+  try:
+    p.parse()
+    desc = _describe(p.env)
+  except Exception: return None, _scanDeps(mod, b, mods), ()
+  return desc, sorted({n.rpartition(b'.')[0] for n in p.used}), tuple(p.used)
+
+def _depOrder(deps: Dict[bytes, List[bytes]]) -> List[bytes]:
+  """The mods sorted so that each comes after its deps (except in cycles)."""
+  order, seen = [], set()
+  def visit(mod):
+    if mod in seen: return
+    seen.add(mod)
+    for d in deps[mod]: visit(d)
+    order.append(mod)
+  for mod in sorted(deps): visit(mod)
+  return order
+
+def _parseTree(files: List[Tuple[bytes, str, bytes]], workers=None) -> TyEnv:
+  mods = frozenset(mod for mod, _, _ in files)
+  if workers is None:
+    big = sum(len(b) for _, _, b in files) >= PARALLEL_MIN_BYTES
+    workers = os.cpu_count() if big else 1
+  args = (*zip(*files), [mods] * len(files))
+  if workers > 1 and len(files) > 1:
+    import concurrent.futures # not at the top: it slows down importing zoa
+    with concurrent.futures.ProcessPoolExecutor(min(workers, len(files))) as ex:
+      parsed = list(ex.map(_parseModule, *args))
+  else: # only scan the deps, each module is parsed into env below
+    parsed = [(None, _scanDeps(mod, b, mods), ()) for mod, _, b in files]
+  parsed = {f[0]: (f, p) for f, p in zip(files, parsed)}
+  env, used = TyEnv(), []
+  for mod in _depOrder({mod: p[1] for mod, (_, p) in parsed.items()}):
+    (_, path, b), (desc, _, u) = parsed[mod]
+    if desc is None: # parse it into env (declaring names of later modules)
+      p = _ModuleParser(b, mod=mod, env=env, path=path, mods=mods)
+      p.parse(); u = p.used
+    else: _loadDefs(env, *desc)
+    used.extend(u)
+  for name in used:
+    if isinstance(env.tys[name], Undefined): raise KeyError(name)
+  return env
+
+def parseTree(paths, workers: int = None, cache: str = None) -> Result:
+  """Parse the .ty files in paths (files or directories) as modules of one env.
+
+  workers is the number of processes to parse with (default: cpus for large
+  trees). If cache is a directory then the result is cached there (see
+  parseCached), keyed by the modules and their content.
+  """
+  files = []
+  for mod, path in treeModules(paths):
+    with open(path, 'rb') as f: files.append((mod, path, f.read()))
+  if cache is None: return envResult(_parseTree(files, workers))
+  h = hashlib.sha256()
+  for mod, _, b in files: h.update(mod + b'\0' + hashlib.sha256(b).digest())
+  return envResult(_cachedEnv(h.digest(), cache, lambda: _parseTree(files, workers)))
+
+################################################################################
+# Parallel Decode: decode a file of records (see open_records) with a pool of
+# processes. The records are split into chunks of about chunk bytes, each of
+# which a worker decodes from its own mapping of the file. The types of an env
+# are sent to the workers by their env ref (see Pickling).
+
+DECODE_CHUNK = 0x400000
+DECODE_WINDOW = 2 # chunks decoded (or done and waiting) at once per worker
+
+_decoder = None # the worker's (mapping, ty, where, fn)
+
+def _initDecoder(path: str, ty, where, fn):
+  global _decoder
+  with open(path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  _decoder = (memoryview(mm), ty, where, fn)
+
+def _decodeChunk(start: int, end: int, decoder=None) -> list:
+  mv, ty, where, fn = decoder or _decoder
+  out = []; i = start
+  try:
+    while i < end:
+      if ty is None: v, i = from_zoab_buf(mv, i, True)
+      else:          v, i = ty._dec(mv, i)
+      if where is not None and not where(v): continue
+      out.append(v if fn is None else fn(v))
+  except IndexError: raise Eof(f"Record at {i} ends early")
+  return out
+
+def _decodeChunks(offs, end: int, chunk: int):
+  """Split the records at offs into (start, end) chunks of about chunk bytes."""
+  starts, ends, i = [], [], 0
+  while i < len(offs):
+    j = bisect.bisect_left(offs, offs[i] + chunk, i + 1)
+    starts.append(offs[i]); ends.append(offs[j] if j < len(offs) else end)
+    i = j
+  return starts, ends
+
+def decode_records(path: str, ty=None, where=None, fn=None,
+                   workers: int = None, ordered=True, chunk: int = None):
+  """Decode the records of the file at path in a pool of workers processes
+  (default: cpus), yielding them in order or (if not ordered) as they are done.
+  At most DECODE_WINDOW * workers chunks are submitted ahead of the consumer.
+
+  Records are decoded as ZoaRaw, or as ty if given. Only the records where
+  where(value) is true are kept and if fn is given fn(value) is yielded
+  instead. where and fn run in the workers and must be picklable (as must what
+  fn returns).
+  """
+  if workers is None: workers = os.cpu_count()
+  with open_records(path) as recs:
+    if chunk is None: chunk = max(1, min(DECODE_CHUNK, recs.end // (4 * workers)))
+    starts, ends = _decodeChunks(recs._offs, recs.end, chunk)
+    if workers <= 1 or len(starts) <= 1:
+      decoder = (recs.buf, ty, where, fn)
+      for s, e in zip(starts, ends): yield from _decodeChunk(s, e, decoder)
+      return
+  if hasattr(ty, '_tyEnv'): envRef(ty._tyEnv) # so the results unpickle as ty
+  import concurrent.futures # not at the top: it slows down importing zoa
+  ex = concurrent.futures.ProcessPoolExecutor(
+    workers, initializer=_initDecoder, initargs=(path, ty, where, fn))
+  chunks = zip(starts, ends)
+  def submit(): # the next chunk, else None
+    c = next(chunks, None)
+    return c and ex.submit(_decodeChunk, *c)
+  try:
+    futs = [submit() for _ in range(min(len(starts), DECODE_WINDOW * workers))]
+    if ordered:
+      futs = deque(futs)
+      while futs:
+        out = futs.popleft().result()
+        fut = submit()
+        if fut: futs.append(fut)
+        yield from out
+    else:
+      futs = set(futs)
+      while futs:
+        done, futs = concurrent.futures.wait(
+          futs, return_when=concurrent.futures.FIRST_COMPLETED)
+        for fut in done:
+          nxt = submit()
+          if nxt: futs.add(nxt)
+          yield from fut.result()
+  finally: ex.shutdown(cancel_futures=True)
+
+################################################################################
+# Select: get one nested value (i.e. record.items[3].name) out of encoded bytes.
+# The path is resolved against the types once, then the bytes are walked by
+# their headers (skipping siblings) and only the target value is decoded. A
+# path is a string of .field, [index] and ['key'] or a list of names and ints.
+
+RE_SELECT = re.compile(r'''\.?([A-Za-z_]\w*)|\[(-?\d+)\]|\['([^']*)'\]''')
+_SEL_ITEM, _SEL_POS, _SEL_ZID, _SEL_VAR, _SEL_KEY = range(5)
+
+def selectPath(path: str) -> list:
+  """Split a path string into its names, ints and keys."""
+  out, i = [], 0
+  while i < len(path):
+    m = RE_SELECT.match(path, i)
+    if m is None or m.end() == i: raise ValueError(f"Invalid path at {i}: {path!r}")
+    name, idx, key = m.groups()
+    out.append(int(idx) if idx is not None else name if name is not None else key)
+    i = m.end()
+  return out
+
+def _selectSteps(ty, path) -> Tuple[list, Any]:
+  """Resolve path against ty: return the steps to walk and the target type."""
+  steps = []
+  for part in path:
+    if ty is None or issubclass(ty, (ArrBase, ArrSizedBase)):
+      if not isinstance(part, int): raise ValueError(f"Arr index must be int: {part!r}")
+      steps.append((_SEL_ITEM, part)); ty = ty and ty._ty
+    elif issubclass(ty, MapBase):
+      steps.append((_SEL_KEY, (part, ty._kty))); ty = ty._vty
+    elif issubclass(ty, StructBase):
+      f = ty._fields.get(part.encode('utf-8') if isinstance(part, str) else part)
+      if f is None: raise ValueError(f"{ty.name} has no field {part!r}")
+      if f.zid is not None: steps.append((_SEL_ZID, f.zid))
+      else: steps.append((_SEL_POS, [g is f for g in ty._fields.values()
+                                     if g.zid is None].index(True)))
+      ty = f.ty
+    elif issubclass(ty, EnumBase):
+      name = part.encode('utf-8') if isinstance(part, str) else part
+      for k, (n, var) in enumerate(ty._variants):
+        if n == name: break
+      else: raise ValueError(f"{ty.name} has no variant {part!r}")
+      steps.append((_SEL_VAR, k)); ty = var.ty
+    else: raise ValueError(f"Can't select {part!r} in {ty.name}")
+  return steps, ty
+
+def _items(mv: memoryview, i: int):
+  """Yield the offset of each item of the arr at mv[i]."""
+  meta = mv[i]; i += 1
+  if not ZOA_ARR & meta: raise TypeError(f"Expected arr at {i - 1}")
+  while True:
+    for _ in range(ZOA_LEN_MASK & meta):
+      yield i
+      m = mv[i]; i = i + 1 + m if m < ZOA_ARR else zoab_skip(mv, i)
+    if not ZOA_JOIN & meta: return
+    meta = mv[i]; i += 1
+    if not ZOA_ARR & meta: raise ValueError("join different types")
+
+def _nth(items, n: int) -> int:
+  """The nth of items, or None."""
+  if n < 0:
+    items = list(items)
+    return items[n] if -n <= len(items) else None
+  for k, i in enumerate(items):
+    if k == n: return i
+
+def _selectAt(mv: memoryview, i: int, steps) -> int:
+  """Walk steps from mv[i]: return the offset of the target, or None if an
+  arr item, struct field, enum variant or map key on the way is not present.
+  """
+  for kind, arg in steps:
+    items = _items(mv, i)
+    if kind == _SEL_ITEM:
+      i = _nth(items, arg)
+      if i is None: return None
+      continue
+    if kind == _SEL_KEY:
+      key, kty = arg
+      for j in items:
+        v = next(items)
+        if kty._dec(mv, j)[0] == key: i = v; break
+      else: return None
+      continue
+    first = Int._dec(mv, next(items))[0] # posArgs or the variant
+    if kind == _SEL_VAR:
+      if first != arg: return None
+      i = next(items)
+    elif kind == _SEL_POS:
+      if arg >= first: return None
+      i = _nth(items, arg)
+    else: # _SEL_ZID
+      for k, j in enumerate(items):
+        if k < first: continue
+        zid, j = Int._dec(mv, _dec_fixed(mv, j, 2))
+        if zid == arg: i = j; break
+      else: return None
+  return i
+
+def _selectValue(mv: memoryview, i: int, steps, target):
+  try:
+    i = _selectAt(mv, i, steps)
+    if i is None: return None
+    if target is None: return from_zoab_buf(mv, i)[0]
+    return target._dec(mv, i)[0]
+  except (IndexError, StopIteration): raise Eof() # a short buf or arr
+
+def _select(ty, path):
+  return _selectSteps(ty, selectPath(path) if isinstance(path, str) else path)
+
+def select(buf, ty, path, i: int = 0):
+  """Decode the value at path (see Select) of the ty value at buf[i].
+
+  Returns None if an arr item, struct field, enum variant or map key on the way
+  is not present. If ty is None the path must be arr indexes and the value is
+  ZoaRaw.
+  """
+  mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+  return _selectValue(mv, i, *_select(ty, path))
+
+def select_records(file: str, ty, path, index=None):
+  """Yield the select() of path from each record of file (see open_records)."""
+  steps, target = _select(ty, path)
+  with open_records(file, index) as recs:
+    for off in recs._offs: yield _selectValue(recs.buf, off, steps, target)
@@ -14,7 +14,7 @@ from zoa import utf8
 
 argP = argparse.ArgumentParser(
   description='zoa exporter. Auto-generate code types and constants from zoa.')
-argP.add_argument('tys', help="Path/s to file or directory.")
+argP.add_argument('tys', nargs='+', help="Path/s to file or directory.")
 argP.add_argument('export',  help="Path to export file.")
 argP.add_argument('--lang', default='C', help="Path to export file.")
 
@@ -26,11 +26,15 @@ HEADER = '''
 #include "civ.h"\n
 '''
 
+def cName(name):
+  """The C name of a (module) name, i.e. net.Msg is net_Msg."""
+  return utf8(name).replace('.', '_')
+
 def cStruct(s: zoa.StructBase):
   out = ["typedef struct {"]
   for name, f in s._fields.items():
-    out.append(f"  {utf8(f.ty.name)} {utf8(name)};")
-  out.append("}  " + utf8(s.name) + ";")
+    out.append(f"  {cName(f.ty.name)} {utf8(name)};")
+  out.append("}  " + cName(s.name) + ";")
   out =  '\n'.join(out)
   print(out)
   return out
@@ -40,14 +44,14 @@ NATIVE_TYS = {'U1': 'U1', 'U2': 'U4', 'U4': 'U4'}
 
 def cTx(ty, field):
   """Generate transmission code for a field."""
-  ty = utf8(ty)
+  ty = cName(ty)
   field = 't->' + utf8(field)
   if ty in NATIVE_TYS: ty = NATIVE_TYS[ty]
   else:                field = '&' + field
   return f'{ty}_txZoab(r, {field})'
 
 def cStructTx(s: zoa.StructBase):
-  out = ['void  {ty}_txZoab(Ring* r, {ty}* t) {{'.format(ty=utf8(s.name))]
+  out = ['void  {ty}_txZoab(Ring* r, {ty}* t) {{'.format(ty=cName(s.name))]
   for field, f in s._fields.items():
     tx = cTx(f.ty.name, field)
     out.append(f"  {tx};")
@@ -58,7 +62,7 @@ def cWrite(ty, field):
   """Generate writer code for a field."""
 
 def cStructDbg(s: zoa.StructBase):
-  out = ['void  {ty}_dbg(Writer* w, {ty}* t) {{'.format(ty=utf8(s.name))]
+  out = ['void  {ty}_dbg(Writer* w, {ty}* t) {{'.format(ty=cName(s.name))]
   for field, f in s._fields.items():
     tx = cTx(f.ty.name, field)
     out.append(f"  {tx};")
@@ -67,7 +71,7 @@ def cStructDbg(s: zoa.StructBase):
 
 def exportConstants(f, vals):
   for k, v in vals.items():
-    f.write(f'#define {k:<20}  0x{v:02X}\n')
+    f.write(f'#define {cName(k):<20}  0x{v:02X}\n')
   f.write('\n')
 
 def exportStructs(f, tys):
@@ -89,8 +93,9 @@ def exportC(tys, vals, export, zty):
 def main(argv):
   print(argv)
   args = argP.parse_args()
-  r = zoa.parse(args.tys)
-  exportC(r.tys, r.vals, args.export, args.tys)
+  if len(args.tys) == 1: r = zoa.parse(args.tys[0])
+  else:                  r = zoa.parseTree(args.tys)
+  exportC(r.tys, r.vals, args.export, ' '.join(args.tys))
 
 
 if __name__ == '__main__':